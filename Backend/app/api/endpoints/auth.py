@@ -1,17 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ...database.session import get_db
 from ...models.user import User
-from ...core.auth import verify_password, create_access_token, get_current_user
+from ...core.auth import verify_password, create_access_token, get_current_user, get_admin_user
+from ...core.ratelimit import throttle_login, get_throttle_stats
 from ...schemas.user import UserResponse, KeyCardAuth 
 
 router = APIRouter()
 
 @router.post("/token")
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    throttle_login(request, "name", form_data.username)
+
     result = await db.execute(
         select(User).where(User.name == form_data.username)
     )
@@ -31,8 +34,10 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSessi
     }
 
 @router.post("/token/keycard")
-async def login_with_keycard(auth_data: KeyCardAuth, db: AsyncSession = Depends(get_db)):
+async def login_with_keycard(request: Request, auth_data: KeyCardAuth, db: AsyncSession = Depends(get_db)):
     """Authenticate using key card ID and PIN"""
+    throttle_login(request, "card", auth_data.key_card_id)
+
     # Query all users since we can't directly query by hashed value
     result = await db.execute(select(User))
     users = result.scalars().all()
@@ -58,3 +63,8 @@ async def login_with_keycard(auth_data: KeyCardAuth, db: AsyncSession = Depends(
 @router.get("/me", response_model=UserResponse)
 async def get_current_user_info(current_user: User = Depends(get_current_user)):
     return current_user._tojson()
+
+@router.get("/throttle")
+async def get_login_throttle_stats(current_user: User = Depends(get_admin_user)):
+    """Counters of login attempts rejected by the rate limiter"""
+    return get_throttle_stats()
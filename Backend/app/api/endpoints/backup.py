@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+
+from ...models.user import User
+from ...core.auth import get_admin_user
+from ...database.sqlite import backup_database, list_backups, sqlite_path
+from ...config import settings
+
+router = APIRouter()
+
+@router.get("")
+async def get_backups(current_user: User = Depends(get_admin_user)):
+    """SQLite backups in SQLITE_BACKUP_DIR, newest first (admin only)"""
+    return list_backups()
+
+@router.post("")
+async def create_backup(current_user: User = Depends(get_admin_user)):
+    """Copy the SQLite database now, while it stays online (admin only)"""
+    if sqlite_path(settings.DATABASE_URL) is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Backups are only supported for SQLite database files"
+        )
+    return await backup_database()
@@ -1,8 +1,9 @@
 import asyncio
-from fastapi import APIRouter, Depends, WebSocket, HTTPException, status
+import time
+from fastapi import APIRouter, Depends, WebSocket, HTTPException, Query, status
 from sqlalchemy import select
 from datetime import datetime, timezone, timedelta
-from typing import List, Dict, Set
+from typing import List, Dict, Set, Optional
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 from ...core.logging import get_transaction_logger
@@ -39,11 +40,21 @@ async def broadcast_status_update(device_id: int, data: dict):
         status_ws_connections[device_id] -= dead_connections
 
 from ...database.session import get_db
+from ...database.replica import get_read_db
+from ...database.instrumentation import track_queries
 from ...models.device import Device
 from ...models.user import User
-from ...schemas.device import DeviceResponse
+from ...schemas.device import DeviceResponse, UsageSessionResponse
 from ...core.auth import get_current_user, get_admin_user
-from ...config import DEVICES
+from ...core.ledger import get_request_id, record_movement, to_utc_naive
+from ...core.idempotency import check_idempotency_key, commit_idempotent, request_fingerprint, run_idempotent
+from ...core.stats import record_run, record_refund
+from ...core.sites import DEVICE_IDS, notify_device_change
+from ...core.device_table import get_devices_json, publish_device, read_device, table_stamp, to_datetime
+from ...core.responses import FastJSONResponse
+from ...models.ledger import LedgerKind
+from ...models.usage_session import UsageSession
+from ...config import DEVICES, settings
 
 # Add this class for request validation
 class DeviceStartRequest(BaseModel):
@@ -57,26 +68,33 @@ transaction_logger = get_transaction_logger()
 @router.get("/all", response_model=List[DeviceResponse])
 async def get_all_devices(
     current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
+    # Answered from the shared device table without a query once it is loaded
+    devices = get_devices_json()
+    if devices is not None:
+        return FastJSONResponse(devices)
+    
     result = await db.execute(select(Device))
     devices = result.scalars().all()
     
-    # Update status for each device
+    # Expired devices are shown as idle. The session may be the read-only replica, so the reset
+    # isn't committed here, the next start, stop or status update of the device saves it.
     for device in devices:
-        await _update_device_status(db, device)
-    await db.commit()
+        await _update_device_status(db, device, commit=False)
     
-    return [device._tojson() for device in devices]
+    return FastJSONResponse([device._tojson() for device in devices])
 
 @router.post("/start/{device_id}", response_model=DeviceResponse)
 async def start_device(
     device_id: int,
     request: DeviceStartRequest,
     current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    request_id: str = Depends(get_request_id),
+    idempotency_key: Optional[str] = Depends(check_idempotency_key)
 ):
-    if not 1 <= device_id <= 5:
+    if device_id not in DEVICE_IDS:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid device ID"
@@ -86,42 +104,74 @@ async def start_device(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Duration must be positive"
         )
+    if request.duration_minutes > settings.MAX_RUN_MINUTES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Duration must be at most {settings.MAX_RUN_MINUTES} minutes"
+        )
     
-    return await _handle_device_start(
+    # Retries and concurrent duplicates get the first request's answer and aren't charged again
+    fingerprint = request_fingerprint(current_user.uid, device_id=device_id, body=request.model_dump())
+    response = await run_idempotent(db, idempotency_key, "start_device", fingerprint, lambda: _handle_device_start(
         db, 
         device_id, 
         request.user_id, 
-        request.duration_minutes
-    )
+        request.duration_minutes,
+        actor_id=current_user.uid,
+        request_id=request_id,
+        idempotency_key=idempotency_key,
+        fingerprint=fingerprint
+    ))
+    notify_device_change(device_id)
+    return response
 
 @router.post("/stop/{device_id}")
 async def stop_device(
     device_id: int,
     current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    request_id: str = Depends(get_request_id),
+    idempotency_key: Optional[str] = Depends(check_idempotency_key)
 ):
-    if not 1 <= device_id <= 5:
+    if device_id not in DEVICE_IDS:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid device ID"
         )
     
-    # Get device to check permissions
+    # Allow both admins and the user who started the device to stop it. Checked before the
+    # idempotency lookup, so nobody gets a stored or in-flight response for another user's run.
+    # An idle device passes here, a retry of the caller's own stop gets its stored response.
     device = await _get_device_with_status_update(db, device_id)
-    
-    # Allow both admins and the user who started the device to stop it
-    if not current_user.is_admin and device.user_id != current_user.uid:
+    if not current_user.is_admin and device.user_id is not None and device.user_id != current_user.uid:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not authorized to stop this device"
         )
     
-    return await _handle_device_stop(db, device_id)
+    async def stop():
+        # The device may have been stopped or started again meanwhile, check on the current state
+        device = await _get_device_with_status_update(db, device_id)
+        if not current_user.is_admin and device.user_id != current_user.uid:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Not authorized to stop this device"
+            )
+        
+        return await _handle_device_stop(
+            db, device_id, actor_id=current_user.uid, request_id=request_id, idempotency_key=idempotency_key,
+            fingerprint=fingerprint
+        )
+    
+    fingerprint = request_fingerprint(current_user.uid, device_id=device_id)
+    response = await run_idempotent(db, idempotency_key, "stop_device", fingerprint, stop)
+    notify_device_change(device_id)
+    return response
 
 @router.websocket("/ws/timeleft/{device_id}")
 async def time_ws_endpoint(websocket: WebSocket, device_id: int):
     # Validate device_id before accepting the connection
-    if not 1 <= device_id <= 5:
+    if device_id not in DEVICE_IDS:
         await websocket.close(code=1003, reason="Invalid device ID")
         return
     
@@ -134,42 +184,56 @@ async def time_ws_endpoint(websocket: WebSocket, device_id: int):
 
     try:
         while True:
-            db_generator = get_db()
-            session = await anext(db_generator)
+            state = read_device(device_id)
+            if state is not None:
+                user_id, end_time = state
+                time_left = end_time - time.time() if end_time else 0
+                await websocket.send_json({
+                    "device_id": device_id,
+                    "time_left": round(time_left) if time_left > 0 else 0,
+                    "status": "running" if time_left > 0 else "idle",
+                    "user_id": user_id if time_left > 0 else None
+                })
+                await asyncio.sleep(1)
+                continue
             
-            try:
-                result = await session.execute(select(Device).where(Device.id == device_id))
-                device = result.scalars().first()
+            with track_queries("WS /device/ws/timeleft/{device_id}"):
+                db_generator = get_db()
+                session = await anext(db_generator)
+            
+                try:
+                    result = await session.execute(select(Device).where(Device.id == device_id))
+                    device = result.scalars().first()
                 
-                response_data = {
-                    "device_id": device_id,
-                    "time_left": 0,
-                    "status": "idle",
-                    "user_id": None
-                }
+                    response_data = {
+                        "device_id": device_id,
+                        "time_left": 0,
+                        "status": "idle",
+                        "user_id": None
+                    }
                 
-                if device and device.end_time:
-                    if device.end_time.tzinfo is None:
-                        device.end_time = device.end_time.replace(tzinfo=timezone.utc)
+                    if device and device.end_time:
+                        if device.end_time.tzinfo is None:
+                            device.end_time = device.end_time.replace(tzinfo=timezone.utc)
                     
-                    time_left = (device.end_time - datetime.now(timezone.utc)).total_seconds()
-                    if time_left <= 0:
-                        device.user_id = None
-                        device.end_time = None
-                        await session.commit()
-                    else:
-                        response_data.update({
-                            "time_left": round(time_left),
-                            "status": "running",
-                            "user_id": device.user_id
-                        })
+                        time_left = (device.end_time - datetime.now(timezone.utc)).total_seconds()
+                        if time_left <= 0:
+                            device.user_id = None
+                            device.end_time = None
+                            await session.commit()
+                        else:
+                            response_data.update({
+                                "time_left": round(time_left),
+                                "status": "running",
+                                "user_id": device.user_id
+                            })
                 
-                await websocket.send_json(response_data)
-            finally:
-                try:
-                    await db_generator.asend(None)
-                except StopAsyncIteration:
-                    pass
+                    await websocket.send_json(response_data)
+                finally:
+                    try:
+                        await db_generator.asend(None)
+                    except StopAsyncIteration:
+                        pass
                 
             await asyncio.sleep(1)
     finally:
@@ -182,7 +246,7 @@ async def time_ws_endpoint(websocket: WebSocket, device_id: int):
 @router.websocket("/ws/status/{device_id}")
 async def device_status_ws_endpoint(websocket: WebSocket, device_id: int):
     # Validate device_id before accepting the connection
-    if not 1 <= device_id <= 5:
+    if device_id not in DEVICE_IDS:
         await websocket.close(code=1003, reason="Invalid device ID")
         return
     
@@ -196,45 +260,62 @@ async def device_status_ws_endpoint(websocket: WebSocket, device_id: int):
     try:
         last_status = None
         while True:
-            db_generator = get_db()
-            session = await anext(db_generator)
-            
-            try:
-                result = await session.execute(select(Device).where(Device.id == device_id))
-                device = result.scalars().first()
-                
-                if not device or not device.end_time:
-                    current_status = False
-                else:
-                    # Make sure end_time is timezone-aware
-                    if device.end_time.tzinfo is None:
-                        device.end_time = device.end_time.replace(tzinfo=timezone.utc)
-                    
-                    time_left = (device.end_time - datetime.now(timezone.utc)).total_seconds()
-                    if time_left <= 0:
-                        # Reset device
-                        device.user_id = None
-                        device.end_time = None
-                        await session.commit()
-                        current_status = False
-                    else:
-                        current_status = True
-                
-                # Only send update if status has changed
+            state = read_device(device_id)
+            if state is not None:
+                _, end_time = state
+                current_status = bool(end_time) and end_time > time.time()
                 if current_status != last_status:
                     response = {
                         "device_id": device_id,
                         "running": current_status
                     }
                     if current_status:
-                        response["end_time"] = device.end_time.isoformat()
+                        response["end_time"] = to_datetime(end_time).isoformat()
                     await websocket.send_json(response)
                     last_status = current_status
-            finally:
+                await asyncio.sleep(1)
+                continue
+            
+            with track_queries("WS /device/ws/status/{device_id}"):
+                db_generator = get_db()
+                session = await anext(db_generator)
+            
                 try:
-                    await db_generator.asend(None)
-                except StopAsyncIteration:
-                    pass
+                    result = await session.execute(select(Device).where(Device.id == device_id))
+                    device = result.scalars().first()
+                
+                    if not device or not device.end_time:
+                        current_status = False
+                    else:
+                        # Make sure end_time is timezone-aware
+                        if device.end_time.tzinfo is None:
+                            device.end_time = device.end_time.replace(tzinfo=timezone.utc)
+                    
+                        time_left = (device.end_time - datetime.now(timezone.utc)).total_seconds()
+                        if time_left <= 0:
+                            # Reset device
+                            device.user_id = None
+                            device.end_time = None
+                            await session.commit()
+                            current_status = False
+                        else:
+                            current_status = True
+                
+                    # Only send update if status has changed
+                    if current_status != last_status:
+                        response = {
+                            "device_id": device_id,
+                            "running": current_status
+                        }
+                        if current_status:
+                            response["end_time"] = device.end_time.isoformat()
+                        await websocket.send_json(response)
+                        last_status = current_status
+                finally:
+                    try:
+                        await db_generator.asend(None)
+                    except StopAsyncIteration:
+                        pass
                         
             await asyncio.sleep(1)
     finally:
@@ -244,20 +325,69 @@ async def device_status_ws_endpoint(websocket: WebSocket, device_id: int):
             if not status_ws_connections[device_id]:
                 del status_ws_connections[device_id]
 
+@router.get("/sessions", response_model=List[UsageSessionResponse])
+async def get_usage_sessions(
+    device_id: Optional[int] = None,
+    user_id: Optional[int] = None,
+    at: Optional[datetime] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Device runs, newest first. `at` finds the runs active at that moment, `start`/`end`
+    the runs overlapping that window. Non-admins only see their own runs.
+    """
+    if not current_user.is_admin:
+        if user_id is not None and user_id != current_user.uid:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Not enough permissions"
+            )
+        user_id = current_user.uid
+    
+    query = select(UsageSession)
+    if device_id is not None:
+        query = query.where(UsageSession.device_id == device_id)
+    if user_id is not None:
+        query = query.where(UsageSession.user_id == user_id)
+    # No run lasts longer than MAX_RUN_MINUTES, so a lower bound on start_time keeps the
+    # (start_time, end_time) index scan to that window instead of all older runs
+    max_run = timedelta(minutes=settings.MAX_RUN_MINUTES)
+    if at is not None:
+        at = to_utc_naive(at)
+        query = query.where(UsageSession.start_time >= at - max_run, UsageSession.start_time <= at,
+                            UsageSession.end_time > at)
+    if start is not None:
+        start = to_utc_naive(start)
+        query = query.where(UsageSession.start_time >= start - max_run, UsageSession.end_time > start)
+    if end is not None:
+        query = query.where(UsageSession.start_time < to_utc_naive(end))
+    query = query.order_by(UsageSession.start_time.desc(), UsageSession.id.desc()).limit(limit)
+    
+    result = await db.execute(query)
+    return [usage_session._tojson() for usage_session in result.scalars().all()]
+
 @router.get("/{device_id}", response_model=DeviceResponse)
 async def get_device(
     device_id: int,
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    if not 1 <= device_id <= 5:
+    if device_id not in DEVICE_IDS:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid device ID"
         )
     
+    devices = get_devices_json([device_id])
+    if devices is not None:
+        return FastJSONResponse(devices[0])
+    
     device = await _get_device_with_status_update(db, device_id)
-    return device._tojson()
+    return FastJSONResponse(device._tojson())
 
 # Helper functions
 async def _get_device_with_status_update(session, device_id):
@@ -273,7 +403,7 @@ async def _get_device_with_status_update(session, device_id):
     await _update_device_status(session, device)
     return device
 
-async def _update_device_status(session, device):
+async def _update_device_status(session, device, commit=True):
     if device.end_time:
         if device.end_time.tzinfo is None:
             device.end_time = device.end_time.replace(tzinfo=timezone.utc)
@@ -282,9 +412,11 @@ async def _update_device_status(session, device):
         if time_left <= 0:
             device.user_id = None
             device.end_time = None
-            await session.commit()
+            if commit:
+                await session.commit()
 
-async def _handle_device_start(session, device_id, user_id, duration_minutes):
+async def _handle_device_start(session, device_id, user_id, duration_minutes, actor_id=None, request_id=None,
+                               idempotency_key=None, fingerprint=""):
     user = await _get_user(session, user_id)
     device = await _get_or_create_device(session, device_id)
     device_config = _get_device_config(device_id)
@@ -310,11 +442,22 @@ async def _handle_device_start(session, device_id, user_id, duration_minutes):
     
     # Deduct the cost from user's balance
     user.cash = new_balance
+    record_movement(
+        session, user, LedgerKind.DEVICE_PAYMENT, old_balance, new_balance,
+        device_id=device_id, actor_id=actor_id, request_id=request_id
+    )
+    await record_run(
+        session, device, user_id, datetime.now(timezone.utc), duration_minutes, round(old_balance - new_balance, 2)
+    )
     
-    await _update_device_time(session, device, user_id, duration_minutes)
-    return device._tojson()
+    await _update_device_time(session, device, user_id, duration_minutes, cost=old_balance - new_balance)
+    stamp = table_stamp()
+    response = await commit_idempotent(session, idempotency_key, "start_device", fingerprint, device._tojson())
+    publish_device(device, stamp)
+    return response
 
-async def _handle_device_stop(session, device_id):
+async def _handle_device_stop(session, device_id, actor_id=None, request_id=None, idempotency_key=None,
+                              fingerprint=""):
     device = await _get_device_with_status_update(session, device_id)
     
     if not device.end_time:
@@ -323,11 +466,11 @@ async def _handle_device_stop(session, device_id):
             detail="Device is not running"
         )
     
-    refund = await _process_refund(session, device)
+    refund = await _process_refund(session, device, actor_id=actor_id, request_id=request_id)
+    await _close_usage_session(session, device, refund)
     
     device.user_id = None
     device.end_time = None
-    await session.commit()
     
     # Create response data
     response = {
@@ -335,6 +478,9 @@ async def _handle_device_stop(session, device_id):
         "device": device._tojson(),
         "refund_amount": refund
     }
+    stamp = table_stamp()
+    response = await commit_idempotent(session, idempotency_key, "stop_device", fingerprint, response)
+    publish_device(device, stamp)
     
     # Broadcast updates to all connected WebSocket clients
     await broadcast_device_update(device_id, {
@@ -383,18 +529,43 @@ def _get_device_config(device_id: int) -> dict:
         )
     return device_config
 
-async def _update_device_time(session, device: Device, user_id: int, duration_minutes: int):
+async def _update_device_time(session, device: Device, user_id: int, duration_minutes: int, cost: float = 0):
     if device.end_time and device.end_time > datetime.now(timezone.utc):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Device is currently in use"
         )
     
+    start_time = datetime.now(timezone.utc)
     device.user_id = user_id
-    device.end_time = datetime.now(timezone.utc) + timedelta(minutes=duration_minutes)
-    await session.commit()
+    device.end_time = start_time + timedelta(minutes=duration_minutes)
+    
+    # Keep a record of the run that outlives the device reset
+    session.add(UsageSession(
+        device_id=device.id,
+        user_id=user_id,
+        start_time=to_utc_naive(start_time),
+        planned_end=to_utc_naive(device.end_time),
+        end_time=to_utc_naive(device.end_time),
+        cost=round(cost, 2)
+    ))
 
-async def _process_refund(session, device: Device) -> float:
+async def _close_usage_session(session, device: Device, refund: float):
+    """Mark the device's current run as stopped early"""
+    now = to_utc_naive(datetime.now(timezone.utc))
+    result = await session.execute(
+        select(UsageSession)
+        .where(UsageSession.device_id == device.id, UsageSession.actual_end.is_(None), UsageSession.end_time > now)
+        .order_by(UsageSession.start_time.desc())
+        .limit(1)
+    )
+    usage_session = result.scalars().first()
+    if usage_session:
+        usage_session.actual_end = now
+        usage_session.end_time = now
+        usage_session.refund = refund
+
+async def _process_refund(session, device: Device, actor_id=None, request_id=None) -> float:
     if not device.end_time or not device.user_id:
         return 0.0
     
@@ -430,6 +601,11 @@ async def _process_refund(session, device: Device) -> float:
     )
     
     user.cash = new_balance
+    record_movement(
+        session, user, LedgerKind.DEVICE_REFUND, old_balance, new_balance,
+        device_id=device.id, actor_id=actor_id, request_id=request_id
+    )
+    await record_refund(session, device, device.user_id, datetime.now(timezone.utc), time_left, refund_amount)
     
     # Don't commit here, let the calling function handle the commit
     # to maintain transaction integrity
@@ -0,0 +1,138 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+from typing import Optional
+
+from ...database.session import get_db
+from ...models.user import User
+from ...models.ledger import LedgerCheckpoint, LedgerEntry
+from ...core.auth import get_admin_user
+from ...core.ledger import to_utc_naive
+from ...core.integrity import get_inclusion_proof, get_latest_checkpoint, seal_ledger, verify_entries
+from ...core.reconcile import get_last_reconciliation, reconcile_balances
+
+router = APIRouter()
+
+@router.get("/checkpoints")
+async def get_checkpoints(
+    limit: int = Query(20, ge=1, le=1000),
+    current_user: User = Depends(get_admin_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Ledger checkpoints, newest first (admin only)"""
+    result = await db.execute(select(LedgerCheckpoint).order_by(LedgerCheckpoint.tree_size.desc()).limit(limit))
+    return [checkpoint._tojson() for checkpoint in result.scalars().all()]
+
+@router.post("/checkpoints")
+async def create_checkpoint(
+    current_user: User = Depends(get_admin_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Seal all pending ledger entries now and return the latest checkpoint (admin only)"""
+    while await seal_ledger(db):
+        pass
+    checkpoint = await _get_checkpoint_or_404(db)
+    return checkpoint._tojson()
+
+@router.get("/verify")
+async def verify_ledger(
+    user_id: Optional[int] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user: User = Depends(get_admin_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Verify a user's entries or all entries in a time range against the latest checkpoint (admin only).
+    Time ranges are checked as one contiguous stretch of the chain, so deleted entries are found too.
+    """
+    if user_id is None and start is None and end is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Specify user_id or a time range"
+        )
+    checkpoint = await _get_checkpoint_or_404(db)
+
+    conditions = []
+    if user_id is not None:
+        conditions.append(LedgerEntry.user_id == user_id)
+    if start is not None:
+        conditions.append(LedgerEntry.timestamp >= to_utc_naive(start))
+    if end is not None:
+        conditions.append(LedgerEntry.timestamp < to_utc_naive(end))
+    query = select(LedgerEntry).where(*conditions)
+
+    contiguous = user_id is None
+    if contiguous:
+        # Everything sealed between the first and last entry of the range, so gaps show up
+        bounds = await db.execute(select(func.min(LedgerEntry.seq), func.max(LedgerEntry.seq)).where(*conditions))
+        first_seq, last_seq = bounds.one()
+        if first_seq is not None:
+            query = select(LedgerEntry).where(or_(
+                LedgerEntry.seq.between(first_seq, last_seq),
+                and_(LedgerEntry.seq.is_(None), *conditions)
+            ))
+
+    result = await db.execute(query)
+    entries = result.scalars().all()
+    failures = await verify_entries(db, entries, checkpoint, contiguous=contiguous)
+    sealed = sum(1 for entry in entries if entry.seq is not None and entry.seq < checkpoint.tree_size)
+    return {
+        "valid": not failures,
+        "checkpoint": checkpoint._tojson(),
+        "checked": sealed,
+        "unsealed": len(entries) - sealed,
+        "failures": failures
+    }
+
+@router.get("/proof/{entry_id}")
+async def get_entry_proof(
+    entry_id: int,
+    current_user: User = Depends(get_admin_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Inclusion proof of one ledger entry in the latest checkpoint, for verifying it offline (admin only)"""
+    result = await db.execute(select(LedgerEntry).where(LedgerEntry.id == entry_id))
+    entry = result.scalars().first()
+    if not entry:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Ledger entry not found"
+        )
+    checkpoint = await _get_checkpoint_or_404(db)
+    if entry.seq is None or entry.seq >= checkpoint.tree_size:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Ledger entry is not sealed yet"
+        )
+    return {"entry": entry._tojson(), **await get_inclusion_proof(db, entry, checkpoint)}
+
+@router.get("/reconciliation")
+async def get_reconciliation(current_user: User = Depends(get_admin_user)):
+    """Report of the last balance reconciliation (admin only)"""
+    report = get_last_reconciliation()
+    if report is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No reconciliation has run yet"
+        )
+    return report
+
+@router.post("/reconciliation")
+async def run_reconciliation(
+    current_user: User = Depends(get_admin_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Check every user's balance against the ledger now (admin only)"""
+    return await reconcile_balances(db)
+
+# Helper functions
+async def _get_checkpoint_or_404(session) -> LedgerCheckpoint:
+    checkpoint = await get_latest_checkpoint(session)
+    if not checkpoint:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No ledger checkpoint yet"
+        )
+    return checkpoint
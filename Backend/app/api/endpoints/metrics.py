@@ -0,0 +1,53 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ...database.session import get_db
+from ...database.instrumentation import get_query_stats, reset_query_stats
+from ...database.replica import get_replica_status
+from ...database.sqlite import get_sqlite_stats
+from ...models.user import User
+from ...core.auth import get_admin_user
+from ...core.logging import get_logging_stats
+from ...core.idempotency import get_idempotency_stats
+from ...core.device_table import get_device_table_stats
+
+router = APIRouter()
+
+@router.get("/logging")
+async def get_logging_metrics(current_user: User = Depends(get_admin_user)):
+    """Backlog and drop counters of the background log writer"""
+    return get_logging_stats()
+
+@router.get("/idempotency")
+async def get_idempotency_metrics(
+    current_user: User = Depends(get_admin_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Size of the idempotency_keys table, sweeper progress and front cache counters"""
+    return await get_idempotency_stats(db)
+
+@router.get("/queries")
+async def get_query_metrics(current_user: User = Depends(get_admin_user)):
+    """Query count and database time per route and WebSocket tick, with the routes flagged for N+1 patterns"""
+    return get_query_stats()
+
+@router.delete("/queries")
+async def reset_query_metrics(current_user: User = Depends(get_admin_user)):
+    """Start aggregating query metrics from scratch"""
+    reset_query_stats()
+    return {"message": "Query metrics reset"}
+
+@router.get("/replica")
+async def get_replica_metrics(current_user: User = Depends(get_admin_user)):
+    """Replication lag and how many reads went to the replica and the primary"""
+    return get_replica_status()
+
+@router.get("/sqlite")
+async def get_sqlite_metrics(current_user: User = Depends(get_admin_user)):
+    """Writer queue waits and the last backup, when running on SQLite"""
+    return get_sqlite_stats()
+
+@router.get("/device-table")
+async def get_device_table_metrics(current_user: User = Depends(get_admin_user)):
+    """Reads, seqlock retries and writes of this worker on the shared device table"""
+    return get_device_table_stats()
@@ -0,0 +1,65 @@
+from typing import List
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ...database.replica import get_read_db
+from ...models.device import Device
+from ...models.user import User
+from ...schemas.device import DeviceResponse
+from ...core.auth import get_current_user
+from ...core.sites import SITE_DEVICES, get_hub, get_sites, release_hub
+from ...core.device_table import get_devices_json
+from ...core.responses import FastJSONResponse
+
+router = APIRouter()
+
+@router.get("")
+async def list_sites(current_user: User = Depends(get_current_user)):
+    """Sites with their devices, the worker owning each and its hub if it runs in this process"""
+    return get_sites()
+
+@router.get("/{site}/devices", response_model=List[DeviceResponse])
+async def get_site_devices(
+    site: str,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    if site not in SITE_DEVICES:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Site not found"
+        )
+
+    devices = get_devices_json(SITE_DEVICES[site])
+    if devices is not None:
+        return FastJSONResponse(devices)
+
+    result = await db.execute(select(Device).where(Device.site == site).order_by(Device.id))
+    devices = []
+    for device in result.scalars().all():
+        data = device._tojson()
+        # Expired devices are shown as idle, the site's hub saves the reset
+        if data["end_time"] and not data["time_left"]:
+            data.update(user_id=None, end_time=None)
+        devices.append(data)
+    return FastJSONResponse(devices)
+
+@router.websocket("/{site}/ws")
+async def site_ws_endpoint(websocket: WebSocket, site: str):
+    # Validate site before accepting the connection
+    if site not in SITE_DEVICES:
+        await websocket.close(code=1003, reason="Invalid site")
+        return
+
+    await websocket.accept()
+    hub = get_hub(site)
+    try:
+        await hub.connect(websocket)
+        # Updates are pushed by the hub, the client only has to stay connected
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        release_hub(hub, websocket)
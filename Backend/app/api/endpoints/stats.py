@@ -0,0 +1,72 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from ...database.replica import get_read_db
+from ...models.user import User
+from ...models.stats import UsageRollup
+from ...core.auth import get_current_user, get_admin_user
+from ...core.stats import bucket_start
+from ...core.ledger import to_utc_naive
+from ...core.analytics import load_intervals, occupancy
+
+router = APIRouter()
+
+@router.get("")
+async def get_stats(
+    scope: str = Query("device", pattern="^(device|device_type|user)$"),
+    period: str = Query("day", pattern="^(hour|day|month)$"),
+    key: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Usage and revenue rollups per device, device type or user and hour, day or month.
+    Non-admins can only read their own user rollups.
+    """
+    if not current_user.is_admin and (scope != "user" or key != str(current_user.uid)):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+
+    query = select(UsageRollup).where(UsageRollup.scope == scope, UsageRollup.period == period)
+    if start:
+        query = query.where(UsageRollup.bucket_start >= bucket_start(start, period))
+    if end:
+        query = query.where(UsageRollup.bucket_start < to_utc_naive(end))
+    if key is not None:
+        query = query.where(UsageRollup.key == key)
+    query = query.order_by(UsageRollup.bucket_start, UsageRollup.key)
+
+    result = await db.execute(query)
+    return [rollup._tojson() for rollup in result.scalars().all()]
+
+@router.get("/occupancy")
+async def get_occupancy(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    device_type: Optional[str] = None,
+    utc_offset_hours: int = Query(0, ge=-12, le=14),
+    current_user: User = Depends(get_admin_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Weekday x hour-of-day occupancy heatmap, peak concurrency and per device utilization
+    (admin only). Defaults to the last year. Rows of the 7 x 24 grids start on Monday.
+    """
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(days=365)
+    if to_utc_naive(start) >= to_utc_naive(end):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="start must be before end"
+        )
+    intervals = await load_intervals(db, start, end, device_type)
+    # The array work is CPU bound, keep it off the event loop
+    return await run_in_threadpool(occupancy, intervals, utc_offset_hours)
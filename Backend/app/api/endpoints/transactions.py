@@ -0,0 +1,48 @@
+from fastapi import APIRouter, Depends, Query
+from fastapi.concurrency import run_in_threadpool
+from datetime import datetime
+from typing import List, Optional
+
+from ...models.user import User
+from ...core.auth import get_admin_user
+from ...core.logindex import get_transaction_log_index
+from ...core.logging import read_segment_manifest
+from ...config import settings
+
+router = APIRouter()
+
+def _to_log_time(value: Optional[datetime]) -> Optional[datetime]:
+    """The log has naive local timestamps, convert aware datetimes before comparing"""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value
+
+@router.get("/log")
+async def query_transaction_log(
+    user_id: Optional[int] = None,
+    device_id: Optional[int] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    kind: Optional[List[str]] = Query(None),
+    limit: int = Query(1000, ge=1, le=10000),
+    current_user: User = Depends(get_admin_user)
+):
+    """Search transactions.log and its rotated segments through the sidecar index (admin only)"""
+    # Index refresh and file reads are blocking, keep them off the event loop
+    records = await run_in_threadpool(
+        get_transaction_log_index().query,
+        user_id=user_id,
+        device_id=device_id,
+        start=_to_log_time(start),
+        end=_to_log_time(end),
+        kinds=kind,
+        limit=limit
+    )
+    for record in records:
+        record["timestamp"] = record["timestamp"].isoformat()
+    return records
+
+@router.get("/segments")
+async def get_transaction_log_segments(current_user: User = Depends(get_admin_user)):
+    """Closed transactions.log segments with their time ranges (admin only)"""
+    return read_segment_manifest(settings.TRANSACTION_LOG_PATH)
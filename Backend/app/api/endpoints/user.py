@@ -1,14 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Path
-from sqlalchemy import select
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, status, Path, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy import select, func
+from sqlalchemy.exc import IntegrityError
+from typing import List, Optional
+from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession
+import base64
+import codecs
+import csv
+import io
+import json
 import logging
 
 from ...database.session import get_db
+from ...database.replica import get_read_db
 from ...models.user import User
 from ...schemas.user import KeyCardAuth, UserCreate, UserUpdate, UserResponse
-from ...core.auth import get_current_user, get_admin_user, get_password_hash
+from ...core.auth import get_current_user, get_admin_user, get_password_hash, get_password_hashes
 from ...core.logging import get_transaction_logger
+from ...core.ledger import get_request_id, record_movement, to_utc_naive
+from ...core.idempotency import check_idempotency_key, commit_idempotent, request_fingerprint, run_idempotent
+from ...core.responses import FastJSONResponse
+from ...models.ledger import LedgerEntry, LedgerKind
+from ...schemas.ledger import LedgerEntryResponse
+from ...config import settings
 
 router = APIRouter()
 # Regular logger
@@ -16,17 +32,140 @@ logger = logging.getLogger(__name__)
 # Special transaction logger
 transaction_logger = get_transaction_logger()
 
+# Columns the user list can be sorted by. uid is always the tie breaker for the keyset.
+USER_SORT_COLUMNS = {"uid": User.uid, "name": User.name}
+# JSON types a cursor may carry for each sort column
+USER_SORT_TYPES = {"uid": (int,), "name": (str,)}
+# Columns of a UserResponse, selected as rows so no User objects are loaded for the list
+USER_LIST_COLUMNS = (
+    User.uid,
+    User.name,
+    User.cash,
+    User.creation_time,
+    User.is_admin,
+    (User.key_card_hash.isnot(None) & User.pin_hash.isnot(None)).label("has_keycard")
+)
+
 @router.get("/all", response_model=List[UserResponse])
-async def get_all_users(db: AsyncSession = Depends(get_db)): #TODO: make admin only
-    result = await db.execute(select(User))
-    users = result.scalars().all()
-    return [user._tojson() for user in users]
+async def get_all_users( #TODO: make admin only
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    name_prefix: Optional[str] = None,
+    sort: str = Query("uid", pattern="^-?(uid|name)$"),
+    include_total: bool = False,
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    List users. Without `limit` all users are returned. With `limit` a page is returned
+    and the cursor for the next page is sent in the X-Next-Cursor header.
+    `sort` is `uid` or `name`, prefixed with `-` for descending order.
+    """
+    descending = sort.startswith("-")
+    sort_column = USER_SORT_COLUMNS[sort.lstrip("-")]
+    sort_types = USER_SORT_TYPES[sort.lstrip("-")]
+
+    filters = []
+    if name_prefix:
+        filters.append(User.name.startswith(name_prefix, autoescape=True))
+
+    query = select(*USER_LIST_COLUMNS).where(*filters)
+    if cursor:
+        sort_value, last_uid = _decode_cursor(cursor, sort_types)
+        if sort_column is User.uid:
+            query = query.where(User.uid < last_uid if descending else User.uid > last_uid)
+        elif descending:
+            query = query.where((sort_column < sort_value) | ((sort_column == sort_value) & (User.uid < last_uid)))
+        else:
+            query = query.where((sort_column > sort_value) | ((sort_column == sort_value) & (User.uid > last_uid)))
+
+    if descending:
+        query = query.order_by(sort_column.desc(), User.uid.desc())
+    else:
+        query = query.order_by(sort_column.asc(), User.uid.asc())
+    if limit:
+        # Fetch one extra row to know whether there is a next page
+        query = query.limit(limit + 1)
+
+    result = await db.execute(query)
+    users = result.all()
+
+    headers = {}
+    if limit and len(users) > limit:
+        users = users[:limit]
+        last = users[-1]
+        headers["X-Next-Cursor"] = _encode_cursor(getattr(last, sort_column.key), last.uid)
+
+    if include_total:
+        total = await db.execute(select(func.count()).select_from(User).where(*filters))
+        headers["X-Total-Count"] = str(total.scalar())
+
+    return FastJSONResponse([
+        {
+            "uid": user.uid,
+            "name": user.name,
+            "cash": float(user.cash),
+            "creation_time": user.creation_time,
+            "is_admin": bool(user.is_admin),
+            "has_keycard": bool(user.has_keycard)
+        }
+        for user in users
+    ], headers=headers)
+
+# Fields written by the user export, in column order
+EXPORT_FIELDS = ["uid", "name", "cash", "is_admin", "has_keycard", "creation_time"]
+
+@router.get("/export")
+async def export_users(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    current_user: User = Depends(get_admin_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Stream all users with balances and key card status as CSV or NDJSON (admin only)"""
+    query = select(
+        User.uid,
+        User.name,
+        User.cash,
+        User.is_admin,
+        (User.key_card_hash.isnot(None) & User.pin_hash.isnot(None)).label("has_keycard"),
+        User.creation_time
+    ).order_by(User.uid).execution_options(yield_per=settings.EXPORT_CHUNK_SIZE)
+
+    async def generate():
+        # db.stream uses a server side cursor, so only one chunk of rows is held in memory
+        result = await db.stream(query)
+        if format == "csv":
+            yield ",".join(EXPORT_FIELDS) + "\n"
+        async for rows in result.partitions():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer) if format == "csv" else None
+            for row in rows:
+                values = [
+                    row.uid,
+                    row.name,
+                    float(row.cash) if row.cash is not None else None,
+                    bool(row.is_admin),
+                    bool(row.has_keycard),
+                    row.creation_time.isoformat() if row.creation_time else None
+                ]
+                if writer:
+                    writer.writerow(values)
+                else:
+                    buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, values))) + "\n")
+            yield buffer.getvalue()
+
+    logger.info(f"User {current_user.uid} exported users as {format}")
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        generate(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="users.{format}"'}
+    )
 
 @router.get("/{uid}", response_model=UserResponse)
 async def get_user(
     uid: int,
     current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     if not current_user.is_admin and current_user.uid != uid:
         raise HTTPException(
@@ -41,7 +180,58 @@ async def get_user(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
-    return user._tojson()
+    return FastJSONResponse(user._tojson())
+
+@router.get("/{uid}/transactions", response_model=List[LedgerEntryResponse])
+async def get_user_transactions(
+    uid: int,
+    response: Response,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Payments, refunds and cash updates of a user, newest first. The cursor for the
+    next (older) page is sent in the X-Next-Cursor header. `end` is exclusive.
+    """
+    if not current_user.is_admin and current_user.uid != uid:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to access this user"
+        )
+
+    query = select(LedgerEntry).where(LedgerEntry.user_id == uid)
+    if start:
+        query = query.where(LedgerEntry.timestamp >= to_utc_naive(start))
+    if end:
+        query = query.where(LedgerEntry.timestamp < to_utc_naive(end))
+    if cursor:
+        last_timestamp, last_id = _decode_cursor(cursor, (str,))
+        try:
+            last_timestamp = to_utc_naive(datetime.fromisoformat(last_timestamp))
+        except (ValueError, TypeError):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+        query = query.where(
+            (LedgerEntry.timestamp < last_timestamp) |
+            ((LedgerEntry.timestamp == last_timestamp) & (LedgerEntry.id < last_id))
+        )
+    # Walks the (user_id, timestamp, id) index backwards, so the newest page is cheap
+    query = query.order_by(LedgerEntry.timestamp.desc(), LedgerEntry.id.desc()).limit(limit + 1)
+
+    result = await db.execute(query)
+    entries = result.scalars().all()
+    if len(entries) > limit:
+        entries = entries[:limit]
+        last = entries[-1]
+        response.headers["X-Next-Cursor"] = _encode_cursor(last.timestamp.isoformat(), last.id)
+
+    return [entry._tojson() for entry in entries]
 
 @router.post("/admin", response_model=UserResponse)
 async def create_admin_user(
@@ -65,6 +255,89 @@ async def create_user(
     
     return await _createUser(user_data, db)
 
+@router.post("/import")
+async def import_users(
+    request: Request,
+    current_user: User = Depends(get_admin_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Create many users at once (admin only). The body is a JSON array, NDJSON or CSV
+    (with a header row) of UserCreate fields, selected by the Content-Type header.
+    Rows that fail are reported and skipped, the remaining rows are created.
+    """
+    rows = await _read_import_rows(request)
+    errors = []
+    valid = []
+
+    for index, row in enumerate(rows, start=1):
+        try:
+            valid.append((index, UserCreate(**row)))
+        except (ValidationError, TypeError) as e:
+            errors.append({"row": index, "name": row.get("name") if isinstance(row, dict) else None,
+                           "detail": str(e).splitlines()[0]})
+
+    # Detect duplicates against one pre-fetched name set instead of one query per row
+    names = {user_data.name for _, user_data in valid}
+    existing = set()
+    name_list = list(names)
+    for i in range(0, len(name_list), settings.IMPORT_BATCH_SIZE):
+        result = await db.execute(select(User.name).where(User.name.in_(name_list[i:i + settings.IMPORT_BATCH_SIZE])))
+        existing.update(result.scalars().all())
+
+    to_create = []
+    for index, user_data in valid:
+        if user_data.name in existing:
+            errors.append({"row": index, "name": user_data.name, "detail": "Username already exists"})
+            continue
+        existing.add(user_data.name)
+        to_create.append((index, user_data))
+
+    # Hash all secrets in one parallel pass
+    secrets = []
+    for _, user_data in to_create:
+        secrets += [user_data.password, user_data.key_card_id, user_data.pin]
+    hashes = await get_password_hashes(secrets)
+
+    new_users = [
+        (index, User(
+            name=user_data.name,
+            cash=0,
+            hashed_password=hashes[3 * i],
+            is_admin=user_data.is_admin,
+            key_card_hash=hashes[3 * i + 1],
+            pin_hash=hashes[3 * i + 2]
+        ))
+        for i, (index, user_data) in enumerate(to_create)
+    ]
+
+    created = 0
+    for i in range(0, len(new_users), settings.IMPORT_BATCH_SIZE):
+        batch = new_users[i:i + settings.IMPORT_BATCH_SIZE]
+        db.add_all([user for _, user in batch])
+        try:
+            await db.commit()
+            created += len(batch)
+        except IntegrityError:
+            # Someone else created one of the names meanwhile, retry row by row to find it
+            await db.rollback()
+            for index, user in batch:
+                db.add(user)
+                try:
+                    await db.commit()
+                    created += 1
+                except IntegrityError:
+                    await db.rollback()
+                    errors.append({"row": index, "name": user.name, "detail": "Username already exists"})
+
+    logger.info(f"User {current_user.uid} imported {created} users ({len(errors)} rows failed)")
+    errors.sort(key=lambda error: error["row"])
+    return {
+        "created": created,
+        "failed": len(errors),
+        "errors": errors
+    }
+
 @router.delete("/{uid}")
 async def delete_user(
     uid: int, 
@@ -93,53 +366,23 @@ async def update_user(
     uid: int, 
     user_data: UserUpdate, 
     current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    request_id: str = Depends(get_request_id),
+    idempotency_key: Optional[str] = Depends(check_idempotency_key)
 ):
-    # Get the user to update
-    result = await db.execute(select(User).where(User.uid == uid))
-    user = result.scalars().first()
-    
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    
-    # Only allow users to update their own account unless they're an admin
+    # Only allow users to update their own account unless they're an admin. Checked before
+    # the idempotency lookup, so a reused key never hands out another user's stored response.
     if current_user.uid != uid and not current_user.is_admin:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not enough permissions"
         )
     
-    # Update fields if provided
-    if user_data.name is not None:
-        user.name = user_data.name
-    
-    # Log and update cash if provided
-    if user_data.cash is not None:
-        old_cash = float(user.cash)
-        new_cash = user_data.cash
-        cash_difference = new_cash - old_cash
-        
-        # Log the transaction before making the change
-        transaction_logger.transaction(
-            f"CASH_UPDATE: User {user.uid} ({user.name}) balance changed from {old_cash} to {new_cash} "
-            f"(difference: {cash_difference}) by user {current_user.uid} ({current_user.name})"
-        )
-        
-        # Update the cash value
-        user.cash = new_cash
-    
-    # Update key card info if provided
-    if user_data.key_card_id is not None:
-        user.key_card_hash = get_password_hash(user_data.key_card_id) if user_data.key_card_id else None
-    
-    if user_data.pin is not None:
-        user.pin_hash = get_password_hash(user_data.pin) if user_data.pin else None
-        
-    await db.commit()
-    return user._tojson()
+    # A retried cash update must not be applied twice
+    fingerprint = request_fingerprint(current_user.uid, uid=uid, body=user_data.model_dump())
+    return await run_idempotent(db, idempotency_key, "update_user", fingerprint, lambda: _update_user(
+        db, uid, user_data, current_user, request_id, idempotency_key, fingerprint
+    ))
 
 @router.post("/{uid}/keycard", response_model=UserResponse)
 async def add_keycard(
@@ -219,16 +462,139 @@ async def remove_keycard(
     return {"message": "Key card authentication removed successfully"}
 
 # Helper functions
-async def _createUser(user_data: UserCreate, db: AsyncSession):
+def _encode_cursor(sort_value, last_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([sort_value, last_id]).encode()).decode()
+
+def _decode_cursor(cursor: str, sort_types: tuple = (str, int, float, type(None))):
+    """Sort value and id of the last row of the previous page. The sort value must be one of sort_types."""
+    try:
+        sort_value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        # Anything else, e.g. a list or dict from a crafted cursor, can't be compared with the column
+        if isinstance(sort_value, bool) or not isinstance(sort_value, sort_types):
+            raise TypeError("Cursor sort value has the wrong type")
+        return sort_value, int(last_id)
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+async def _iter_body_lines(request: Request):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    async for chunk in request.stream():
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+async def _read_import_rows(request: Request) -> list:
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    rows = []
+
+    try:
+        if content_type == "text/csv":
+            header = None
+            # One reader over the whole body, quoted fields may contain line breaks
+            text = (await request.body()).decode("utf-8")
+            for values in csv.reader(io.StringIO(text, newline="")):
+                if len(values) < 2 and not "".join(values).strip():  # blank line
+                    continue
+                if header is None:
+                    header = [column.strip() for column in values]
+                    continue
+                # Empty CSV cells mean "not set"
+                rows.append({k: v for k, v in zip(header, values) if v != ""})
+                if len(rows) > settings.IMPORT_MAX_ROWS:
+                    break
+        elif content_type == "application/x-ndjson":
+            async for line in _iter_body_lines(request):
+                if line.strip():
+                    rows.append(json.loads(line))
+                if len(rows) > settings.IMPORT_MAX_ROWS:
+                    break
+        elif content_type == "application/json":
+            rows = json.loads(await request.body())
+            if not isinstance(rows, list):
+                raise ValueError("Expected a JSON array")
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail="Content-Type must be application/json, application/x-ndjson or text/csv"
+            )
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid import data: {e}"
+        )
+
+    if len(rows) > settings.IMPORT_MAX_ROWS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Too many rows, at most {settings.IMPORT_MAX_ROWS} users can be imported at once"
+        )
+    return rows
+
+async def _update_user(db: AsyncSession, uid: int, user_data: UserUpdate, current_user: User,
+                       request_id: str, idempotency_key: Optional[str], fingerprint: str) -> dict:
+    # Get the user to update
+    result = await db.execute(select(User).where(User.uid == uid))
+    user = result.scalars().first()
     
-    # Check if username already exists
-    result = await db.execute(select(User).where(User.name == user_data.name))
-    if result.scalars().first():
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    
+    # Update fields if provided
+    if user_data.name is not None:
+        user.name = user_data.name
+    
+    # Log and update cash if provided
+    if user_data.cash is not None:
+        old_cash = float(user.cash)
+        new_cash = user_data.cash
+        cash_difference = new_cash - old_cash
+        
+        # Log the transaction before making the change
+        transaction_logger.transaction(
+            f"CASH_UPDATE: User {user.uid} ({user.name}) balance changed from {old_cash} to {new_cash} "
+            f"(difference: {cash_difference}) by user {current_user.uid} ({current_user.name})"
+        )
+        
+        # Update the cash value
+        user.cash = new_cash
+        record_movement(
+            db, user, LedgerKind.CASH_UPDATE, old_cash, new_cash,
+            actor_id=current_user.uid, request_id=request_id
+        )
+    
+    # Update key card info if provided
+    if user_data.key_card_id is not None:
+        user.key_card_hash = get_password_hash(user_data.key_card_id) if user_data.key_card_id else None
+    
+    if user_data.pin is not None:
+        user.pin_hash = get_password_hash(user_data.pin) if user_data.pin else None
+        
+    return await _commit_or_username_taken(db, idempotency_key, "update_user", fingerprint, user._tojson())
+
+async def _commit_or_username_taken(db: AsyncSession, idempotency_key: Optional[str] = None,
+                                    endpoint: Optional[str] = None, fingerprint: str = "",
+                                    response: Optional[dict] = None):
+    # The unique index on User.name rejects duplicates, so no lookup is needed beforehand
+    try:
+        return await commit_idempotent(db, idempotency_key, endpoint, fingerprint, response)
+    except IntegrityError:
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already exists"
         )
-    
+
+async def _createUser(user_data: UserCreate, db: AsyncSession):
     new_user = User(
         name=user_data.name,
         cash=0,
@@ -238,5 +604,5 @@ async def _createUser(user_data: UserCreate, db: AsyncSession):
         pin_hash=get_password_hash(user_data.pin) if user_data.pin else None
     )
     db.add(new_user)
-    await db.commit()
+    await _commit_or_username_taken(db)
     return new_user._tojson()
@@ -0,0 +1,124 @@
+import numpy as np
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..models.device import Device
+from ..models.usage_session import UsageSession
+from .ledger import to_utc_naive
+
+HOUR = 3600
+# 1970-01-01, where epoch hour 0 falls, was a Thursday
+EPOCH_WEEKDAY = 3
+
+
+def _to_epoch(timestamps) -> np.ndarray:
+    return np.array(timestamps, dtype="datetime64[s]").astype(np.int64)
+
+async def load_intervals(session: AsyncSession, start: datetime, end: datetime,
+                         device_type: Optional[str] = None) -> dict:
+    """Usage sessions overlapping [start, end) as arrays of device ids and epoch seconds"""
+    start, end = to_utc_naive(start), to_utc_naive(end)
+    devices_query = select(Device.id)
+    if device_type:
+        devices_query = devices_query.where(Device.type == device_type)
+    device_ids = (await session.execute(devices_query)).scalars().all()
+
+    result = await session.execute(
+        select(UsageSession.device_id, UsageSession.start_time, UsageSession.end_time)
+        .where(
+            UsageSession.device_id.in_(device_ids),
+            UsageSession.start_time < end,
+            UsageSession.end_time > start
+        )
+    )
+    rows = result.all()
+    return _intervals(
+        device_ids,
+        [row.device_id for row in rows],
+        _to_epoch([row.start_time for row in rows]),
+        _to_epoch([row.end_time for row in rows]),
+        start,
+        end
+    )
+
+def _intervals(device_ids, run_devices, run_starts, run_ends, start: datetime, end: datetime) -> dict:
+    window_start, window_end = _to_epoch([start, end])
+    run_starts = np.clip(np.asarray(run_starts, dtype=np.int64), window_start, window_end)
+    run_ends = np.clip(np.asarray(run_ends, dtype=np.int64), window_start, window_end)
+    keep = run_ends > run_starts
+    return {
+        "device_ids": list(device_ids),
+        "devices": np.asarray(run_devices, dtype=np.int64)[keep],
+        "starts": run_starts[keep],
+        "ends": run_ends[keep],
+        "window_start": int(window_start),
+        "window_end": int(window_end),
+    }
+
+def _split_into_hours(starts: np.ndarray, ends: np.ndarray):
+    """Split intervals at hour boundaries. Returns the source interval, epoch hour and seconds of each piece."""
+    first_hour = starts // HOUR
+    last_hour = (ends - 1) // HOUR
+    pieces = (last_hour - first_hour + 1).astype(np.int64)
+    source = np.repeat(np.arange(len(starts)), pieces)
+    offset = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    hours = first_hour[source] + offset
+    seconds = np.minimum(ends[source], (hours + 1) * HOUR) - np.maximum(starts[source], hours * HOUR)
+    return source, hours, seconds
+
+def _weekday_hour(hours: np.ndarray, utc_offset_hours: int) -> np.ndarray:
+    """Flat weekday * 24 + hour of day bin of epoch hours, in local time"""
+    local_hours = hours + utc_offset_hours
+    return ((local_hours // 24 + EPOCH_WEEKDAY) % 7) * 24 + local_hours % 24
+
+def occupancy(intervals: dict, utc_offset_hours: int = 0) -> dict:
+    """
+    Weekday x hour-of-day occupancy (share of machine time in use), per device utilization
+    and weekday x hour-of-day peak number of machines running at once.
+    """
+    device_ids = intervals["device_ids"]
+    starts, ends, devices = intervals["starts"], intervals["ends"], intervals["devices"]
+    window_start, window_end = intervals["window_start"], intervals["window_end"]
+    device_count = max(len(device_ids), 1)
+
+    # Machine seconds in use per weekday-hour bin
+    _, hours, seconds = _split_into_hours(starts, ends)
+    busy = np.bincount(_weekday_hour(hours, utc_offset_hours), weights=seconds, minlength=7 * 24)
+
+    # Machine seconds available per bin: every hour of the window, times the number of machines
+    _, window_hours, window_seconds = _split_into_hours(np.array([window_start]), np.array([window_end]))
+    available = np.bincount(
+        _weekday_hour(window_hours, utc_offset_hours), weights=window_seconds, minlength=7 * 24
+    ) * device_count
+    heatmap = np.divide(busy, available, out=np.zeros_like(busy), where=available > 0)
+
+    # Utilization per device over the whole window
+    index = {device_id: i for i, device_id in enumerate(device_ids)}
+    device_index = np.array([index.get(device_id, -1) for device_id in devices], dtype=np.int64)
+    known = device_index >= 0
+    device_busy = np.bincount(device_index[known], weights=(ends - starts)[known], minlength=len(device_ids))
+    window_length = max(window_end - window_start, 1)
+
+    # Running machines over time: +1 at each start, -1 at each end, ends first at equal times
+    times = np.concatenate([starts, ends])
+    steps = np.concatenate([np.ones(len(starts), np.int64), -np.ones(len(ends), np.int64)])
+    order = np.lexsort((steps, times))
+    times, levels = times[order], np.cumsum(steps[order])
+    # Each level holds until the next event. Take the max level touching every weekday-hour bin.
+    segment_ends = np.append(times[1:], times[-1:])
+    running = (levels > 0) & (segment_ends > times)
+    source, hours, _ = _split_into_hours(times[running], segment_ends[running])
+    peak = np.zeros(7 * 24, dtype=np.int64)
+    np.maximum.at(peak, _weekday_hour(hours, utc_offset_hours), levels[running][source])
+
+    return {
+        "device_count": len(device_ids),
+        "occupancy": np.round(heatmap, 4).reshape(7, 24).tolist(),
+        "peak_concurrency": peak.reshape(7, 24).tolist(),
+        "device_utilization": {
+            str(device_id): round(float(device_busy[i]) / window_length * 100, 2)
+            for i, device_id in enumerate(device_ids)
+        },
+    }
@@ -3,6 +3,10 @@ from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+import asyncio
+import os
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -26,6 +30,34 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+# Process pool for bulk hashing, bcrypt holds the GIL so threads don't help
+_hash_pool: Optional[ProcessPoolExecutor] = None
+
+def _hash_chunk(values: List[Optional[str]]) -> List[Optional[str]]:
+    return [get_password_hash(value) if value else None for value in values]
+
+async def get_password_hashes(values: List[Optional[str]]) -> List[Optional[str]]:
+    """Hash many secrets in parallel across the hash process pool. Empty values stay None."""
+    global _hash_pool
+    if not values:
+        return []
+    workers = settings.HASH_WORKERS or os.cpu_count() or 1
+    if _hash_pool is None:
+        _hash_pool = ProcessPoolExecutor(max_workers=workers)
+
+    # One chunk per worker keeps pickling overhead low
+    chunk_size = max(1, -(-len(values) // workers))
+    chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(loop.run_in_executor(_hash_pool, _hash_chunk, chunk) for chunk in chunks))
+    return [hashed for chunk in results for hashed in chunk]
+
+def shutdown_hash_pool():
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown()
+        _hash_pool = None
+
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
     db: AsyncSession = Depends(get_db)
@@ -0,0 +1,288 @@
+import fcntl
+import logging
+import os
+import platform
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select
+
+from ..config import DEVICES, settings
+from ..database.session import AsyncSessionLocal
+from ..models.device import Device
+
+# Identifies a segment laid out by this module, bump LAYOUT_VERSION when RECORD changes
+MAGIC = 0x57415343
+LAYOUT_VERSION = 1
+# A read that keeps racing the writer gives up and the caller reads the database
+MAX_READ_RETRIES = 100
+# The seqlock needs stores to become visible to other processes in program order, which x86
+# guarantees. numpy can't issue memory barriers, so elsewhere (e.g. ARM) the table stays off.
+ORDERED_STORE_MACHINES = {"x86_64", "amd64", "i386", "i686", "x86"}
+
+# devices is a checksum of the configured device ids, a different DEVICES gets a new segment
+HEADER = np.dtype([("magic", "<u8"), ("version", "<u8"), ("capacity", "<u8"), ("devices", "<u8")])
+# seq is the seqlock: odd while a write is in progress, 0 until the record was first written.
+# end_time is in epoch seconds, 0 for idle devices. stamp orders writes, see publish_device.
+RECORD = np.dtype([
+    ("seq", "<u8"), ("id", "<i8"), ("user_id", "<i8"), ("end_time", "<f8"), ("stamp", "<f8")
+])
+
+logger = logging.getLogger(__name__)
+# Sessions of load_device_table, which runs at startup outside of any request. Looked up on
+# every use, so tests can point it at their own database.
+session_factory = AsyncSessionLocal
+
+# Slot of each configured device, the same in every worker
+_slots = {device_id: slot for slot, device_id in enumerate(sorted(device["id"] for device in DEVICES))}
+_devices_checksum = zlib.crc32(",".join(str(device_id) for device_id in _slots).encode())
+
+
+class DeviceTable:
+    """
+    Device states in a shared memory segment that every worker on the host maps.
+
+    Readers never lock: they copy a record between two reads of its seq and retry if a write
+    was in progress or happened meanwhile. Writers take an exclusive flock on a lock file, so
+    there is only ever one writer. Writes are rare (starts, stops, expiries), reads are hot.
+
+    The segment outlives the workers, a restarted worker attaches to it again. It goes away
+    with a reboot or with close(unlink=True).
+    """
+
+    def __init__(self, name: str, capacity: int):
+        self.name = name
+        self.capacity = capacity
+        self.reads = 0
+        self.retries = 0
+        self.writes = 0
+        self.rejected = 0
+        self._lock_file = open(os.path.join(tempfile.gettempdir(), f"{name}.lock"), "a+")
+        size = HEADER.itemsize + RECORD.itemsize * max(1, capacity)
+
+        with self._writer_lock():
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+                self.created = True
+            except FileExistsError:
+                self.shm = shared_memory.SharedMemory(name=name)
+                self.created = False
+                if not self._layout_matches():
+                    # Left over from a different DEVICES or an older release
+                    logger.warning("Device table %s has another layout, recreating it", name)
+                    self.shm.close()
+                    self.shm.unlink()
+                    self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+                    self.created = True
+            # Python would unlink the segment when this process exits, while other workers still use it
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+            self.header = np.ndarray((1,), dtype=HEADER, buffer=self.shm.buf)
+            self.records = np.ndarray((capacity,), dtype=RECORD, buffer=self.shm.buf, offset=HEADER.itemsize)
+            if self.created:
+                self.records[:] = 0
+                self.header[0] = (MAGIC, LAYOUT_VERSION, capacity, _devices_checksum)
+        self._seq = self.records["seq"]
+
+    def _layout_matches(self) -> bool:
+        if self.shm.size < HEADER.itemsize:
+            return False
+        header = np.ndarray((1,), dtype=HEADER, buffer=self.shm.buf)[0]
+        return (int(header["magic"]), int(header["version"]), int(header["capacity"]), int(header["devices"])) == (
+            MAGIC, LAYOUT_VERSION, self.capacity, _devices_checksum
+        )
+
+    @contextmanager
+    def _writer_lock(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def read(self, slot: int) -> Optional[Tuple[int, int, float, float]]:
+        """(id, user_id, end_time, stamp) of the slot, None if it was never written"""
+        self.reads += 1
+        seq = self._seq
+        for _ in range(MAX_READ_RETRIES):
+            before = int(seq[slot])
+            if before == 0:
+                return None
+            if before % 2 == 0:
+                _, device_id, user_id, end_time, stamp = self.records[slot].item()
+                if int(seq[slot]) == before:
+                    return device_id, user_id, end_time, stamp
+            self.retries += 1
+        return None
+
+    def write(self, slot: int, device_id: int, user_id: int, end_time: float, stamp: float,
+              expect_end_time: Optional[float] = None) -> bool:
+        """
+        Write the slot unless it holds a newer stamp, or, with expect_end_time, unless its
+        end_time changed. Returns whether it was written.
+        """
+        with self._writer_lock():
+            record = self.records[slot]
+            if int(record["seq"]):
+                if stamp < float(record["stamp"]) or (
+                    expect_end_time is not None and float(record["end_time"]) != expect_end_time
+                ):
+                    self.rejected += 1
+                    return False
+            # Odd while the fields change, readers that saw the old seq retry. Stores become visible in
+            # program order (only x86 is supported, see ORDERED_STORE_MACHINES), so readers never see
+            # new fields with an even seq.
+            self._seq[slot] += 1
+            record["id"] = device_id
+            record["user_id"] = user_id
+            record["end_time"] = end_time
+            record["stamp"] = stamp
+            self._seq[slot] += 1
+            self.writes += 1
+            return True
+
+    def close(self, unlink: bool = False):
+        self.header = self.records = self._seq = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+        self._lock_file.close()
+
+
+_table: Optional[DeviceTable] = None
+# Columns of each device that only change with the config, loaded with the table
+_static: Dict[int, dict] = {}
+
+
+def table_stamp() -> float:
+    """
+    Order of a device change. Taken after the transaction read the device and before it
+    commits, so a change based on another one always gets a larger stamp than it, and a
+    late write of the older change is rejected. CLOCK_MONOTONIC is the same for every process.
+    """
+    return time.monotonic()
+
+def table_supported() -> bool:
+    return platform.machine().lower() in ORDERED_STORE_MACHINES
+
+def open_device_table() -> Optional[DeviceTable]:
+    global _table
+    if _table is None and settings.DEVICE_TABLE_NAME:
+        if not table_supported():
+            logger.warning("Device table disabled on %s, device reads use the database", platform.machine())
+            return None
+        _table = DeviceTable(settings.DEVICE_TABLE_NAME, len(_slots))
+    return _table
+
+def close_device_table(unlink: bool = False):
+    global _table
+    if _table is not None:
+        _table.close(unlink=unlink)
+    _table = None
+    _static.clear()
+
+async def load_device_table():
+    """
+    Map the table and fill it from the database. Every device is written, the segment may be
+    left over from before a restart or a database restore. The stamp is taken before the read,
+    so a change another worker published meanwhile has a newer stamp and is kept.
+    """
+    table = open_device_table()
+    if table is None:
+        return
+    stamp = table_stamp()
+    async with session_factory() as session:
+        result = await session.execute(select(Device))
+        devices = result.scalars().all()
+
+    static = {}
+    for device in devices:
+        static[device.id] = {"id": device.id, "name": device.name, "type": device.type,
+                             "hourly_cost": device.hourly_cost, "site": device.site}
+        slot = _slots.get(device.id)
+        if slot is not None:
+            table.write(slot, device.id, device.user_id or 0, _epoch(device.end_time), stamp)
+    _static.clear()
+    _static.update(static)
+
+def publish_device(device: Device, stamp: float):
+    """Write a started or stopped device to the table, after its transaction committed"""
+    slot = _slots.get(device.id)
+    if _table is not None and slot is not None:
+        _table.write(slot, device.id, device.user_id or 0, _epoch(device.end_time), stamp)
+
+def expire_device(device_id: int, end_time: float):
+    """Clear an expired run, unless the device was started again meanwhile"""
+    slot = _slots.get(device_id)
+    if _table is not None and slot is not None:
+        _table.write(slot, device_id, 0, 0.0, table_stamp(), expect_end_time=end_time)
+
+def read_device(device_id: int) -> Optional[Tuple[Optional[int], Optional[float]]]:
+    """
+    user_id and end_time (epoch seconds) of the device as last written, None if the table
+    can't answer and the database has to. An end_time in the past means the device is idle.
+    """
+    slot = _slots.get(device_id)
+    if _table is None or not _static or slot is None:
+        return None
+    record = _table.read(slot)
+    if record is None:
+        return None
+    _, user_id, end_time, _ = record
+    return (user_id or None), (end_time or None)
+
+def get_devices_json(device_ids: Optional[Iterable[int]] = None) -> Optional[List[dict]]:
+    """
+    Devices like Device._tojson() without a query, expired runs shown as idle. None if any
+    of them isn't in the table.
+    """
+    if _table is None or not _static:
+        return None
+    now = time.time()
+    devices = []
+    for device_id in (_static if device_ids is None else device_ids):
+        info = _static.get(device_id)
+        state = read_device(device_id)
+        if info is None or state is None:
+            return None
+        user_id, end_time = state
+        time_left = max(0.0, end_time - now) if end_time else 0
+        running = time_left > 0
+        devices.append({
+            **info,
+            "user_id": user_id if running else None,
+            "end_time": to_datetime(end_time).isoformat() if running else None,
+            "time_left": time_left
+        })
+    return devices
+
+def get_device_table_stats() -> dict:
+    if _table is None:
+        return {"enabled": bool(settings.DEVICE_TABLE_NAME) and table_supported(), "loaded": False}
+    return {
+        "enabled": True,
+        "loaded": bool(_static),
+        "name": _table.name,
+        "created_here": _table.created,
+        "capacity": _table.capacity,
+        "reads": _table.reads,
+        "read_retries": _table.retries,
+        "writes": _table.writes,
+        "rejected_writes": _table.rejected
+    }
+
+def to_datetime(end_time: float) -> datetime:
+    return datetime.fromtimestamp(end_time, timezone.utc)
+
+def _epoch(value: Optional[datetime]) -> float:
+    if value is None:
+        return 0.0
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
@@ -1,12 +1,28 @@
-from functools import wraps
-from datetime import datetime, timezone, timedelta
+import asyncio
+import hashlib
+import hmac
 import json
-from sqlalchemy import select
-from fastapi import Depends, Header, HTTPException
-from typing import Optional, Callable, Any
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import Header, HTTPException, status
+from sqlalchemy import case, delete, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..database.session import get_db
+from ..config import settings
+from ..database.session import AsyncSessionLocal
 from ..models.idempotency import IdempotencyKey
+from .ledger import to_utc_naive
+
+# Response of a key whose first request is still running. Other workers wait until it is replaced.
+PENDING = ""
+
+logger = logging.getLogger(__name__)
+_sweep_stats = {"runs": 0, "deleted": 0, "last_run": None, "last_duration_ms": None}
 
 def datetime_handler(obj):
     if isinstance(obj, datetime):
@@ -23,48 +39,297 @@ async def check_idempotency_key(
         )
     return idempotency_key
 
-def idempotent_operation(ttl_hours: int = 24):
-    def decorator(func: Callable[..., Any]):
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
-            idempotency_key = kwargs.get('idempotency_key')
-            if not idempotency_key:
-                return await func(*args, **kwargs)
-            
-            # Get database session using dependency
-            db_generator = get_db()
-            session = await anext(db_generator)
-            
+def request_fingerprint(user_id: int, **params) -> str:
+    """
+    Identifies the caller and the arguments of a request, a key reused with another fingerprint
+    is rejected. Keyed with SECRET_KEY, the body may hold a PIN.
+    """
+    payload = json.dumps({"user_id": user_id, "params": params}, sort_keys=True, default=datetime_handler)
+    return hmac.new(settings.SECRET_KEY.encode(), payload.encode(), hashlib.sha256).hexdigest()
+
+
+class IdempotencyCache:
+    """
+    Stored responses of recently used idempotency keys, so retries are answered without a
+    database round trip. Entries are kept in least-recently-used order, like the login buckets.
+    """
+
+    def __init__(self, max_keys: int, ttl_seconds: float):
+        self.max_keys = max_keys
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[str, str, dict, float]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Tuple[str, str, dict]]:
+        entry = self._entries.get(key)
+        if entry is None or entry[3] <= time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0], entry[1], entry[2]
+
+    def put(self, key: str, endpoint: str, fingerprint: str, response: dict, expires_at: datetime):
+        # Never keep an entry past the key's own expiry
+        seconds_left = (to_utc_naive(expires_at) - to_utc_naive(datetime.now(timezone.utc))).total_seconds()
+        ttl = min(self.ttl_seconds, seconds_left)
+        if ttl <= 0:
+            return
+        self._entries[key] = (endpoint, fingerprint, response, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        return {"cached_keys": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+idempotency_cache = IdempotencyCache(settings.IDEMPOTENCY_CACHE_SIZE, settings.IDEMPOTENCY_CACHE_TTL_SECONDS)
+# Requests of this worker currently executing, by idempotency key
+_inflight: Dict[str, Tuple[str, str, asyncio.Future]] = {}
+
+def _utcnow() -> datetime:
+    return to_utc_naive(datetime.now(timezone.utc))
+
+def _check_request(stored_endpoint: str, stored_fingerprint: str, endpoint: str, fingerprint: str):
+    if stored_endpoint != endpoint or not hmac.compare_digest(stored_fingerprint, fingerprint):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Idempotency key was already used for a different request"
+        )
+
+async def get_stored_response(session: AsyncSession, idempotency_key: Optional[str], endpoint: str,
+                              fingerprint: str) -> Optional[dict]:
+    """
+    Response of an earlier request with the same key, or None if the request has to be processed.
+    The earlier request must have come from the same endpoint and request_fingerprint.
+    """
+    if not idempotency_key:
+        return None
+
+    cached = idempotency_cache.get(idempotency_key)
+    if cached is not None:
+        _check_request(cached[0], cached[1], endpoint, fingerprint)
+        return cached[2]
+
+    result = await session.execute(select(IdempotencyKey).where(IdempotencyKey.key == idempotency_key))
+    record = result.scalars().first()
+    if not record or record.response == PENDING or to_utc_naive(record.expires_at) <= _utcnow():
+        return None
+    _check_request(record.endpoint, record.fingerprint, endpoint, fingerprint)
+    response = json.loads(record.response)
+    idempotency_cache.put(idempotency_key, endpoint, fingerprint, response, record.expires_at)
+    return response
+
+async def commit_idempotent(session: AsyncSession, idempotency_key: Optional[str], endpoint: str,
+                            fingerprint: str, response: dict) -> dict:
+    """
+    Commit the session together with the response stored under idempotency_key, so the
+    operation and its key are saved atomically. If a concurrent request with the same key
+    committed first, this transaction is rolled back and that request's response is returned.
+    """
+    if not idempotency_key:
+        await session.commit()
+        return response
+
+    expires_at = datetime.now(timezone.utc) + timedelta(hours=settings.IDEMPOTENCY_TTL_HOURS)
+    # merge() replaces an expired record with the same key
+    await session.merge(IdempotencyKey(
+        key=idempotency_key,
+        endpoint=endpoint,
+        fingerprint=fingerprint,
+        response=json.dumps(response, default=datetime_handler),
+        expires_at=to_utc_naive(expires_at)
+    ))
+    try:
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        stored = await get_stored_response(session, idempotency_key, endpoint, fingerprint)
+        if stored is None:
+            raise
+        return stored
+
+    idempotency_cache.put(idempotency_key, endpoint, fingerprint,
+                          json.loads(json.dumps(response, default=datetime_handler)), expires_at)
+    return response
+
+async def run_idempotent(session: AsyncSession, idempotency_key: Optional[str], endpoint: str, fingerprint: str,
+                         operation: Callable[[], Awaitable[dict]]) -> dict:
+    """
+    Run operation at most once per idempotency key. operation has to finish with commit_idempotent.
+    Retries of a finished request get its stored response. Duplicates arriving while the first
+    request is still running wait for it instead of running again: on this worker through a
+    shared future, across workers through a pending marker row in idempotency_keys. A key reused
+    with another endpoint or fingerprint gets 422, so callers check permissions before calling this.
+    """
+    if not idempotency_key:
+        return await operation()
+
+    stored = await get_stored_response(session, idempotency_key, endpoint, fingerprint)
+    if stored is not None:
+        return stored
+
+    inflight = _inflight.get(idempotency_key)
+    if inflight is not None:
+        _check_request(inflight[0], inflight[1], endpoint, fingerprint)
+        # shield: a waiter that disconnects must not cancel the request it is waiting for
+        return await asyncio.shield(inflight[2])
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[idempotency_key] = (endpoint, fingerprint, future)
+    try:
+        stored = await _claim(session, idempotency_key, endpoint, fingerprint)
+        if stored is not None:
+            result = stored
+        else:
             try:
-                result = await session.execute(
-                    select(IdempotencyKey).where(IdempotencyKey.key == idempotency_key)
-                )
-                existing_key = result.scalars().first()
-                
-                if existing_key:
-                    if existing_key.expires_at < datetime.now(timezone.utc):
-                        await session.delete(existing_key)
-                        await session.commit()
-                    else:
-                        return json.loads(existing_key.response)
-                
-                response = await func(*args, **kwargs)
-                
-                idempotency_record = IdempotencyKey(
-                    key=idempotency_key,
-                    endpoint=func.__name__,
-                    response=json.dumps(response, default=datetime_handler),
-                    expires_at=datetime.now(timezone.utc) + timedelta(hours=ttl_hours)
+                result = await operation()
+            except BaseException:
+                await _release(session, idempotency_key)
+                raise
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(e)
+            future.exception()  # waiters re-raise it, don't warn when there are none
+        raise
+    finally:
+        del _inflight[idempotency_key]
+
+async def _claim(session: AsyncSession, idempotency_key: str, endpoint: str, fingerprint: str) -> Optional[dict]:
+    """
+    Insert the pending marker for the key. Returns None once this request owns the key, or the
+    response of another worker's request with the same key after waiting for it to finish.
+    """
+    # The marker has to be visible to other workers before the operation runs, so it is committed
+    # on its own. A separate session keeps rollbacks here from expiring the request's objects.
+    await session.commit()
+    async with AsyncSession(session.bind, expire_on_commit=False) as marker_session:
+        deadline = time.monotonic() + settings.IDEMPOTENCY_PENDING_SECONDS
+        delay = 0.05
+        while True:
+            pending_until = _utcnow() + timedelta(seconds=settings.IDEMPOTENCY_PENDING_SECONDS)
+            marker_session.add(IdempotencyKey(
+                key=idempotency_key, endpoint=endpoint, fingerprint=fingerprint, response=PENDING,
+                expires_at=pending_until
+            ))
+            try:
+                await marker_session.commit()
+                return None
+            except IntegrityError:
+                await marker_session.rollback()
+
+            result = await marker_session.execute(select(IdempotencyKey).where(IdempotencyKey.key == idempotency_key))
+            record = result.scalars().first()
+            if record is not None:
+                if to_utc_naive(record.expires_at) <= _utcnow():
+                    # Expired response, or a marker left behind by a worker that died: take the key over
+                    result = await marker_session.execute(
+                        update(IdempotencyKey)
+                        .where(IdempotencyKey.key == idempotency_key, IdempotencyKey.expires_at == record.expires_at)
+                        .values(endpoint=endpoint, fingerprint=fingerprint, response=PENDING, expires_at=pending_until)
+                        .execution_options(synchronize_session=False)
+                    )
+                    await marker_session.commit()
+                    if result.rowcount == 1:
+                        return None
+                elif record.response != PENDING:
+                    _check_request(record.endpoint, record.fingerprint, endpoint, fingerprint)
+                    response = json.loads(record.response)
+                    idempotency_cache.put(idempotency_key, endpoint, fingerprint, response, record.expires_at)
+                    return response
+                else:
+                    _check_request(record.endpoint, record.fingerprint, endpoint, fingerprint)
+
+            if time.monotonic() >= deadline:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail="A request with this idempotency key is still being processed"
                 )
-                session.add(idempotency_record)
-                await session.commit()
-                
-                return response
-            finally:
-                # Close the session
-                try:
-                    await db_generator.asend(None)
-                except StopAsyncIteration:
-                    pass
-        return wrapper
-    return decorator
+            # End the transaction so the next look sees the other worker's commit
+            await marker_session.rollback()
+            marker_session.expunge_all()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+async def _release(session: AsyncSession, idempotency_key: str):
+    """Remove the pending marker of a failed request, so a retry can run it again"""
+    await session.rollback()
+    await session.execute(
+        delete(IdempotencyKey).where(IdempotencyKey.key == idempotency_key, IdempotencyKey.response == PENDING)
+    )
+    await session.commit()
+
+async def sweep_expired_keys(session: AsyncSession) -> int:
+    """
+    Delete expired keys in batches of IDEMPOTENCY_SWEEP_BATCH_SIZE, committing and pausing
+    between batches so no delete holds locks for long. Returns the number of deleted keys.
+    """
+    started = time.perf_counter()
+    deleted = 0
+    while True:
+        # Select first, MySQL can't delete with a LIMIT subquery on the same table
+        result = await session.execute(
+            select(IdempotencyKey.key)
+            .where(IdempotencyKey.expires_at <= _utcnow())
+            .limit(settings.IDEMPOTENCY_SWEEP_BATCH_SIZE)
+        )
+        keys = result.scalars().all()
+        if keys:
+            # Re-check the expiry, a key may have been taken over since it was selected
+            result = await session.execute(
+                delete(IdempotencyKey)
+                .where(IdempotencyKey.key.in_(keys), IdempotencyKey.expires_at <= _utcnow())
+                .execution_options(synchronize_session=False)
+            )
+            deleted += result.rowcount
+        await session.commit()
+        if len(keys) < settings.IDEMPOTENCY_SWEEP_BATCH_SIZE:
+            break
+        await asyncio.sleep(settings.IDEMPOTENCY_SWEEP_PAUSE_MS / 1000)
+
+    _sweep_stats["runs"] += 1
+    _sweep_stats["deleted"] += deleted
+    _sweep_stats["last_run"] = datetime.now(timezone.utc).isoformat()
+    _sweep_stats["last_duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return deleted
+
+async def run_idempotency_sweeper():
+    """Sweep expired idempotency keys every IDEMPOTENCY_SWEEP_INTERVAL_SECONDS until cancelled"""
+    while True:
+        await asyncio.sleep(settings.IDEMPOTENCY_SWEEP_INTERVAL_SECONDS)
+        try:
+            async with AsyncSessionLocal() as session:
+                await sweep_expired_keys(session)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Sweeping expired idempotency keys failed")
+
+async def get_idempotency_stats(session: AsyncSession) -> dict:
+    # SUM(CASE ...) instead of COUNT(*) FILTER (...), which MySQL and MariaDB don't support
+    result = await session.execute(
+        select(
+            func.count(),
+            func.sum(case((IdempotencyKey.expires_at <= _utcnow(), 1), else_=0)),
+            func.sum(case((IdempotencyKey.response == PENDING, 1), else_=0))
+        ).select_from(IdempotencyKey)
+    )
+    total, expired, pending = result.one()
+    return {
+        # SUM over no rows is NULL
+        "table": {"keys": total, "expired": int(expired or 0), "pending": int(pending or 0)},
+        "sweeper": dict(_sweep_stats),
+        "cache": idempotency_cache.stats(),
+        "inflight": len(_inflight)
+    }
@@ -1,19 +1,79 @@
-from sqlalchemy import select
+import hashlib
+import logging
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine
 
 from ..database.session import get_db
+from ..models.base import Base
 from ..models.user import User
-from ..models.device import Device
+from ..models.device import Device, DEFAULT_SITE
+from ..models.schema_version import SchemaVersion
 from ..core.auth import get_password_hash
 from ..config import DEVICES
 
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def startup_phase(name: str):
+    """Log how long a startup phase took"""
+    started = time.perf_counter()
+    yield
+    logger.info("Startup: %s took %.1f ms", name, (time.perf_counter() - started) * 1000)
+
+def schema_fingerprint() -> str:
+    """Hash of every table, column and index of the models, changes whenever the models do"""
+    parts = []
+    for table in sorted(Base.metadata.tables.values(), key=lambda table: table.name):
+        parts.append(table.name)
+        for column in table.columns:
+            parts.append(f"{column.name}:{column.type}:{column.nullable}:{column.primary_key}")
+        for index in sorted(table.indexes, key=lambda index: index.name or ""):
+            parts.append(f"{index.name}:{index.unique}:{','.join(column.name for column in index.columns)}")
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+async def ensure_schema(engine: AsyncEngine) -> bool:
+    """
+    Create missing tables and indexes, unless the stored fingerprint shows the schema is
+    already current. Returns whether the DDL ran.
+    """
+    fingerprint = schema_fingerprint()
+    try:
+        async with engine.connect() as conn:
+            result = await conn.execute(select(SchemaVersion.fingerprint).where(SchemaVersion.id == 1))
+            if result.scalar() == fingerprint:
+                return False
+    except DBAPIError:
+        # First boot, schema_version doesn't exist yet
+        pass
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    # Several workers may get here at once. On first boot they can all find no row and insert it,
+    # the losers get an IntegrityError. The winner stored the same fingerprint, so that's fine.
+    try:
+        async with engine.begin() as conn:
+            result = await conn.execute(
+                update(SchemaVersion).where(SchemaVersion.id == 1).values(fingerprint=fingerprint)
+            )
+            if result.rowcount == 0:
+                await conn.execute(insert(SchemaVersion).values(id=1, fingerprint=fingerprint))
+    except IntegrityError:
+        logger.info("Startup: schema version was stored by another worker")
+    return True
+
 async def initialize_database():
     db_generator = get_db()
     session = await anext(db_generator)
-    
+
     try:
         # Create initial admin user if no users exist
-        result = await session.execute(select(User))
-        if not result.scalars().first():
+        result = await session.execute(select(User.uid).limit(1))
+        if result.first() is None:
             admin_user = User(
                 name="admin",
                 cash=0,
@@ -21,38 +81,42 @@ async def initialize_database():
                 is_admin=True
             )
             session.add(admin_user)
-        
-        # Initialize or update devices from config
-        for device_config in DEVICES:
-            result = await session.execute(
-                select(Device).where(Device.id == device_config["id"])
+
+        # Reconcile devices with the config in bulk: one read, then only the rows that differ are written
+        result = await session.execute(select(Device.id, Device.name, Device.type, Device.hourly_cost, Device.site))
+        existing = {row.id: (row.name, row.type, row.hourly_cost, row.site) for row in result}
+        configured = {
+            device_config["id"]: (
+                device_config["name"], device_config["type"], device_config["hourly_cost"],
+                device_config.get("site", DEFAULT_SITE)
             )
-            device = result.scalars().first()
-            
-            if not device:
-                device = Device(
-                    id=device_config["id"],
-                    name=device_config["name"],
-                    type=device_config["type"],
-                    hourly_cost=device_config["hourly_cost"]
-                )
-                session.add(device)
-            else:
-                # Update existing device with current config values
-                device.name = device_config["name"]
-                device.type = device_config["type"]
-                device.hourly_cost = device_config["hourly_cost"]
-        
-        # Remove devices that are no longer in config
-        result = await session.execute(select(Device))
-        existing_devices = result.scalars().all()
-        config_device_ids = [d["id"] for d in DEVICES]
-        
-        for device in existing_devices:
-            if device.id not in config_device_ids:
-                await session.delete(device)
-        
+            for device_config in DEVICES
+        }
+
+        new_devices = [
+            {"id": device_id, "name": name, "type": device_type, "hourly_cost": hourly_cost, "site": site}
+            for device_id, (name, device_type, hourly_cost, site) in configured.items() if device_id not in existing
+        ]
+        changed_devices = [
+            {"id": device_id, "name": name, "type": device_type, "hourly_cost": hourly_cost, "site": site}
+            for device_id, (name, device_type, hourly_cost, site) in configured.items()
+            if device_id in existing and existing[device_id] != (name, device_type, hourly_cost, site)
+        ]
+        removed_ids = [device_id for device_id in existing if device_id not in configured]
+
+        if new_devices:
+            await session.execute(insert(Device), new_devices)
+        if changed_devices:
+            # Bulk UPDATE by primary key
+            await session.execute(update(Device), changed_devices)
+        if removed_ids:
+            await session.execute(delete(Device).where(Device.id.in_(removed_ids)))
+
         await session.commit()
+        logger.info(
+            "Devices reconciled with config: %d added, %d updated, %d removed",
+            len(new_devices), len(changed_devices), len(removed_ids)
+        )
     finally:
         # Close the session
         try:
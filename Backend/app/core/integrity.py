@@ -0,0 +1,243 @@
+import asyncio
+import hashlib
+import logging
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from ..database.session import AsyncSessionLocal
+from ..models.ledger import LedgerCheckpoint, LedgerEntry, LedgerMerkleNode
+from .ledger import to_utc_naive
+
+# prev hash of the first entry in the chain
+GENESIS_HASH = "0" * 64
+# Keys per node lookup, keeps the IN lists within every database's limits
+NODE_FETCH_CHUNK = 500
+
+logger = logging.getLogger(__name__)
+_seal_lock = asyncio.Lock()
+
+NodeKey = Tuple[int, int]
+
+
+def _entry_payload(entry: LedgerEntry) -> bytes:
+    """Canonical form of the fields covered by the hash. Only uses what survives a database round trip."""
+    timestamp = to_utc_naive(entry.timestamp).isoformat(timespec="seconds")
+    fields = [
+        entry.id, entry.user_id, entry.device_id, entry.kind,
+        format(Decimal(str(entry.amount)), ".2f"), format(Decimal(str(entry.balance_after)), ".2f"),
+        entry.actor_id, timestamp, entry.request_id
+    ]
+    return "|".join("" if field is None else str(field) for field in fields).encode()
+
+def hash_entry(prev_hash: str, entry: LedgerEntry) -> str:
+    """Chained entry hash, also the entry's leaf in the Merkle tree (RFC 6962 leaf prefix 0x00)"""
+    return hashlib.sha256(b"\x00" + bytes.fromhex(prev_hash) + _entry_payload(entry)).hexdigest()
+
+def hash_children(left: str, right: str) -> str:
+    return hashlib.sha256(b"\x01" + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+def _pieces(start: int, size: int) -> List[NodeKey]:
+    """Complete nodes making up the leaves [start, start + size), left to right"""
+    pieces = []
+    for level in reversed(range(size.bit_length())):
+        if size >> level & 1:
+            pieces.append((level, start >> level))
+            start += 1 << level
+    return pieces
+
+def _fold(hashes: List[str]) -> str:
+    # Right to left, so an incomplete tree hashes like RFC 6962 (left subtree always the largest power of two)
+    root = hashes[-1]
+    for left in reversed(hashes[:-1]):
+        root = hash_children(left, root)
+    return root
+
+def _audit_path(leaf: int, tree_size: int) -> List[Tuple[int, int, bool]]:
+    """Sibling subtrees from the leaf up to the root, as (start, size, sibling is on the right)"""
+    path = []
+    start, size = 0, tree_size
+    while size > 1:
+        split = 1 << ((size - 1).bit_length() - 1)  # largest power of two below size
+        if leaf < start + split:
+            path.append((start + split, size - split, True))
+            size = split
+        else:
+            path.append((start, split, False))
+            start += split
+            size -= split
+    return path[::-1]
+
+def root_from_path(leaf_hash: str, path: List[dict]) -> str:
+    """Recompute the root from a leaf and the sibling hashes of its audit path"""
+    root = leaf_hash
+    for sibling in path:
+        if sibling["right"]:
+            root = hash_children(root, sibling["hash"])
+        else:
+            root = hash_children(sibling["hash"], root)
+    return root
+
+async def _load_nodes(session: AsyncSession, keys: Iterable[NodeKey], known: Dict[NodeKey, str]):
+    """Fetch the nodes not already in known into it, with as few queries as possible"""
+    missing = sorted(set(keys) - known.keys())
+    for i in range(0, len(missing), NODE_FETCH_CHUNK):
+        by_level: Dict[int, List[int]] = {}
+        for level, idx in missing[i:i + NODE_FETCH_CHUNK]:
+            by_level.setdefault(level, []).append(idx)
+        result = await session.execute(
+            select(LedgerMerkleNode).where(or_(*(
+                and_(LedgerMerkleNode.level == level, LedgerMerkleNode.idx.in_(idxs))
+                for level, idxs in by_level.items()
+            )))
+        )
+        for node in result.scalars():
+            known[(node.level, node.idx)] = node.hash
+
+async def get_latest_checkpoint(session: AsyncSession) -> Optional[LedgerCheckpoint]:
+    result = await session.execute(select(LedgerCheckpoint).order_by(LedgerCheckpoint.tree_size.desc()).limit(1))
+    return result.scalars().first()
+
+async def seal_ledger(session: AsyncSession, max_entries: Optional[int] = None) -> Optional[LedgerCheckpoint]:
+    """
+    Chain the hashes of entries that aren't sealed yet, add the Merkle nodes they complete and
+    write a checkpoint with the new root. Everything is committed in one transaction, so the
+    latest checkpoint's tree_size is always the number of sealed entries.
+    Returns the new checkpoint, or None if there was nothing to seal.
+    """
+    async with _seal_lock:
+        latest = await get_latest_checkpoint(session)
+        sealed = latest.tree_size if latest else 0
+
+        result = await session.execute(
+            select(LedgerEntry)
+            .where(LedgerEntry.seq.is_(None))
+            .order_by(LedgerEntry.id)
+            .limit(max_entries or settings.LEDGER_SEAL_BATCH_SIZE)
+        )
+        pending = result.scalars().all()
+        if not pending:
+            return None
+
+        # Nodes of the current tree that new nodes will be built on
+        known: Dict[NodeKey, str] = {}
+        await _load_nodes(session, _pieces(0, sealed) + ([(0, sealed - 1)] if sealed else []), known)
+        prev_hash = known[(0, sealed - 1)] if sealed else GENESIS_HASH
+
+        new_nodes: Dict[NodeKey, str] = {}
+        for seq, entry in enumerate(pending, start=sealed):
+            prev_hash = hash_entry(prev_hash, entry)
+            entry.seq = seq
+            entry.entry_hash = prev_hash
+            new_nodes[(0, seq)] = prev_hash
+        known.update(new_nodes)
+
+        tree_size = sealed + len(pending)
+        for level in range(1, tree_size.bit_length()):
+            for idx in range(sealed >> level, tree_size >> level):
+                node = hash_children(known[(level - 1, 2 * idx)], known[(level - 1, 2 * idx + 1)])
+                known[(level, idx)] = new_nodes[(level, idx)] = node
+
+        roots = _pieces(0, tree_size)
+        await _load_nodes(session, roots, known)
+        checkpoint = LedgerCheckpoint(
+            tree_size=tree_size,
+            last_entry_id=pending[-1].id,
+            root_hash=_fold([known[key] for key in roots])
+        )
+        session.add_all(LedgerMerkleNode(level=level, idx=idx, hash=node) for (level, idx), node in new_nodes.items())
+        session.add(checkpoint)
+        await session.commit()
+        return checkpoint
+
+def _path_keys(leaf: int, tree_size: int) -> List[NodeKey]:
+    return [key for start, size, _ in _audit_path(leaf, tree_size) for key in _pieces(start, size)]
+
+def _build_path(leaf: int, tree_size: int, known: Dict[NodeKey, str]) -> Optional[List[dict]]:
+    """Audit path hashes, or None if a node is missing (which only happens when the tree was tampered with)"""
+    path = []
+    for start, size, right in _audit_path(leaf, tree_size):
+        hashes = [known.get(key) for key in _pieces(start, size)]
+        if None in hashes:
+            return None
+        path.append({"hash": _fold(hashes), "right": right})
+    return path
+
+async def get_inclusion_proof(session: AsyncSession, entry: LedgerEntry, checkpoint: LedgerCheckpoint) -> dict:
+    """Audit path proving a sealed entry is part of the checkpoint's tree, for verifying it offline"""
+    known: Dict[NodeKey, str] = {}
+    prev_key = [(0, entry.seq - 1)] if entry.seq else []
+    await _load_nodes(session, _path_keys(entry.seq, checkpoint.tree_size) + prev_key, known)
+    prev_hash = known.get((0, entry.seq - 1)) if entry.seq else GENESIS_HASH
+    path = _build_path(entry.seq, checkpoint.tree_size, known)
+    leaf_hash = hash_entry(prev_hash, entry) if prev_hash else None
+    return {
+        "entry_id": entry.id,
+        "seq": entry.seq,
+        "prev_hash": prev_hash,
+        "entry_hash": leaf_hash,
+        "tree_size": checkpoint.tree_size,
+        "root_hash": checkpoint.root_hash,
+        "path": path,
+        "valid": (
+            leaf_hash is not None and path is not None and leaf_hash == entry.entry_hash
+            and root_from_path(leaf_hash, path) == checkpoint.root_hash
+        )
+    }
+
+async def verify_entries(session: AsyncSession, entries: List[LedgerEntry], checkpoint: LedgerCheckpoint,
+                         contiguous: bool = False) -> List[dict]:
+    """
+    Check sealed entries against a checkpoint. Consecutive entries are checked by rehashing the
+    chain and proving only the last one of each run, so a range costs one hash per entry plus
+    one O(log n) audit path. With contiguous, missing sequence numbers are reported as well.
+    Returns the failures, empty if everything checks out.
+    """
+    entries = sorted((entry for entry in entries if entry.seq is not None), key=lambda entry: entry.seq)
+    failures = []
+    runs: List[List[LedgerEntry]] = []
+    for entry in entries:
+        if entry.seq >= checkpoint.tree_size:
+            continue
+        if runs and entry.seq == runs[-1][-1].seq + 1:
+            runs[-1].append(entry)
+            continue
+        if contiguous and runs:
+            for seq in range(runs[-1][-1].seq + 1, entry.seq):
+                failures.append({"seq": seq, "entry_id": None, "reason": "Entry missing"})
+        runs.append([entry])
+
+    keys = []
+    for run in runs:
+        if run[0].seq:
+            keys.append((0, run[0].seq - 1))
+        keys.extend(_path_keys(run[-1].seq, checkpoint.tree_size))
+    known: Dict[NodeKey, str] = {}
+    await _load_nodes(session, keys, known)
+
+    for run in runs:
+        prev_hash = known.get((0, run[0].seq - 1), "") if run[0].seq else GENESIS_HASH
+        for entry in run:
+            if not prev_hash or hash_entry(prev_hash, entry) != entry.entry_hash:
+                failures.append({"seq": entry.seq, "entry_id": entry.id, "reason": "Hash chain broken"})
+            prev_hash = entry.entry_hash
+        path = _build_path(run[-1].seq, checkpoint.tree_size, known)
+        if path is None or root_from_path(run[-1].entry_hash, path) != checkpoint.root_hash:
+            failures.append({"seq": run[-1].seq, "entry_id": run[-1].id, "reason": "Not in checkpoint"})
+    return failures
+
+async def run_ledger_sealer():
+    """Seal new ledger entries every LEDGER_SEAL_INTERVAL_SECONDS until cancelled"""
+    while True:
+        await asyncio.sleep(settings.LEDGER_SEAL_INTERVAL_SECONDS)
+        try:
+            async with AsyncSessionLocal() as session:
+                while await seal_ledger(session):
+                    pass
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Sealing the ledger failed")
@@ -0,0 +1,49 @@
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+from fastapi import Header
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..models.ledger import LedgerEntry
+from ..models.user import User
+
+async def get_request_id(
+    request_id: Optional[str] = Header(None, alias="X-Request-ID")
+) -> str:
+    """Use the client's X-Request-ID if it sent a usable one, otherwise generate one"""
+    if request_id and len(request_id) <= 64:
+        return request_id
+    return uuid.uuid4().hex
+
+def to_utc_naive(value: datetime) -> datetime:
+    """Timestamps are stored as naive UTC, convert aware datetimes before comparing"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def record_movement(
+    session: AsyncSession,
+    user: User,
+    kind: str,
+    old_balance: float,
+    new_balance: float,
+    device_id: Optional[int] = None,
+    actor_id: Optional[int] = None,
+    request_id: Optional[str] = None
+) -> LedgerEntry:
+    """
+    Add a ledger entry for a balance change to the session. It is committed together
+    with the balance change itself, so the ledger and User.cash can't diverge.
+    """
+    entry = LedgerEntry(
+        user_id=user.uid,
+        device_id=device_id,
+        kind=kind,
+        amount=round(new_balance - old_balance, 2),
+        balance_after=new_balance,
+        actor_id=actor_id,
+        timestamp=datetime.now(timezone.utc),
+        request_id=request_id
+    )
+    session.add(entry)
+    return entry
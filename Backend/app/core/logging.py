@@ -1,5 +1,19 @@
+import atexit
+import gzip
+import json
 import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from enum import IntEnum
+from logging.handlers import QueueHandler
+from typing import List, Optional
+
+from ..config import settings
 
 # Custom log level for money transactions
 class CustomLogLevels(IntEnum):
@@ -23,21 +37,281 @@ def get_transaction_logger():
     
     return transaction_logger
 
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks the caller. Records are dropped and counted when the queue is full."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class BatchedFileHandler(logging.FileHandler):
+    """
+    FileHandler that doesn't flush after every record. The log writer calls sync() after
+    each batch, which flushes and fsyncs once enough records or time have accumulated.
+    """
+
+    def __init__(self, filename: str, fsync_records: int = 0, fsync_ms: int = 0):
+        super().__init__(filename)
+        self.fsync_records = fsync_records
+        self.fsync_ms = fsync_ms
+        self.fsyncs = 0
+        self._unsynced = 0
+        self._last_fsync = time.monotonic()
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            self._unsynced += 1
+        except Exception:
+            self.handleError(record)
+
+    def sync(self, force: bool = False):
+        if self.stream is None:
+            return
+        self.flush()
+        if not self._unsynced:
+            return
+
+        due = force
+        if self.fsync_records and self._unsynced >= self.fsync_records:
+            due = True
+        if self.fsync_ms and (time.monotonic() - self._last_fsync) * 1000 >= self.fsync_ms:
+            due = True
+        if due:
+            os.fsync(self.stream.fileno())
+            self.fsyncs += 1
+            self._unsynced = 0
+            self._last_fsync = time.monotonic()
+
+class RotatingBatchedFileHandler(BatchedFileHandler):
+    """
+    BatchedFileHandler that starts a new segment when the file grows past max_bytes or a
+    new day begins. Closed segments are renamed after their first record's time, compressed
+    in the background and listed with their time range in a manifest next to the log.
+    """
+
+    def __init__(self, filename: str, max_bytes: int = 0, rotate_daily: bool = False, compress: bool = False,
+                 fsync_records: int = 0, fsync_ms: int = 0):
+        super().__init__(filename, fsync_records=fsync_records, fsync_ms=fsync_ms)
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.compress = compress
+        self.manifest_path = self.baseFilename + ".manifest.json"
+        self._manifest_lock = threading.Lock()
+        self._compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-compress") if compress else None
+        self._first, self._last = self._read_time_range()
+        self._records = 0
+
+    def _read_time_range(self):
+        # Continue an existing log file: its first and last lines start with the asctime
+        try:
+            with open(self.baseFilename, "rb") as f:
+                first_line = f.readline()
+                f.seek(max(0, os.fstat(f.fileno()).st_size - 4096))
+                last_line = f.read().rstrip(b"\n").rsplit(b"\n", 1)[-1]
+            return [datetime.strptime(line[:19].decode(), "%Y-%m-%d %H:%M:%S") for line in (first_line, last_line)]
+        except (OSError, ValueError, UnicodeDecodeError):
+            return None, None
+
+    def emit(self, record):
+        created = datetime.fromtimestamp(record.created)
+        if self._should_rotate(created):
+            self.rotate()
+        if self._first is None:
+            self._first = created
+        self._last = created
+        self._records += 1
+        super().emit(record)
+
+    def _should_rotate(self, created: datetime) -> bool:
+        if self._first is None or self.stream is None:
+            return False
+        if self.rotate_daily and created.date() != self._first.date():
+            return True
+        return bool(self.max_bytes) and self.stream.tell() >= self.max_bytes
+
+    def rotate(self):
+        self.sync(force=True)
+        self.stream.close()
+        self.stream = None
+
+        segment_path = f"{self.baseFilename}.{self._first:%Y%m%d-%H%M%S}"
+        suffix = 1
+        while os.path.exists(segment_path) or os.path.exists(segment_path + ".gz"):
+            segment_path = f"{self.baseFilename}.{self._first:%Y%m%d-%H%M%S}-{suffix}"
+            suffix += 1
+        os.rename(self.baseFilename, segment_path)
+
+        self._add_to_manifest({
+            "path": os.path.basename(segment_path),
+            "first": self._first.isoformat(timespec="seconds"),
+            "last": self._last.isoformat(timespec="seconds"),
+            "records": self._records
+        })
+        self._first = self._last = None
+        self._records = 0
+        self.stream = self._open()
+
+        if self._compressor:
+            self._compressor.submit(self._compress_segment, segment_path)
+
+    def _compress_segment(self, segment_path: str):
+        with open(segment_path, "rb") as src, gzip.open(segment_path + ".gz.tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(segment_path + ".gz.tmp", segment_path + ".gz")
+        name = os.path.basename(segment_path)
+        with self._manifest_lock:
+            manifest = self.read_manifest()
+            for segment in manifest["segments"]:
+                if segment["path"] == name:
+                    segment["path"] = name + ".gz"
+            self._write_manifest(manifest)
+        os.remove(segment_path)
+
+    def read_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"segments": []}
+
+    def _write_manifest(self, manifest: dict):
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    def _add_to_manifest(self, segment: dict):
+        with self._manifest_lock:
+            manifest = self.read_manifest()
+            manifest["segments"].append(segment)
+            self._write_manifest(manifest)
+
+    def close(self):
+        super().close()
+        if self._compressor:
+            # Let running compressions finish so no half written .gz files are left behind
+            self._compressor.shutdown(wait=True)
+
+def read_segment_manifest(log_path: str) -> list:
+    """Closed segments of a rotated log with their time ranges, oldest first"""
+    try:
+        with open(log_path + ".manifest.json") as f:
+            return json.load(f)["segments"]
+    except (OSError, ValueError, KeyError):
+        return []
+
+class LogWriter(threading.Thread):
+    """Background thread that drains the log queue in batches and writes them to the real handlers"""
+
+    def __init__(self, log_queue: queue.Queue, handlers: List[logging.Handler], batch_size: int = 256):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = log_queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.written = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not (self._stop_event.is_set() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except queue.Empty:
+                self._sync()
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for record in batch:
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            self.written += len(batch)
+            self._sync()
+        self._sync(force=True)
+
+    def _sync(self, force: bool = False):
+        for handler in self.handlers:
+            if isinstance(handler, BatchedFileHandler):
+                handler.sync(force)
+            else:
+                handler.flush()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+_queue_handler: Optional[DroppingQueueHandler] = None
+_writer: Optional[LogWriter] = None
+
 def setup_logging():
     """Configure logging for the application"""
-    # Configure root logger
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    global _queue_handler, _writer
+    if _writer is not None:
+        return
+
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+
+    # Transaction log file, only records of the transaction logger go here
+    transaction_handler = RotatingBatchedFileHandler(
+        settings.TRANSACTION_LOG_PATH,
+        max_bytes=settings.TRANSACTION_LOG_MAX_BYTES,
+        rotate_daily=settings.TRANSACTION_LOG_ROTATE_DAILY,
+        compress=settings.TRANSACTION_LOG_COMPRESS,
+        fsync_records=settings.TRANSACTION_LOG_FSYNC_RECORDS,
+        fsync_ms=settings.TRANSACTION_LOG_FSYNC_MS
     )
-    
-    # Configure transaction logger with file handler
-    transaction_handler = logging.FileHandler("transactions.log")
     transaction_handler.setLevel(CustomLogLevels.TRANSACTION)
+    transaction_handler.addFilter(logging.Filter("transaction"))
     transaction_handler.setFormatter(logging.Formatter(
         '%(asctime)s - %(levelname)s - %(message)s'
     ))
-    
+
+    # Loggers only put records on the queue, all disk and console IO happens in the writer thread
+    log_queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _writer = LogWriter(log_queue, [console_handler, transaction_handler])
+    _writer.start()
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(_queue_handler)
+
+    # Transaction records reach the queue through the root logger
     transaction_logger = get_transaction_logger()
     transaction_logger.setLevel(CustomLogLevels.TRANSACTION)
-    transaction_logger.addHandler(transaction_handler)
\ No newline at end of file
+
+    atexit.register(shutdown_logging)
+
+def shutdown_logging():
+    """Write out everything still queued and fsync the transaction log"""
+    global _queue_handler, _writer
+    if _writer is None:
+        return
+    logging.getLogger().removeHandler(_queue_handler)
+    _writer.stop()
+    for handler in _writer.handlers:
+        handler.close()
+    _queue_handler = None
+    _writer = None
+
+def get_logging_stats() -> dict:
+    if _writer is None:
+        return {"running": False}
+    return {
+        "running": True,
+        "backlog": _writer.queue.qsize(),
+        "dropped": _queue_handler.dropped,
+        "written": _writer.written,
+        "fsyncs": sum(h.fsyncs for h in _writer.handlers if isinstance(h, BatchedFileHandler))
+    }
@@ -0,0 +1,358 @@
+import glob
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from ..config import settings
+
+# Line format written by setup_logging: '%(asctime)s - %(levelname)s - %(message)s'
+LINE_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - TRANSACTION - (\w+): (.*)$")
+MESSAGE_PATTERNS = {
+    "DEVICE_PAYMENT": re.compile(
+        r"^User (?P<user_id>\d+) \(.*\) paid (?P<cost>[-\d.e]+) for device (?P<device_id>\d+) \(.*\) "
+        r"for (?P<minutes>[\d.]+) minutes\. Balance changed from (?P<old>[-\d.e]+) to (?P<new>[-\d.e]+)$"
+    ),
+    "DEVICE_REFUND": re.compile(
+        r"^User (?P<user_id>\d+) \(.*\) refunded (?P<refund>[-\d.e]+) from device (?P<device_id>\d+) \(.*\) "
+        r"for (?P<minutes>[\d.]+) minutes\. Balance changed from (?P<old>[-\d.e]+) to (?P<new>[-\d.e]+)$"
+    ),
+    "CASH_UPDATE": re.compile(
+        r"^User (?P<user_id>\d+) \(.*\) balance changed from (?P<old>[-\d.e]+) to (?P<new>[-\d.e]+) "
+        r"\(difference: [-\d.e]+\) by user (?P<actor_id>\d+) \(.*\)$"
+    ),
+}
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S,%f"
+INDEX_VERSION = 3
+
+
+def parse_line(line: str) -> Optional[dict]:
+    """Parse one transactions.log line into a record, or None if it isn't a transaction line"""
+    match = LINE_PATTERN.match(line)
+    if not match:
+        return None
+    timestamp, kind, message = match.groups()
+    pattern = MESSAGE_PATTERNS.get(kind)
+    details = pattern.match(message) if pattern else None
+    if not details:
+        return None
+
+    fields = details.groupdict()
+    old_balance = float(fields["old"])
+    new_balance = float(fields["new"])
+    return {
+        "timestamp": datetime.strptime(timestamp, TIMESTAMP_FORMAT),
+        "kind": kind,
+        "user_id": int(fields["user_id"]),
+        "device_id": int(fields["device_id"]) if fields.get("device_id") else None,
+        "actor_id": int(fields["actor_id"]) if fields.get("actor_id") else None,
+        "amount": round(new_balance - old_balance, 2),
+        "balance_before": old_balance,
+        "balance_after": new_balance,
+    }
+
+
+class _Segment:
+    """Offsets of the transaction lines in one log file, keyed by user, device and day"""
+
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.size = 0  # bytes indexed so far, always at a line boundary
+        self.users: Dict[str, List[int]] = {}
+        self.devices: Dict[str, List[int]] = {}
+        self.days: Dict[str, int] = {}  # first offset of each day
+        self.first: Optional[str] = None  # timestamp of the first record, orders segments in time
+        self.last: Optional[str] = None
+        self.stat: Optional[List[int]] = None  # size and mtime of the file when it was last indexed
+        self.count = 0
+
+    def to_json(self) -> dict:
+        return {
+            "path": self.path, "size": self.size, "count": self.count, "first": self.first,
+            "last": self.last, "stat": self.stat, "users": self.users, "devices": self.devices, "days": self.days
+        }
+
+    @classmethod
+    def from_json(cls, fingerprint: str, data: dict) -> "_Segment":
+        segment = cls(data["path"], fingerprint)
+        segment.size = data["size"]
+        segment.count = data["count"]
+        segment.first = data["first"]
+        segment.last = data["last"]
+        segment.stat = data["stat"]
+        segment.users = data["users"]
+        segment.devices = data["devices"]
+        segment.days = data["days"]
+        return segment
+
+    def update(self, mm) -> bool:
+        """Index lines appended since the last update. Only complete lines are indexed."""
+        end = len(mm)
+        position = self.size
+        changed = False
+        while position < end:
+            line_end = mm.find(b"\n", position)
+            if line_end == -1:
+                break
+            record = parse_line(mm[position:line_end].decode("utf-8", errors="replace").rstrip("\r"))
+            if record:
+                self.users.setdefault(str(record["user_id"]), []).append(position)
+                if record["device_id"] is not None:
+                    self.devices.setdefault(str(record["device_id"]), []).append(position)
+                self.days.setdefault(record["timestamp"].strftime("%Y-%m-%d"), position)
+                if self.first is None:
+                    self.first = record["timestamp"].isoformat()
+                self.last = record["timestamp"].isoformat()
+                self.count += 1
+            position = line_end + 1
+            changed = True
+        self.size = position
+        return changed
+
+    def overlaps(self, start: Optional[datetime], end: Optional[datetime]) -> bool:
+        if self.first is None:
+            return False
+        if end is not None and datetime.fromisoformat(self.first) >= end:
+            return False
+        if start is not None and datetime.fromisoformat(self.last) < start:
+            return False
+        return True
+
+    def offsets(self, user_id: Optional[int], device_id: Optional[int],
+                start: Optional[datetime], end: Optional[datetime]) -> List[int]:
+        candidates = None
+        if user_id is not None:
+            candidates = self.users.get(str(user_id), [])
+        if device_id is not None:
+            device_offsets = self.devices.get(str(device_id), [])
+            candidates = device_offsets if candidates is None else sorted(set(candidates) & set(device_offsets))
+
+        # Lines are appended in time order, so a day range is an offset range
+        low, high = 0, self.size
+        if start is not None:
+            later_days = [offset for day, offset in self.days.items() if day >= start.strftime("%Y-%m-%d")]
+            low = min(later_days) if later_days else self.size
+        if end is not None:
+            after_days = [offset for day, offset in self.days.items() if day > end.strftime("%Y-%m-%d")]
+            high = min(after_days) if after_days else self.size
+
+        if candidates is None:
+            return [offset for offsets in self.users.values() for offset in offsets if low <= offset < high]
+        return [offset for offset in candidates if low <= offset < high]
+
+
+class TransactionLogIndex:
+    """
+    Index over transactions.log and its rotated segments. Plain files are read through mmap
+    and only the bytes appended since the last refresh are parsed. Compressed segments are
+    closed, so they are only indexed once when they first show up, and the last few decompressed
+    ones are kept in memory for the queries that follow. The index is kept in a
+    sidecar directory next to the log with one JSON file per segment, so a restart doesn't
+    rescan years of history and new lines only rewrite the file of the live segment.
+    """
+
+    def __init__(self, log_path: str):
+        self.log_path = log_path
+        self.index_path = log_path + ".idx"
+        self.segments: Dict[str, _Segment] = {}
+        # Decompressed content of recently read .gz segments by (path, size, mtime), oldest first
+        self._decompressed: "OrderedDict[Tuple[str, int, int], bytes]" = OrderedDict()
+        # Reentrant, query() refreshes again while holding it when a segment moved
+        self._lock = threading.RLock()
+        self._load()
+
+    def _segment_index_path(self, fingerprint: str) -> str:
+        return os.path.join(self.index_path, fingerprint + ".json")
+
+    def _load(self):
+        try:
+            names = os.listdir(self.index_path)
+        except OSError:  # not built yet, or the single sidecar file of an older version
+            return
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.index_path, name)
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if data.get("version") != INDEX_VERSION:
+                os.remove(path)
+                continue
+            fingerprint = name[:-len(".json")]
+            self.segments[fingerprint] = _Segment.from_json(fingerprint, data["segment"])
+
+    def _save(self, changed: Set[str], removed: Set[str]):
+        """Write the index files of changed segments and delete those of removed ones"""
+        if not os.path.isdir(self.index_path):
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+            os.makedirs(self.index_path, exist_ok=True)
+        for fingerprint in changed:
+            path = self._segment_index_path(fingerprint)
+            temp_path = path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump({"version": INDEX_VERSION, "segment": self.segments[fingerprint].to_json()}, f,
+                          separators=(",", ":"))
+            os.replace(temp_path, path)
+        for fingerprint in removed:
+            try:
+                os.remove(self._segment_index_path(fingerprint))
+            except FileNotFoundError:
+                pass
+
+    def segment_paths(self) -> List[str]:
+        """The live log and its rotated segments, plain or compressed"""
+        paths = [path for path in glob.glob(glob.escape(self.log_path) + ".*")
+                 if not path.endswith((".idx", ".tmp", ".json"))]
+        if os.path.exists(self.log_path):
+            paths.append(self.log_path)
+        return paths
+
+    @contextmanager
+    def _open_segment(self, path: str):
+        """Yields the segment's content as an mmap, or as bytes for compressed segments"""
+        if path.endswith(".gz"):
+            yield self._read_compressed(path)
+            return
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b""
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+
+    def _read_compressed(self, path: str) -> bytes:
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        data = self._decompressed.get(key)
+        if data is not None:
+            self._decompressed.move_to_end(key)
+            return data
+        with gzip.open(path, "rb") as f:
+            data = f.read()
+        self._decompressed[key] = data
+        while len(self._decompressed) > max(0, settings.TRANSACTION_LOG_CACHE_SEGMENTS):
+            self._decompressed.popitem(last=False)
+        return data
+
+    @staticmethod
+    def _fingerprint(mm) -> Optional[str]:
+        # The first line (with its millisecond timestamp) identifies a segment even after it is renamed
+        first_line_end = mm.find(b"\n")
+        if first_line_end == -1:
+            return None
+        return hashlib.sha1(mm[:first_line_end]).hexdigest()
+
+    def refresh(self):
+        """Index new lines of all segments and forget segments that no longer exist"""
+        with self._lock:
+            changed = set()
+            seen = set()
+            by_path = {segment.path: segment for segment in self.segments.values()}
+            for path in self.segment_paths():
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # compressed or removed meanwhile
+                    continue
+                file_stat = [stat.st_size, stat.st_mtime_ns]
+
+                # Rotated segments don't change anymore, don't open them again
+                known = by_path.get(path)
+                if path != self.log_path and known is not None and known.stat == file_stat:
+                    seen.add(known.fingerprint)
+                    continue
+
+                try:
+                    with self._open_segment(path) as mm:
+                        fingerprint = self._fingerprint(mm)
+                        if fingerprint is None:
+                            continue
+                        seen.add(fingerprint)
+                        segment = self.segments.get(fingerprint)
+                        if segment is None or segment.size > len(mm):
+                            segment = _Segment(path, fingerprint)
+                            self.segments[fingerprint] = segment
+                            changed.add(fingerprint)
+                        if segment.path != path or segment.stat != file_stat:
+                            segment.path = path
+                            segment.stat = file_stat
+                            changed.add(fingerprint)
+                        if segment.update(mm):
+                            changed.add(fingerprint)
+                except FileNotFoundError:
+                    continue
+
+            removed = set(self.segments) - seen
+            for fingerprint in removed:
+                del self.segments[fingerprint]
+            if changed or removed:
+                self._save(changed - removed, removed)
+
+    def _read_records(self, path: str, offsets: List[int]) -> List[dict]:
+        """Parse the lines at offsets of one segment"""
+        records = []
+        with self._open_segment(path) as mm:
+            for offset in sorted(offsets):
+                line_end = mm.find(b"\n", offset)
+                if line_end == -1:  # unterminated last line
+                    line_end = len(mm)
+                record = parse_line(mm[offset:line_end].decode("utf-8", errors="replace").rstrip("\r"))
+                if record is not None:
+                    records.append(record)
+        return records
+
+    def query(self, user_id: Optional[int] = None, device_id: Optional[int] = None,
+              start: Optional[datetime] = None, end: Optional[datetime] = None,
+              kinds: Optional[List[str]] = None, limit: Optional[int] = None) -> List[dict]:
+        """Return matching records in chronological order. start and end are naive local times, like the log."""
+        self.refresh()
+        records = []
+        with self._lock:
+            for segment in sorted(self.segments.values(), key=lambda segment: segment.first or ""):
+                # Segments outside the time window are never opened
+                if not segment.overlaps(start, end):
+                    continue
+                offsets = segment.offsets(user_id, device_id, start, end)
+                if not offsets:
+                    continue
+                try:
+                    segment_records = self._read_records(segment.path, offsets)
+                except FileNotFoundError:
+                    # Compressed and removed by the rotator since the refresh. The segment keeps its
+                    # fingerprint, so a second refresh finds it under its new path.
+                    self.refresh()
+                    segment = self.segments.get(segment.fingerprint)
+                    if segment is None:
+                        continue
+                    segment_records = self._read_records(segment.path, offsets)
+                for record in segment_records:
+                    if start is not None and record["timestamp"] < start:
+                        continue
+                    if end is not None and record["timestamp"] >= end:
+                        continue
+                    if kinds and record["kind"] not in kinds:
+                        continue
+                    records.append(record)
+                    if limit and len(records) >= limit:
+                        return records
+        return records
+
+
+_index: Optional[TransactionLogIndex] = None
+
+def get_transaction_log_index() -> TransactionLogIndex:
+    global _index
+    if _index is None:
+        _index = TransactionLogIndex(settings.TRANSACTION_LOG_PATH)
+    return _index
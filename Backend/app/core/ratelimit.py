@@ -0,0 +1,108 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import HTTPException, Request, status
+
+from ..config import settings
+
+
+class TokenBucketLimiter:
+    """In-memory token buckets keyed by an arbitrary string.
+
+    Buckets are kept in an OrderedDict in least-recently-used order so idle
+    entries can be evicted from the front without scanning the whole map.
+    """
+
+    def __init__(self, name: str, capacity: int, per_minute: int, ttl_seconds: Optional[float] = None,
+                 max_keys: int = 100_000):
+        self.name = name
+        self.capacity = float(capacity)
+        self.refill_rate = per_minute / 60.0
+        # A bucket idle for capacity / refill_rate seconds is full again, so it can be dropped
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else self.capacity / self.refill_rate
+        self.max_keys = max_keys
+        self.rejected = 0
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    def hit(self, key: str) -> float:
+        """Take one token for key. Returns 0 if allowed, otherwise seconds until a token is available."""
+        now = time.monotonic()
+        self._evict(now)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [self.capacity, now]
+            self._buckets[key] = bucket
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.refill_rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+
+        self.rejected += 1
+        return (1 - bucket[0]) / self.refill_rate
+
+    def _evict(self, now: float):
+        while self._buckets:
+            key, (_, last_seen) = next(iter(self._buckets.items()))
+            if now - last_seen < self.ttl_seconds and len(self._buckets) < self.max_keys:
+                break
+            del self._buckets[key]
+
+    def reset(self):
+        self._buckets.clear()
+        self.rejected = 0
+
+    def stats(self) -> dict:
+        return {
+            "rejected": self.rejected,
+            "tracked_keys": len(self._buckets)
+        }
+
+
+ip_limiter = TokenBucketLimiter(
+    "ip", settings.LOGIN_IP_BURST, settings.LOGIN_IP_PER_MINUTE
+)
+account_limiter = TokenBucketLimiter(
+    "account", settings.LOGIN_ACCOUNT_BURST, settings.LOGIN_ACCOUNT_PER_MINUTE
+)
+
+
+def _account_key(kind: str, identifier: str) -> str:
+    # Hash identifiers so raw key card IDs are never kept in memory
+    return kind + ":" + hashlib.sha256(identifier.encode()).hexdigest()[:32]
+
+def _raise_too_many(retry_after: float):
+    raise HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many login attempts",
+        headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+    )
+
+def throttle_login(request: Request, kind: str, identifier: str):
+    """Apply per-IP and per-account limits. Must run before any hash verification."""
+    client_ip = request.client.host if request.client else "unknown"
+
+    retry_after = ip_limiter.hit(client_ip)
+    if retry_after:
+        _raise_too_many(retry_after)
+
+    retry_after = account_limiter.hit(_account_key(kind, identifier))
+    if retry_after:
+        _raise_too_many(retry_after)
+
+def get_throttle_stats() -> dict:
+    return {
+        "rejected_total": ip_limiter.rejected + account_limiter.rejected,
+        ip_limiter.name: ip_limiter.stats(),
+        account_limiter.name: account_limiter.stats()
+    }
+
+def reset_throttles():
+    ip_limiter.reset()
+    account_limiter.reset()
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from ..database.session import AsyncSessionLocal
+from ..models.ledger import LedgerEntry
+from ..models.user import User
+
+# Users listed in a report, the totals always cover everyone
+MAX_REPORTED_USERS = 1000
+
+logger = logging.getLogger(__name__)
+_last_report: Optional[dict] = None
+_reconcile_lock = asyncio.Lock()
+
+
+def _to_cents(values) -> np.ndarray:
+    # Numeric(10, 2) columns come back as Decimal, integer cents keep the sums exact
+    return np.rint(np.asarray(values, dtype=np.float64) * 100).astype(np.int64)
+
+async def _load_movements(session: AsyncSession):
+    """Stream the ledger ordered by user and time into arrays of user ids, amounts and balances in cents"""
+    users, amounts, balances = [], [], []
+    result = await session.stream(
+        select(LedgerEntry.user_id, LedgerEntry.amount, LedgerEntry.balance_after)
+        .order_by(LedgerEntry.user_id, LedgerEntry.timestamp, LedgerEntry.id)
+        .execution_options(yield_per=settings.RECONCILE_CHUNK_SIZE)
+    )
+    async for rows in result.partitions():
+        columns = list(zip(*rows))
+        users.append(np.asarray(columns[0], dtype=np.int64))
+        amounts.append(_to_cents(columns[1]))
+        balances.append(_to_cents(columns[2]))
+    if not users:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int64)
+    return np.concatenate(users), np.concatenate(amounts), np.concatenate(balances)
+
+async def _load_balances(session: AsyncSession):
+    result = await session.execute(select(User.uid, User.cash).order_by(User.uid))
+    rows = result.all()
+    return (
+        np.asarray([row.uid for row in rows], dtype=np.int64),
+        _to_cents([row.cash or 0 for row in rows])
+    )
+
+def compare_balances(movement_users, amounts, balances, uids, cash) -> dict:
+    """
+    Replay the ledger per user and diff the result against User.cash. Expects movements sorted by
+    user and time. Everything is grouped with array operations, there is no loop over movements.
+    """
+    # Users without movements have nothing to replay
+    expected_cash = cash.copy()
+    user_breaks = np.zeros(len(uids), np.int64)
+    has_movements = np.zeros(len(uids), bool)
+
+    if len(movement_users):
+        # Start of each user's group of movements
+        starts = np.flatnonzero(np.r_[True, movement_users[1:] != movement_users[:-1]])
+        ledger_users = movement_users[starts]
+        # Balance before the first recorded movement, 0 unless the user predates the ledger
+        opening = balances[starts] - amounts[starts]
+        expected = opening + np.add.reduceat(amounts, starts)
+
+        # Each movement should continue from the balance the previous one of the same user left
+        continues = np.r_[False, movement_users[1:] == movement_users[:-1]]
+        broken = continues & (balances != np.r_[0, balances[:-1]] + amounts)
+        breaks = np.bincount(np.searchsorted(starts, np.flatnonzero(broken), side="right") - 1, minlength=len(starts))
+
+        # Line users up with their group of movements
+        position = np.minimum(np.searchsorted(ledger_users, uids), len(ledger_users) - 1)
+        has_movements = ledger_users[position] == uids
+        expected_cash = np.where(has_movements, expected[position], cash)
+        user_breaks = np.where(has_movements, breaks[position], 0)
+
+    drift = cash - expected_cash
+    drifted = np.flatnonzero((drift != 0) | (user_breaks > 0))
+    drifted = drifted[np.argsort(-np.abs(drift[drifted]), kind="stable")]
+    return {
+        "users_checked": int(len(uids)),
+        "users_without_movements": int(len(uids) - has_movements.sum()),
+        "movements": int(len(movement_users)),
+        "drifted_users": int(len(drifted)),
+        "total_drift": float(np.abs(drift).sum()) / 100,
+        "drift": [
+            {
+                "user_id": int(uids[i]),
+                "cash": float(cash[i]) / 100,
+                "expected": float(expected_cash[i]) / 100,
+                "drift": float(drift[i]) / 100,
+                "chain_breaks": int(user_breaks[i])
+            }
+            for i in drifted[:MAX_REPORTED_USERS]
+        ]
+    }
+
+async def reconcile_balances(session: AsyncSession) -> dict:
+    """Replay the ledger, diff it against every user's cash and keep the report as the latest one"""
+    global _last_report
+    async with _reconcile_lock:
+        started = time.perf_counter()
+        started_at = datetime.now(timezone.utc)
+        movement_users, amounts, balances = await _load_movements(session)
+        uids, cash = await _load_balances(session)
+        # The grouping is CPU bound, keep it off the event loop
+        report = await run_in_threadpool(compare_balances, movement_users, amounts, balances, uids, cash)
+        report["started_at"] = started_at.isoformat()
+        report["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        if report["drifted_users"]:
+            logger.warning(
+                "Balance reconciliation found %d users drifting from the ledger (total %.2f)",
+                report["drifted_users"], report["total_drift"]
+            )
+        _last_report = report
+        return report
+
+def get_last_reconciliation() -> Optional[dict]:
+    return _last_report
+
+def _seconds_until(hour: int) -> float:
+    now = datetime.now(timezone.utc)
+    next_run = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if next_run <= now:
+        next_run += timedelta(days=1)
+    return (next_run - now).total_seconds()
+
+async def run_nightly_reconciliation():
+    """Reconcile balances every day at RECONCILE_HOUR (UTC) until cancelled"""
+    while True:
+        await asyncio.sleep(_seconds_until(settings.RECONCILE_HOUR))
+        try:
+            async with AsyncSessionLocal() as session:
+                await reconcile_balances(session)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Balance reconciliation failed")
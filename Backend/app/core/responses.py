@@ -0,0 +1,28 @@
+from typing import Any
+
+from fastapi import Response
+from pydantic_core import to_json
+
+try:
+    import orjson
+except ImportError:  # optional, pydantic's encoder is used instead, about half as fast
+    orjson = None
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return to_json(content)
+
+
+class FastJSONResponse(Response):
+    """
+    JSON response for content that already has the shape of the route's response_model,
+    like the output of _tojson(). FastAPI sends returned responses as they are, so the dicts
+    aren't validated into models and dumped again. The response_model still documents the
+    route, tests check the content against it.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
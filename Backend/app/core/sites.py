@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set
+
+from fastapi import WebSocket, WebSocketDisconnect
+from sqlalchemy import select, update
+
+from ..config import DEVICES, settings
+from ..database.instrumentation import track_queries
+from ..database.session import AsyncSessionLocal
+from ..models.device import Device, DEFAULT_SITE
+from .device_table import expire_device, read_device, to_datetime
+
+# Shortest wait between two reads of a site's devices, keeps expiries that are due right now from spinning
+MIN_WAIT_SECONDS = 0.05
+
+logger = logging.getLogger(__name__)
+# Sessions of the hubs, which run outside of any request and its get_db. Looked up on every
+# use, so tests can point the hubs at their own database.
+session_factory = AsyncSessionLocal
+
+# Device ids of each site, from the config
+SITE_DEVICES: Dict[str, List[int]] = {}
+for _device_config in DEVICES:
+    SITE_DEVICES.setdefault(_device_config.get("site", DEFAULT_SITE), []).append(_device_config["id"])
+DEVICE_IDS = {device_config["id"] for device_config in DEVICES}
+_device_sites = {device_id: site for site, device_ids in SITE_DEVICES.items() for device_id in device_ids}
+
+
+def site_of(device_id: int) -> str:
+    return _device_sites.get(device_id, DEFAULT_SITE)
+
+def site_worker(site: str) -> int:
+    """Index of the worker that owns the site, stable across restarts and processes"""
+    return zlib.crc32(site.encode()) % max(1, settings.SITE_WORKER_COUNT)
+
+def owns_site(site: str) -> bool:
+    return site_worker(site) == settings.SITE_WORKER_INDEX
+
+
+class SiteHub:
+    """
+    Hot state of one site: its WebSocket clients and the timer that resets expired devices.
+    One task reads all devices of the site, from the shared device table or else with a single
+    query, and pushes a snapshot to every client when something changed. It sleeps until the
+    next device expires, a start or stop wakes it, or SITE_POLL_SECONDS pass (changes made by
+    other workers).
+
+    Only the worker owning the site writes the expiry resets, hubs of other workers show
+    expired devices as idle without saving it.
+    """
+
+    def __init__(self, site: str, pinned: bool = False):
+        self.site = site
+        # Pinned hubs keep the site's expiry timer running without clients
+        self.pinned = pinned
+        self.sockets: Set[WebSocket] = set()
+        self.snapshot: Optional[dict] = None
+        self.ticks = 0
+        self.broadcasts = 0
+        self.expired_resets = 0
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        self.task = self.loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                timeout = await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Site hub %s failed to refresh", self.site)
+                timeout = settings.SITE_POLL_SECONDS
+            try:
+                await asyncio.wait_for(self.wake.wait(), max(MIN_WAIT_SECONDS, timeout))
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+
+    async def _tick(self) -> float:
+        """Refresh the site's devices and return how long to wait for the next expiry"""
+        self.ticks += 1
+        now = datetime.now(timezone.utc)
+        devices = self._read_table()
+        if devices is None:
+            devices = await self._read_database(now)
+        else:
+            expired = [(device_id, end_time) for device_id, _, end_time in devices if end_time and end_time <= now]
+            if expired and owns_site(self.site):
+                await self._reset_expired(expired, now)
+
+        states = []
+        next_expiry = None
+        for device_id, user_id, end_time in devices:
+            running = end_time is not None and end_time > now
+            states.append({
+                "device_id": device_id,
+                "running": running,
+                "user_id": user_id if running else None,
+                "end_time": end_time.isoformat() if running else None
+            })
+            if running and (next_expiry is None or end_time < next_expiry):
+                next_expiry = end_time
+
+        snapshot = {"site": self.site, "devices": states}
+        if snapshot != self.snapshot:
+            self.snapshot = snapshot
+            await self._broadcast(snapshot)
+
+        timeout = settings.SITE_POLL_SECONDS
+        if next_expiry is not None:
+            timeout = min(timeout, (next_expiry - now).total_seconds())
+        return timeout
+
+    def _read_table(self) -> Optional[List[tuple]]:
+        # Device states from the shared table, no query. None until it has all of the site's devices.
+        devices = []
+        for device_id in SITE_DEVICES.get(self.site, []):
+            state = read_device(device_id)
+            if state is None:
+                return None
+            user_id, end_time = state
+            devices.append((device_id, user_id, to_datetime(end_time) if end_time else None))
+        return devices
+
+    async def _read_database(self, now: datetime) -> List[tuple]:
+        with track_queries("WS /site/{site}/ws"):
+            async with session_factory() as session:
+                result = await session.execute(select(Device).where(Device.site == self.site).order_by(Device.id))
+                devices = result.scalars().all()
+
+                expired = [device for device in devices if device.end_time and _as_utc(device.end_time) <= now]
+                if expired and owns_site(self.site):
+                    for device in expired:
+                        device.user_id = None
+                        device.end_time = None
+                    await session.commit()
+                    self.expired_resets += len(expired)
+        return [
+            (device.id, device.user_id, _as_utc(device.end_time) if device.end_time else None)
+            for device in devices
+        ]
+
+    async def _reset_expired(self, expired: List[tuple], now: datetime):
+        # Only runs that are still over are reset, a device started again meanwhile is kept
+        with track_queries("WS /site/{site}/ws"):
+            async with session_factory() as session:
+                await session.execute(
+                    update(Device)
+                    .where(Device.id.in_([device_id for device_id, _ in expired]),
+                           Device.end_time <= now.replace(tzinfo=None))
+                    .values(user_id=None, end_time=None)
+                )
+                await session.commit()
+        for device_id, end_time in expired:
+            expire_device(device_id, end_time.timestamp())
+        self.expired_resets += len(expired)
+
+    async def _broadcast(self, data: dict):
+        self.broadcasts += 1
+        dead_connections = set()
+        for websocket in list(self.sockets):
+            try:
+                await websocket.send_json(data)
+            except (RuntimeError, WebSocketDisconnect):  # Connection already closed
+                dead_connections.add(websocket)
+        self.sockets -= dead_connections
+
+    async def connect(self, websocket: WebSocket):
+        self.sockets.add(websocket)
+        if self.snapshot is not None:
+            await websocket.send_json(self.snapshot)
+
+    def notify(self):
+        # Starts and stops may come from another thread's event loop (e.g. a sync test client)
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    def stop(self):
+        self.task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self.sockets),
+            "pinned": self.pinned,
+            "ticks": self.ticks,
+            "broadcasts": self.broadcasts,
+            "expired_resets": self.expired_resets
+        }
+
+
+_hubs: Dict[str, SiteHub] = {}
+
+
+def get_hub(site: str) -> SiteHub:
+    """The site's running hub, started on first use"""
+    hub = _hubs.get(site)
+    if hub is None or hub.task.done() or hub.loop is not asyncio.get_running_loop():
+        hub = _hubs[site] = SiteHub(site, pinned=hub.pinned if hub else False)
+    return hub
+
+def release_hub(hub: SiteHub, websocket: WebSocket):
+    """Drop a client, hubs that aren't pinned stop with their last client"""
+    hub.sockets.discard(websocket)
+    if not hub.sockets and not hub.pinned:
+        hub.stop()
+        if _hubs.get(hub.site) is hub:
+            del _hubs[hub.site]
+
+def notify_device_change(device_id: int):
+    """Push a started or stopped device to the clients of its site right away"""
+    hub = _hubs.get(site_of(device_id))
+    if hub is not None:
+        hub.notify()
+
+def start_site_hubs() -> List[str]:
+    """Pin hubs for the sites this worker owns, so their expiries are handled without clients"""
+    owned = [site for site in SITE_DEVICES if owns_site(site)]
+    for site in owned:
+        get_hub(site).pinned = True
+    return owned
+
+def stop_site_hubs():
+    for hub in _hubs.values():
+        hub.stop()
+    _hubs.clear()
+
+def get_sites() -> List[dict]:
+    return [
+        {
+            "site": site,
+            "device_ids": device_ids,
+            "worker": site_worker(site),
+            "owned": owns_site(site),
+            "hub": _hubs[site].stats() if site in _hubs else None
+        }
+        for site, device_ids in SITE_DEVICES.items()
+    ]
+
+def _as_utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
@@ -0,0 +1,69 @@
+from datetime import datetime
+from sqlalchemy import update
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..models.device import Device
+from ..models.stats import UsageRollup
+from .ledger import to_utc_naive
+
+SCOPES = ("device", "device_type", "user")
+PERIODS = ("hour", "day", "month")
+COUNTERS = ("run_count", "minutes", "revenue", "refunds", "refunded_minutes")
+
+def bucket_start(when: datetime, period: str) -> datetime:
+    """Start of the hour, day or month containing when, as naive UTC like all stored timestamps"""
+    when = to_utc_naive(when)
+    if period == "hour":
+        return when.replace(minute=0, second=0, microsecond=0)
+    if period == "day":
+        return when.replace(hour=0, minute=0, second=0, microsecond=0)
+    return when.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+async def _increment(session: AsyncSession, device: Device, user_id: int, when: datetime, **counters):
+    keys = {
+        "device": str(device.id),
+        "device_type": device.type or "unknown",
+        "user": str(user_id)
+    }
+    values = {counter: counters.get(counter, 0) for counter in COUNTERS}
+    rows = [
+        {"scope": scope, "period": period, "bucket_start": bucket_start(when, period), "key": keys[scope], **values}
+        for scope in SCOPES for period in PERIODS
+    ]
+
+    table = UsageRollup.__table__
+    dialect = session.get_bind().dialect.name
+    # One upsert statement for all nine rollup rows
+    if dialect == "sqlite":
+        statement = sqlite.insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key],
+            set_={counter: table.c[counter] + statement.excluded[counter] for counter in COUNTERS}
+        )
+        await session.execute(statement)
+    elif dialect in ("mysql", "mariadb"):
+        statement = mysql.insert(table).values(rows)
+        statement = statement.on_duplicate_key_update(
+            {counter: table.c[counter] + statement.inserted[counter] for counter in COUNTERS}
+        )
+        await session.execute(statement)
+    else:
+        for row in rows:
+            result = await session.execute(
+                update(table)
+                .where(*(table.c[column.name] == row[column.name] for column in table.primary_key))
+                .values({counter: table.c[counter] + row[counter] for counter in COUNTERS})
+            )
+            if result.rowcount == 0:
+                await session.execute(table.insert().values(row))
+
+async def record_run(session: AsyncSession, device: Device, user_id: int, when: datetime,
+                     minutes: float, cost: float):
+    """Count a device start. Runs in the caller's transaction."""
+    await _increment(session, device, user_id, when, run_count=1, minutes=minutes, revenue=round(cost, 2))
+
+async def record_refund(session: AsyncSession, device: Device, user_id: int, when: datetime,
+                        minutes: float, amount: float):
+    """Count a refund for unused minutes. Runs in the caller's transaction."""
+    await _increment(session, device, user_id, when, refunds=amount, refunded_minutes=minutes)
@@ -0,0 +1,126 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from ..config import settings
+
+# Statements are cut to this length in metrics and logs
+STATEMENT_PREVIEW = 300
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats:
+    """Queries executed while handling one request or WebSocket tick"""
+
+    def __init__(self, name: Optional[str] = None):
+        self.name = name
+        self.count = 0
+        self.total_ms = 0.0
+        self.slowest_ms = 0.0
+        self.slowest_statement: Optional[str] = None
+        self.statements: Dict[str, int] = {}
+
+    def record(self, statement: str, duration_ms: float):
+        self.count += 1
+        self.total_ms += duration_ms
+        if duration_ms > self.slowest_ms:
+            self.slowest_ms = duration_ms
+            self.slowest_statement = statement
+        self.statements[statement] = self.statements.get(statement, 0) + 1
+
+    def repeated(self) -> Dict[str, int]:
+        """
+        Statements executed at least QUERY_N_PLUS_ONE_THRESHOLD times. Parameters are bound
+        separately, so the same query in a loop shows up as the same statement text.
+        """
+        return {
+            statement: count for statement, count in self.statements.items()
+            if count >= settings.QUERY_N_PLUS_ONE_THRESHOLD
+        }
+
+
+_current: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+_lock = threading.Lock()
+_routes: Dict[str, dict] = {}
+_reported = set()  # (route, statement) pairs already logged as N+1
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        context._query_started = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    started = getattr(context, "_query_started", None)
+    if stats is not None and started is not None:
+        stats.record(statement, (time.perf_counter() - started) * 1000)
+
+@contextmanager
+def track_queries(name: Optional[str] = None):
+    """Collect the queries run inside the block. The name can still be set on the yielded stats."""
+    stats = QueryStats(name)
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+        _aggregate(stats)
+
+def _aggregate(stats: QueryStats):
+    name = stats.name or "unknown"
+    repeated = stats.repeated()
+    with _lock:
+        route = _routes.setdefault(name, {
+            "calls": 0, "queries": 0, "db_ms": 0.0, "max_queries": 0,
+            "slowest_ms": 0.0, "slowest_statement": None, "n_plus_one_calls": 0, "n_plus_one_statement": None
+        })
+        route["calls"] += 1
+        route["queries"] += stats.count
+        route["db_ms"] += stats.total_ms
+        route["max_queries"] = max(route["max_queries"], stats.count)
+        if stats.slowest_ms > route["slowest_ms"]:
+            route["slowest_ms"] = stats.slowest_ms
+            route["slowest_statement"] = stats.slowest_statement[:STATEMENT_PREVIEW]
+        if repeated:
+            statement, count = max(repeated.items(), key=lambda item: item[1])
+            route["n_plus_one_calls"] += 1
+            route["n_plus_one_statement"] = statement[:STATEMENT_PREVIEW]
+            new_pattern = (name, statement) not in _reported
+            _reported.add((name, statement))
+        else:
+            new_pattern = False
+    if new_pattern:
+        logger.warning("Possible N+1 in %s: statement ran %d times: %s", name, count, statement[:STATEMENT_PREVIEW])
+
+def debug_headers(stats: QueryStats) -> Dict[str, str]:
+    return {
+        "X-DB-Query-Count": str(stats.count),
+        "X-DB-Time-Ms": f"{stats.total_ms:.2f}",
+        "X-DB-Slowest-Ms": f"{stats.slowest_ms:.2f}",
+        "X-DB-N-Plus-One": str(len(stats.repeated())),
+    }
+
+def get_query_stats() -> dict:
+    """Per route totals, the routes spending the most time in the database first"""
+    with _lock:
+        routes = {name: dict(route) for name, route in _routes.items()}
+    for route in routes.values():
+        route["avg_queries"] = round(route["queries"] / route["calls"], 2)
+        route["avg_db_ms"] = round(route["db_ms"] / route["calls"], 2)
+        route["db_ms"] = round(route["db_ms"], 2)
+        route["slowest_ms"] = round(route["slowest_ms"], 2)
+    return dict(sorted(routes.items(), key=lambda item: item[1]["db_ms"], reverse=True))
+
+def reset_query_stats():
+    with _lock:
+        _routes.clear()
+        _reported.clear()
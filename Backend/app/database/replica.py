@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import Depends, Request, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from ..config import settings
+from ..models.replica import ReplicaHeartbeat
+from .session import AsyncSessionLocal, get_db
+from .sqlite import configure_sqlite, is_sqlite
+
+# Clients tracked for read-after-write, the oldest are dropped beyond this
+MAX_RECENT_WRITERS = 100_000
+# Methods that never write
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+# Cookie and header with the time (epoch seconds) of the client's last write. Every worker sees
+# them, so a read landing on another worker than the write still goes to the primary. Browsers
+# only send the cookie cross-origin with credentials, token clients echo the header instead.
+WRITE_COOKIE = "waschplan_last_write"
+WRITE_HEADER = "X-Last-Write"
+
+logger = logging.getLogger(__name__)
+
+replica_engine = (
+    create_async_engine(settings.DATABASE_REPLICA_URL, echo=settings.DATABASE_ECHO)
+    if settings.DATABASE_REPLICA_URL else None
+)
+if replica_engine is not None and is_sqlite(settings.DATABASE_REPLICA_URL):
+    configure_sqlite(replica_engine)
+ReplicaSessionLocal = (
+    sessionmaker(replica_engine, class_=AsyncSession, expire_on_commit=False) if replica_engine else None
+)
+
+# Last measured lag in seconds, None until the first check or while the replica is unreachable
+_replica_lag: Optional[float] = None
+_last_check: Optional[str] = None
+_routed = {"replica": 0, "primary": 0}
+# Clients of this worker that wrote recently, by key, in the order of their last write (epoch seconds).
+# Covers clients that don't keep cookies, as long as they read from the worker they wrote to.
+_recent_writers: "OrderedDict[str, float]" = OrderedDict()
+
+
+def _client_key(request: Request) -> str:
+    # The bearer token identifies one logged in client, hashed so tokens aren't kept in memory
+    identity = request.headers.get("authorization") or (request.client.host if request.client else "unknown")
+    return hashlib.sha256(identity.encode()).hexdigest()[:32]
+
+def note_write(request: Request, response: Response):
+    """Keep the client's reads on the primary until the replica has caught up with its write"""
+    if request.method in READ_METHODS or ReplicaSessionLocal is None:
+        return
+    key = _client_key(request)
+    now = time.time()
+    # Reads need a login anyway, and the login request itself changes nothing a client reads back
+    if "authorization" in request.headers:
+        response.set_cookie(
+            WRITE_COOKIE, f"{now:.3f}", max_age=max(1, round(settings.REPLICA_MAX_LAG_SECONDS)),
+            httponly=True, samesite="lax"
+        )
+        response.headers[WRITE_HEADER] = f"{now:.3f}"
+    _recent_writers[key] = now
+    _recent_writers.move_to_end(key)
+    while _recent_writers:
+        oldest = next(iter(_recent_writers.values()))
+        if now - oldest < settings.REPLICA_MAX_LAG_SECONDS and len(_recent_writers) <= MAX_RECENT_WRITERS:
+            break
+        _recent_writers.popitem(last=False)
+
+def _last_write(request: Request) -> Optional[float]:
+    candidates = [_recent_writers.get(_client_key(request))]
+    for value in (request.cookies.get(WRITE_COOKIE), request.headers.get(WRITE_HEADER)):
+        try:
+            candidates.append(float(value))
+        except (TypeError, ValueError):
+            pass
+    candidates = [wrote_at for wrote_at in candidates if wrote_at is not None]
+    return max(candidates) if candidates else None
+
+def _use_replica(request: Request) -> bool:
+    if ReplicaSessionLocal is None or _replica_lag is None or _replica_lag > settings.REPLICA_MAX_LAG_SECONDS:
+        return False
+    wrote_at = _last_write(request)
+    return wrote_at is None or time.time() - wrote_at >= settings.REPLICA_MAX_LAG_SECONDS
+
+async def get_read_db(request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    Session for read-only endpoints. Uses the replica if one is configured, its lag is within
+    REPLICA_MAX_LAG_SECONDS and the client didn't write during that time (on any worker, see
+    WRITE_COOKIE and WRITE_HEADER), otherwise the primary.
+    Nothing written through it is committed.
+    """
+    if not _use_replica(request):
+        _routed["primary"] += 1
+        yield db
+        return
+    _routed["replica"] += 1
+    async with ReplicaSessionLocal() as session:
+        yield session
+
+async def check_replica_lag() -> Optional[float]:
+    """Write a heartbeat on the primary and measure how old the replica's copy of it is"""
+    global _replica_lag, _last_check
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    _last_check = now.isoformat()
+    try:
+        async with AsyncSessionLocal() as session:
+            await session.merge(ReplicaHeartbeat(id=1, beat_at=now))
+            await session.commit()
+        async with ReplicaSessionLocal() as session:
+            result = await session.execute(select(ReplicaHeartbeat.beat_at).where(ReplicaHeartbeat.id == 1))
+            beat_at = result.scalar()
+    except Exception:
+        logger.exception("Checking the replica lag failed, reads go to the primary")
+        _replica_lag = None
+        return None
+
+    _replica_lag = (now - beat_at).total_seconds() if beat_at is not None else None
+    if _replica_lag is None or _replica_lag > settings.REPLICA_MAX_LAG_SECONDS:
+        logger.warning("Replica is behind (lag %s s), reads go to the primary", _replica_lag)
+    return _replica_lag
+
+async def run_replica_monitor():
+    """Measure the replica lag every REPLICA_CHECK_INTERVAL_SECONDS until cancelled"""
+    while True:
+        await check_replica_lag()
+        await asyncio.sleep(settings.REPLICA_CHECK_INTERVAL_SECONDS)
+
+def get_replica_status() -> dict:
+    return {
+        "configured": ReplicaSessionLocal is not None,
+        "lag_seconds": _replica_lag,
+        "max_lag_seconds": settings.REPLICA_MAX_LAG_SECONDS,
+        "last_check": _last_check,
+        "recent_writers": len(_recent_writers),
+        "routed": dict(_routed)
+    }
+
+def reset_replica_state():
+    global _replica_lag, _last_check
+    _replica_lag = None
+    _last_check = None
+    _recent_writers.clear()
+    _routed.update(replica=0, primary=0)
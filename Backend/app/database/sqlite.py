@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.util import await_only
+
+from ..config import settings
+
+# Statements that make SQLite take its write lock
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "DROP", "ALTER")
+BACKUP_PREFIX = "waschplan-"
+
+logger = logging.getLogger(__name__)
+
+
+class WriterQueue:
+    """
+    Lets one connection at a time write, in arrival order. SQLite allows a single writer
+    anyway. Waiting here instead of in SQLite's busy handler avoids `database is locked`
+    errors and the handler's sleep-and-retry latency.
+
+    The queue is entered before the first write statement of a transaction, when SQLite
+    itself would take the write lock. It is left when the connection goes back to the pool,
+    after the commit or rollback.
+    """
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.writes = 0
+        self.waited = 0
+        self.wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def enter(self, info: dict):
+        if info.get("sqlite_writer"):
+            return
+        started = time.perf_counter()
+        if self.lock.locked():
+            self.waited += 1
+        # Runs inside SQLAlchemy's greenlet, await_only suspends it until the lock is free
+        await_only(asyncio.wait_for(self.lock.acquire(), settings.SQLITE_BUSY_TIMEOUT_MS / 1000))
+        waited_ms = (time.perf_counter() - started) * 1000
+        self.wait_ms += waited_ms
+        self.max_wait_ms = max(self.max_wait_ms, waited_ms)
+        self.writes += 1
+        info["sqlite_writer"] = True
+
+    def leave(self, info: dict):
+        if info.pop("sqlite_writer", False):
+            self.lock.release()
+
+    def stats(self) -> dict:
+        return {
+            "write_transactions": self.writes,
+            "waited": self.waited,
+            "avg_wait_ms": round(self.wait_ms / self.writes, 2) if self.writes else 0.0,
+            "max_wait_ms": round(self.max_wait_ms, 2),
+            "writer_active": self.lock.locked()
+        }
+
+
+writer_queues: List[WriterQueue] = []
+_backup_stats = {"backups": 0, "last_backup": None, "last_path": None, "last_duration_ms": None}
+
+
+def is_sqlite(url: str) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+def sqlite_path(url: str) -> Optional[str]:
+    """Path of the database file, None for in-memory databases"""
+    database = make_url(url).database
+    if not database or database == ":memory:" or database.startswith("file::memory:"):
+        return None
+    return database
+
+def configure_sqlite(engine: AsyncEngine) -> WriterQueue:
+    """Apply the SQLITE_* pragmas to every new connection and queue the engine's writers"""
+    queue = WriterQueue()
+    writer_queues.append(queue)
+    on_disk = sqlite_path(str(engine.url)) is not None
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if on_disk:
+            # Readers don't block the writer and the writer doesn't block readers
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+        cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+        # Negative values are in KiB instead of pages
+        cursor.execute(f"PRAGMA cache_size={-int(settings.SQLITE_CACHE_SIZE_KB)}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _enter_writer_queue(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+            queue.enter(conn.info)
+
+    @event.listens_for(engine.sync_engine, "checkin")
+    def _leave_writer_queue(dbapi_connection, connection_record):
+        queue.leave(connection_record.info)
+
+    @event.listens_for(engine.sync_engine, "invalidate")
+    def _leave_writer_queue_on_error(dbapi_connection, connection_record, exception):
+        # The record's info is cleared when a broken connection is thrown away
+        queue.leave(connection_record.info)
+
+    return queue
+
+def _backup_file(source: str, target: str):
+    # The backup API copies a consistent snapshot. In WAL mode writers carry on meanwhile.
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+async def backup_database(url: str = None) -> dict:
+    """Copy the SQLite database into SQLITE_BACKUP_DIR and keep the newest SQLITE_BACKUP_KEEP copies"""
+    source = sqlite_path(url or settings.DATABASE_URL)
+    if source is None:
+        raise ValueError("Backups need an SQLite database file")
+
+    started = time.perf_counter()
+    os.makedirs(settings.SQLITE_BACKUP_DIR, exist_ok=True)
+    name = f"{BACKUP_PREFIX}{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S-%f')}.db"
+    target = os.path.join(settings.SQLITE_BACKUP_DIR, name)
+    # Written under a temporary name, so a half written file is never mistaken for a backup
+    await run_in_threadpool(_backup_file, source, target + ".tmp")
+    os.replace(target + ".tmp", target)
+
+    for old in list_backups()[settings.SQLITE_BACKUP_KEEP:]:
+        os.remove(os.path.join(settings.SQLITE_BACKUP_DIR, old["name"]))
+
+    _backup_stats["backups"] += 1
+    _backup_stats["last_backup"] = datetime.now(timezone.utc).isoformat()
+    _backup_stats["last_path"] = target
+    _backup_stats["last_duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return {"path": target, "size_bytes": os.path.getsize(target), "duration_ms": _backup_stats["last_duration_ms"]}
+
+def list_backups() -> List[dict]:
+    """Backups in SQLITE_BACKUP_DIR, newest first"""
+    if not os.path.isdir(settings.SQLITE_BACKUP_DIR):
+        return []
+    names = sorted(
+        (name for name in os.listdir(settings.SQLITE_BACKUP_DIR)
+         if name.startswith(BACKUP_PREFIX) and name.endswith(".db")),
+        reverse=True
+    )
+    return [
+        {"name": name, "size_bytes": os.path.getsize(os.path.join(settings.SQLITE_BACKUP_DIR, name))}
+        for name in names
+    ]
+
+async def run_sqlite_backups():
+    """Back up the database every SQLITE_BACKUP_INTERVAL_HOURS until cancelled"""
+    while True:
+        await asyncio.sleep(settings.SQLITE_BACKUP_INTERVAL_HOURS * 3600)
+        try:
+            await backup_database()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("SQLite backup failed")
+
+def get_sqlite_stats() -> dict:
+    return {
+        "writer_queue": [queue.stats() for queue in writer_queues],
+        "backup": dict(_backup_stats)
+    }
@@ -1,3 +1,6 @@
+import asyncio
+import logging
+import time
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
@@ -5,21 +8,58 @@ from fastapi.responses import HTMLResponse
 from contextlib import asynccontextmanager
 
 from .database.session import engine
-from .models.base import Base
-from .api.endpoints import device, user, auth
-from .core.initializer import initialize_database
-from .core.logging import setup_logging
+from .api.endpoints import device, user, auth, metrics, transactions, stats, ledger, backup, site
+from .core.initializer import ensure_schema, initialize_database, startup_phase
+from .core.auth import shutdown_hash_pool
+from .core.integrity import run_ledger_sealer
+from .core.reconcile import run_nightly_reconciliation
+from .core.idempotency import run_idempotency_sweeper
+from .core.logging import setup_logging, shutdown_logging
+from .core.sites import start_site_hubs, stop_site_hubs
+from .core.device_table import close_device_table, load_device_table
+from .database.instrumentation import debug_headers, track_queries
+from .database.replica import ReplicaSessionLocal, note_write, run_replica_monitor
+from .database.sqlite import run_sqlite_backups, sqlite_path
 from .config import settings
 
+logger = logging.getLogger(__name__)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    started = time.perf_counter()
     # Set up logging
     setup_logging()
     
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    await initialize_database()
+    with startup_phase("schema check"):
+        if await ensure_schema(engine):
+            logger.info("Startup: schema changed, tables and indexes created")
+    with startup_phase("database initialization"):
+        await initialize_database()
+    with startup_phase("device table"):
+        await load_device_table()
+    
+    background_tasks = []
+    if settings.LEDGER_SEAL_INTERVAL_SECONDS:
+        background_tasks.append(asyncio.create_task(run_ledger_sealer()))
+    if settings.RECONCILE_ENABLED:
+        background_tasks.append(asyncio.create_task(run_nightly_reconciliation()))
+    if settings.IDEMPOTENCY_SWEEP_INTERVAL_SECONDS:
+        background_tasks.append(asyncio.create_task(run_idempotency_sweeper()))
+    if ReplicaSessionLocal is not None:
+        background_tasks.append(asyncio.create_task(run_replica_monitor()))
+    if sqlite_path(settings.DATABASE_URL) and settings.SQLITE_BACKUP_INTERVAL_HOURS:
+        background_tasks.append(asyncio.create_task(run_sqlite_backups()))
+    owned_sites = start_site_hubs()
+    logger.info("Startup: worker %d of %d owns sites %s", settings.SITE_WORKER_INDEX, settings.SITE_WORKER_COUNT,
+                ", ".join(owned_sites) or "none")
+    logger.info("Startup: ready after %.1f ms", (time.perf_counter() - started) * 1000)
     yield
+    for task in background_tasks:
+        task.cancel()
+    stop_site_hubs()
+    close_device_table()
+    shutdown_hash_pool()
+    shutdown_logging()
 
 app = FastAPI(lifespan=lifespan)
 templates = Jinja2Templates(directory="HTML")
@@ -31,12 +71,48 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "X-DB-Query-Count", "X-DB-Time-Ms", "X-DB-Slowest-Ms",
+                    "X-DB-N-Plus-One", "X-Last-Write"],
 )
 
+@app.middleware("http")
+async def instrument_queries(request: Request, call_next):
+    """Count the queries of each request, aggregated per route for /metrics/queries"""
+    with track_queries() as stats:
+        response = await call_next(request)
+        stats.name = _route_name(request)
+    if settings.QUERY_DEBUG_HEADERS:
+        response.headers.update(debug_headers(stats))
+    return response
+
+@app.middleware("http")
+async def track_writes(request: Request, call_next):
+    """Remember clients that wrote, their next reads stay on the primary (read-after-write)"""
+    response = await call_next(request)
+    note_write(request, response)
+    return response
+
+def _route_name(request: Request) -> str:
+    # Group by route template so /device/1 and /device/2 count as the same endpoint.
+    # Routes of included routers may only know their own part of the path, the prefix is taken from the URL.
+    route = request.scope.get("route")
+    if route is None:
+        return "unmatched"
+    route_segments = route.path.strip("/").count("/") + 1 if route.path.strip("/") else 0
+    segments = request.url.path.strip("/").split("/")
+    prefix = "/".join(segments[:len(segments) - route_segments])
+    return f"{request.method} {'/' + prefix if prefix else ''}{route.path}"
+
 # Include routers
 app.include_router(auth.router, prefix="/auth", tags=["auth"])
 app.include_router(device.router, prefix="/device", tags=["device"])
 app.include_router(user.router, prefix="/user", tags=["user"])
+app.include_router(metrics.router, prefix="/metrics", tags=["metrics"])
+app.include_router(transactions.router, prefix="/transactions", tags=["transactions"])
+app.include_router(stats.router, prefix="/stats", tags=["stats"])
+app.include_router(ledger.router, prefix="/ledger", tags=["ledger"])
+app.include_router(backup.router, prefix="/backup", tags=["backup"])
+app.include_router(site.router, prefix="/site", tags=["site"])
 
 # Add HTML routes
 @app.get("/", response_class=HTMLResponse)
@@ -3,6 +3,9 @@ from datetime import datetime, timezone
 
 from .base import Base
 
+# Site of devices that don't name one
+DEFAULT_SITE = "main"
+
 class Device(Base):
     __tablename__ = "device"
     
@@ -10,11 +13,14 @@ class Device(Base):
     name = Column(String(255), nullable=False)
     type = Column(String(50), nullable=False)
     hourly_cost = Column(Float, nullable=False)
+    site = Column(String(64), nullable=False, default=DEFAULT_SITE, index=True)
     user_id = Column(Integer, ForeignKey("user.uid"), nullable=True)
     end_time = Column(DateTime, nullable=True)
 
     def _tojson(self):
+        # end_time is stored as naive UTC, it is always sent marked as UTC
         time_left = 0
+        end_time = None
         if self.end_time:
             if self.end_time.tzinfo is None:
                 end_time = self.end_time.replace(tzinfo=timezone.utc)
@@ -27,7 +33,8 @@ class Device(Base):
             "name": self.name,
             "type": self.type,
             "hourly_cost": self.hourly_cost,
+            "site": self.site,
             "user_id": self.user_id,
-            "end_time": self.end_time.isoformat() if self.end_time else None,
+            "end_time": end_time.isoformat() if end_time else None,
             "time_left": time_left
         }
@@ -8,6 +8,9 @@ class IdempotencyKey(Base):
     
     key = Column(String(255), primary_key=True)
     endpoint = Column(String(255), nullable=False)
+    # request_fingerprint of the caller and arguments, a reused key must match it
+    fingerprint = Column(String(64), nullable=False, default="")
     response = Column(String(1024), nullable=False)
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
-    expires_at = Column(DateTime, nullable=False)
\ No newline at end of file
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    # Indexed for the sweeper, which deletes expired keys in batches
+    expires_at = Column(DateTime, nullable=False, index=True)
\ No newline at end of file
@@ -0,0 +1,77 @@
+from sqlalchemy import Column, Integer, Numeric, String, DateTime, Index
+from datetime import datetime, timezone
+
+from .base import Base
+
+class LedgerKind:
+    DEVICE_PAYMENT = "DEVICE_PAYMENT"
+    DEVICE_REFUND = "DEVICE_REFUND"
+    CASH_UPDATE = "CASH_UPDATE"
+
+class LedgerEntry(Base):
+    """Append-only record of a single balance change. Rows are never updated or deleted."""
+    __tablename__ = "ledger"
+    __table_args__ = (
+        # Serves per-user history pages newest first, id breaks ties within the same timestamp
+        Index("ix_ledger_user_timestamp", "user_id", "timestamp", "id"),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    # No foreign keys, ledger rows have to outlive deleted users and devices
+    user_id = Column(Integer, nullable=False)
+    device_id = Column(Integer, nullable=True)
+    kind = Column(String(32), nullable=False)
+    amount = Column(Numeric(10, 2), nullable=False)
+    balance_after = Column(Numeric(10, 2), nullable=False)
+    actor_id = Column(Integer, nullable=True)
+    timestamp = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    request_id = Column(String(64), nullable=True)
+    # Filled in when the entry is sealed: position in the hash chain and the chained hash
+    seq = Column(Integer, nullable=True, unique=True)
+    entry_hash = Column(String(64), nullable=True)
+
+    def _tojson(self):
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "device_id": self.device_id,
+            "kind": self.kind,
+            "amount": float(self.amount),
+            "balance_after": float(self.balance_after),
+            "actor_id": self.actor_id,
+            "timestamp": self.timestamp.isoformat() if self.timestamp else None,
+            "request_id": self.request_id,
+            "seq": self.seq,
+            "entry_hash": self.entry_hash
+        }
+
+class LedgerMerkleNode(Base):
+    """
+    Complete node of the Merkle tree over sealed ledger entries. The node at (level, idx)
+    covers entries with seq in [idx * 2**level, (idx + 1) * 2**level). Level 0 holds the
+    entry hashes. Nodes are only written once all entries below them are sealed.
+    """
+    __tablename__ = "ledger_merkle_node"
+
+    level = Column(Integer, primary_key=True)
+    idx = Column(Integer, primary_key=True)
+    hash = Column(String(64), nullable=False)
+
+class LedgerCheckpoint(Base):
+    """Merkle root over the first tree_size sealed ledger entries"""
+    __tablename__ = "ledger_checkpoint"
+
+    id = Column(Integer, primary_key=True)
+    tree_size = Column(Integer, nullable=False, unique=True)
+    last_entry_id = Column(Integer, nullable=False)
+    root_hash = Column(String(64), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    def _tojson(self):
+        return {
+            "id": self.id,
+            "tree_size": self.tree_size,
+            "last_entry_id": self.last_entry_id,
+            "root_hash": self.root_hash,
+            "created_at": self.created_at.isoformat() if self.created_at else None
+        }
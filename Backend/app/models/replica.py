@@ -0,0 +1,10 @@
+from sqlalchemy import Column, Integer, DateTime
+
+from .base import Base
+
+class ReplicaHeartbeat(Base):
+    """Single row the primary updates regularly, its age on the replica is the replication lag"""
+    __tablename__ = "replica_heartbeat"
+
+    id = Column(Integer, primary_key=True)
+    beat_at = Column(DateTime, nullable=False)
@@ -0,0 +1,12 @@
+from sqlalchemy import Column, Integer, String, DateTime
+from datetime import datetime, timezone
+
+from .base import Base
+
+class SchemaVersion(Base):
+    """Fingerprint of the models the tables were last created from, lets startup skip the DDL"""
+    __tablename__ = "schema_version"
+
+    id = Column(Integer, primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
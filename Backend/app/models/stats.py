@@ -0,0 +1,35 @@
+from sqlalchemy import Column, Integer, Numeric, String, DateTime, Float
+
+from .base import Base
+
+class UsageRollup(Base):
+    """
+    Running totals of device usage per scope (device, device type or user) and time bucket.
+    Rows are incremented as devices are started and refunded, never recomputed.
+    """
+    __tablename__ = "usage_rollup"
+    
+    # Primary key order serves "all keys of a scope and period in a time range"
+    scope = Column(String(16), primary_key=True)
+    period = Column(String(8), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    key = Column(String(64), primary_key=True)
+    run_count = Column(Integer, nullable=False, default=0)
+    minutes = Column(Float, nullable=False, default=0)
+    revenue = Column(Numeric(12, 2), nullable=False, default=0)
+    refunds = Column(Numeric(12, 2), nullable=False, default=0)
+    refunded_minutes = Column(Float, nullable=False, default=0)
+
+    def _tojson(self):
+        return {
+            "scope": self.scope,
+            "period": self.period,
+            "bucket_start": self.bucket_start.isoformat(),
+            "key": self.key,
+            "run_count": self.run_count,
+            "minutes": self.minutes,
+            "revenue": float(self.revenue),
+            "refunds": float(self.refunds),
+            "refunded_minutes": self.refunded_minutes,
+            "net_revenue": round(float(self.revenue) - float(self.refunds), 2)
+        }
@@ -0,0 +1,38 @@
+from sqlalchemy import Column, Integer, Numeric, DateTime, Index
+
+from .base import Base
+
+class UsageSession(Base):
+    """One run of a device. Kept after the device itself is reset."""
+    __tablename__ = "usage_session"
+    __table_args__ = (
+        # Overlap queries: start_time < window end and end_time > window start
+        Index("ix_usage_session_device_start", "device_id", "start_time"),
+        Index("ix_usage_session_start_end", "start_time", "end_time"),
+        Index("ix_usage_session_user_start", "user_id", "start_time"),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    device_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    start_time = Column(DateTime, nullable=False)
+    planned_end = Column(DateTime, nullable=False)
+    # Set when the device is stopped early, runs that finish normally end at planned_end
+    actual_end = Column(DateTime, nullable=True)
+    # actual_end if set, otherwise planned_end. Stored so overlap queries can use an index.
+    end_time = Column(DateTime, nullable=False)
+    cost = Column(Numeric(10, 2), nullable=False)
+    refund = Column(Numeric(10, 2), nullable=False, default=0)
+
+    def _tojson(self):
+        return {
+            "id": self.id,
+            "device_id": self.device_id,
+            "user_id": self.user_id,
+            "start_time": self.start_time.isoformat(),
+            "planned_end": self.planned_end.isoformat(),
+            "actual_end": self.actual_end.isoformat() if self.actual_end else None,
+            "end_time": self.end_time.isoformat(),
+            "cost": float(self.cost),
+            "refund": float(self.refund or 0)
+        }
@@ -7,7 +7,7 @@ class User(Base):
     __tablename__ = "user"
     
     uid = Column(Integer, primary_key=True, index=True)
-    name = Column(String(255))
+    name = Column(String(255), unique=True, index=True)
     cash = Column(Numeric(10, 2))
     creation_time = Column(DateTime, default=datetime.now(timezone.utc))
     hashed_password = Column(String(255))
@@ -7,6 +7,7 @@ class DeviceResponse(BaseModel):
     name: str
     type: str
     hourly_cost: float
+    site: Optional[str] = None
     user_id: Optional[int] = None
     end_time: Optional[datetime] = None
     time_left: Optional[float] = None
@@ -18,3 +19,17 @@ class DeviceStatusResponse(BaseModel):
     device_id: int
     running: bool
     end_time: Optional[datetime]
+
+class UsageSessionResponse(BaseModel):
+    id: int
+    device_id: int
+    user_id: int
+    start_time: datetime
+    planned_end: datetime
+    actual_end: Optional[datetime] = None
+    end_time: datetime
+    cost: float
+    refund: float
+
+    class Config:
+        orm_mode = True
@@ -0,0 +1,17 @@
+from pydantic import BaseModel
+from datetime import datetime
+from typing import Optional
+
+class LedgerEntryResponse(BaseModel):
+    id: int
+    user_id: int
+    device_id: Optional[int] = None
+    kind: str
+    amount: float
+    balance_after: float
+    actor_id: Optional[int] = None
+    timestamp: datetime
+    request_id: Optional[str] = None
+
+    class Config:
+        orm_mode = True
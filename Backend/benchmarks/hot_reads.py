@@ -0,0 +1,133 @@
+"""
+Throughput of the hot read endpoints, GET /device/all and GET /user/all.
+
+    python -m benchmarks.hot_reads --users 1000 --requests 500 --concurrency 10
+
+Run it from the Backend directory. Without --url a temporary SQLite file is used, otherwise point
+it at a scratch database, the benchmark creates the tables, the users and the devices in it.
+Requests go through the whole app in process (ASGI transport, no network), in a child process so
+the engine is created from the given DATABASE_URL.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+RESULT_PREFIX = "RESULT "
+PATHS = ["/device/all", "/user/all"]
+
+
+async def _run(users: int, requests: int, concurrency: int) -> dict:
+    from httpx import ASGITransport, AsyncClient
+    from sqlalchemy import func, insert, select
+
+    from app.main import app
+    from app.core.auth import get_password_hash
+    from app.database.session import AsyncSessionLocal
+    from app.models.user import User
+
+    async with app.router.lifespan_context(app):
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(select(User).where(User.name == "benchmark"))
+            if result.scalars().first() is None:
+                session.add(User(name="benchmark", hashed_password=get_password_hash("benchmark"), is_admin=True,
+                                 cash=0))
+            count = (await session.execute(select(func.count()).select_from(User))).scalar()
+            if count < users:
+                # Hashing once is enough, nobody logs in as these users
+                hashed_password = get_password_hash("benchmark")
+                await session.execute(insert(User), [
+                    {"name": f"bench-{uuid.uuid4().hex[:12]}", "cash": 50, "hashed_password": hashed_password}
+                    for _ in range(users - count)
+                ])
+            await session.commit()
+
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://bench") as ac:
+            login_response = await ac.post("/auth/token", data={"username": "benchmark", "password": "benchmark"})
+            headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+            results = {}
+
+            for path in PATHS:
+                latencies = []
+                remaining = requests
+
+                async def worker():
+                    nonlocal remaining
+                    while remaining > 0:
+                        remaining -= 1
+                        started = time.perf_counter()
+                        response = await ac.get(path, headers=headers)
+                        latencies.append(time.perf_counter() - started)
+                        if response.status_code != 200:
+                            raise RuntimeError(f"{path} failed: {response.status_code} {response.text}")
+
+                started = time.perf_counter()
+                await asyncio.gather(*(worker() for _ in range(concurrency)))
+                elapsed = time.perf_counter() - started
+
+                latencies.sort()
+                def percentile(p):
+                    return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2)
+                results[path] = {
+                    "requests": len(latencies),
+                    "requests_per_second": round(len(latencies) / elapsed, 1),
+                    "p50_ms": percentile(0.50),
+                    "p99_ms": percentile(0.99)
+                }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="database URL")
+    parser.add_argument("--users", type=int, default=1000, help="users in the database")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(RESULT_PREFIX + json.dumps(asyncio.run(_run(args.users, args.requests, args.concurrency))), flush=True)
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(
+            os.environ,
+            DATABASE_URL=args.url or f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}",
+            TRANSACTION_LOG_PATH=os.path.join(workdir, "transactions.log"),
+            # Only the requests should touch the database, and a running app's device table is left alone
+            LEDGER_SEAL_INTERVAL_SECONDS="0",
+            RECONCILE_ENABLED="false",
+            IDEMPOTENCY_SWEEP_INTERVAL_SECONDS="0",
+            SQLITE_BACKUP_INTERVAL_HOURS="0",
+            DEVICE_TABLE_NAME=f"waschplan-bench-{os.getpid()}",
+        )
+        child = subprocess.run(
+            [sys.executable, "-m", "benchmarks.hot_reads", "--child", "--users", str(args.users),
+             "--requests", str(args.requests), "--concurrency", str(args.concurrency)],
+            env=env, capture_output=True, text=True
+        )
+        _unlink_device_table(env["DEVICE_TABLE_NAME"])
+        results = [line for line in child.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+        if child.returncode != 0 or not results:
+            raise RuntimeError(f"Benchmark failed:\n{child.stderr[-2000:]}")
+
+    print(f"{'endpoint':<14}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for path, result in json.loads(results[-1][len(RESULT_PREFIX):]).items():
+        print(f"{path:<14}{result['requests']:>10}{result['requests_per_second']:>10}"
+              f"{result['p50_ms']:>10}{result['p99_ms']:>10}")
+
+def _unlink_device_table(name: str):
+    from multiprocessing import shared_memory
+    try:
+        shared_memory.SharedMemory(name=name).unlink()
+    except FileNotFoundError:
+        pass
+
+
+if __name__ == "__main__":
+    main()
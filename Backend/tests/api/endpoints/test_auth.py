@@ -210,3 +210,37 @@ async def test_user_with_keycard_can_use_password(test_app, test_session_factory
         assert response.status_code == 200
         data = response.json()
         assert "access_token" in data
+
+@pytest.mark.asyncio
+async def test_login_throttled_per_account(test_app, test_user):
+    from app.core.ratelimit import account_limiter, get_throttle_stats
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        # Use up the account's burst with wrong passwords
+        for _ in range(int(account_limiter.capacity)):
+            response = await ac.post(
+                "/auth/token",
+                data={"username": "testuser", "password": "wrongpassword"},
+                headers={"Content-Type": "application/x-www-form-urlencoded"}
+            )
+            assert response.status_code == 401
+
+        # Even the correct password is rejected before it is verified
+        response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+        assert response.json()["detail"] == "Too many login attempts"
+        assert get_throttle_stats()["account"]["rejected"] == 1
+
+        # Other accounts are not affected
+        response = await ac.post(
+            "/auth/token",
+            data={"username": "someoneelse", "password": "anypassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        assert response.status_code == 401
@@ -1,12 +1,20 @@
+import asyncio
+import json
 import pytest
+from typing import List
 from httpx import AsyncClient
+from pydantic import TypeAdapter
 from datetime import datetime, timezone, timedelta
 from sqlalchemy import text, select
 from app.main import app
 from app.models.device import Device
 from app.models.user import User
+from app.models.ledger import LedgerEntry, LedgerKind
+from app.models.idempotency import IdempotencyKey
 from app.core.auth import get_password_hash
-from app.config import DEVICES
+from app.core.idempotency import request_fingerprint
+from app.config import DEVICES, settings
+from app.schemas.device import DeviceResponse
 
 
 ####################GET /all ENDPOINT####################
@@ -75,6 +83,36 @@ async def test_get_all_devices(test_app, test_user, test_session_factory):
         assert "time_left" in active_device_data
         assert active_device_data["time_left"] > 0
 
+@pytest.mark.asyncio
+async def test_get_all_devices_matches_response_model(test_app, test_user, test_session_factory):
+    """The fast JSON path sends what DeviceResponse describes"""
+    async with test_session_factory() as session:
+        session.add(Device(id=1, name="Idle", type="washer", hourly_cost=1.2))
+        session.add(Device(id=2, name="Running", type="dryer", hourly_cost=1.5, user_id=test_user.uid,
+                           end_time=datetime.now(timezone.utc) + timedelta(minutes=30)))
+        await session.commit()
+
+    adapter = TypeAdapter(List[DeviceResponse])
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+
+        response = await ac.get("/device/all", headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/json"
+        devices = response.json()
+        # Every field of the model is sent and valid. Aware end times keep "+00:00", the model would write "Z".
+        adapter.validate_python(devices)
+        assert [set(device) for device in devices] == [set(DeviceResponse.model_fields)] * 2
+        assert devices[1]["user_id"] == test_user.uid
+
+        response = await ac.get("/device/2", headers=headers)
+        assert response.json()["end_time"] == devices[1]["end_time"]
+
 @pytest.mark.asyncio
 async def test_get_all_devices_unauthorized(test_app):
     # Try to get devices without authentication
@@ -255,6 +293,17 @@ async def test_start_device_invalid_duration(test_app, test_user):
         data = response.json()
         assert "detail" in data
         assert "Duration must be positive" in data["detail"]
+        
+        # No run may outlast MAX_RUN_MINUTES, session lookups rely on that bound
+        response = await ac.post(
+            f"/device/start/{device_id}",
+            json={
+                "user_id": test_user.uid,
+                "duration_minutes": settings.MAX_RUN_MINUTES + 1
+            },
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == 400
 
 @pytest.mark.asyncio
 async def test_start_device_already_in_use(test_app, test_user, test_session_factory):
@@ -520,6 +569,21 @@ async def test_stop_device_not_owner_not_admin(test_app, test_user, test_session
         data = response.json()
         assert "detail" in data
         assert "Not authorized to stop this device" in data["detail"]
+        
+        # Also before a response stored under the key could be returned
+        async with test_session_factory() as session:
+            session.add(IdempotencyKey(
+                key="stop-key", endpoint="stop_device",
+                fingerprint=request_fingerprint(test_user.uid, device_id=device_id),
+                response=json.dumps({"message": "Device stopped successfully"}),
+                expires_at=datetime.utcnow() + timedelta(hours=1)
+            ))
+            await session.commit()
+        response = await ac.post(
+            f"/device/stop/{device_id}",
+            headers={"Authorization": f"Bearer {token}", "X-Idempotency-Key": "stop-key"}
+        )
+        assert response.status_code == 403
 
 @pytest.mark.asyncio
 async def test_stop_device_invalid_id(test_app, test_user, test_session_factory):
@@ -670,6 +734,277 @@ async def test_stop_device_refund(test_app, test_user, test_session_factory):
         assert updated_user.cash == expected_cash
 
 
+@pytest.mark.asyncio
+async def test_start_stop_device_writes_ledger(test_app, test_user, test_session_factory):
+    device_id = 1
+    
+    async with test_session_factory() as session:
+        await session.execute(text("DELETE FROM device"))
+        session.add(Device(id=device_id, name="Test Device", type="test", hourly_cost=10.0))
+        await session.commit()
+    
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        
+        token = login_response.json()["access_token"]
+        
+        response = await ac.post(
+            f"/device/start/{device_id}",
+            json={"user_id": test_user.uid, "duration_minutes": 30},
+            headers={"Authorization": f"Bearer {token}", "X-Request-ID": "start-1"}
+        )
+        assert response.status_code == 200
+        
+        response = await ac.post(
+            f"/device/stop/{device_id}",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == 200
+        refund_amount = response.json()["refund_amount"]
+    
+    async with test_session_factory() as session:
+        result = await session.execute(select(LedgerEntry).order_by(LedgerEntry.id))
+        entries = result.scalars().all()
+        assert [e.kind for e in entries] == [LedgerKind.DEVICE_PAYMENT, LedgerKind.DEVICE_REFUND]
+        
+        payment, refund = entries
+        assert payment.user_id == test_user.uid
+        assert payment.device_id == device_id
+        assert payment.actor_id == test_user.uid
+        assert payment.request_id == "start-1"
+        assert float(payment.amount) == -5.0
+        assert float(payment.balance_after) == 95.0
+        assert float(refund.amount) == refund_amount
+        assert refund.request_id is not None
+        
+        result = await session.execute(select(User).where(User.uid == test_user.uid))
+        assert result.scalars().first().cash == refund.balance_after
+
+
+@pytest.mark.asyncio
+async def test_start_stop_device_records_usage_session(test_app, test_user, test_session_factory):
+    device_id = 1
+    
+    async with test_session_factory() as session:
+        await session.execute(text("DELETE FROM device"))
+        await session.execute(text("DELETE FROM usage_session"))
+        session.add(Device(id=device_id, name="Test Device", type="test", hourly_cost=10.0))
+        session.add(User(name="otheruser", hashed_password=get_password_hash("otherpassword"), cash=100.0))
+        await session.commit()
+    
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        token = login_response.json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        
+        response = await ac.post(
+            f"/device/start/{device_id}",
+            json={"user_id": test_user.uid, "duration_minutes": 30},
+            headers=headers
+        )
+        assert response.status_code == 200
+        
+        # The run is active now
+        now = datetime.now(timezone.utc).isoformat()
+        response = await ac.get("/device/sessions", params={"at": now}, headers=headers)
+        assert response.status_code == 200
+        sessions = response.json()
+        assert len(sessions) == 1
+        assert sessions[0]["device_id"] == device_id
+        assert sessions[0]["cost"] == 5.0
+        assert sessions[0]["actual_end"] is None
+        
+        response = await ac.post(f"/device/stop/{device_id}", headers=headers)
+        assert response.status_code == 200
+        refund_amount = response.json()["refund_amount"]
+        
+        # Stopped early: the run ends now and keeps its planned end
+        response = await ac.get("/device/sessions", params={"device_id": device_id}, headers=headers)
+        sessions = response.json()
+        assert len(sessions) == 1
+        assert sessions[0]["actual_end"] is not None
+        assert sessions[0]["end_time"] == sessions[0]["actual_end"]
+        assert sessions[0]["planned_end"] > sessions[0]["end_time"]
+        assert sessions[0]["refund"] == refund_amount
+        
+        later = (datetime.now(timezone.utc) + timedelta(minutes=10)).isoformat()
+        response = await ac.get("/device/sessions", params={"at": later}, headers=headers)
+        assert response.json() == []
+        
+        # Non-admins only see their own runs
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "otheruser", "password": "otherpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        other_headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        response = await ac.get("/device/sessions", headers=other_headers)
+        assert response.status_code == 200
+        assert response.json() == []
+        response = await ac.get("/device/sessions", params={"user_id": test_user.uid}, headers=other_headers)
+        assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_start_stop_device_idempotent_retry(test_app, test_user, test_session_factory):
+    device_id = 1
+    
+    async with test_session_factory() as session:
+        await session.execute(text("DELETE FROM device"))
+        session.add(Device(id=device_id, name="Test Device", type="test", hourly_cost=10.0))
+        await session.commit()
+    
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        token = login_response.json()["access_token"]
+        
+        # The kiosk retries the same start after a timeout
+        headers = {"Authorization": f"Bearer {token}", "X-Idempotency-Key": "start-key"}
+        first = await ac.post(
+            f"/device/start/{device_id}",
+            json={"user_id": test_user.uid, "duration_minutes": 30},
+            headers=headers
+        )
+        second = await ac.post(
+            f"/device/start/{device_id}",
+            json={"user_id": test_user.uid, "duration_minutes": 30},
+            headers=headers
+        )
+        assert first.status_code == 200
+        assert second.status_code == 200
+        assert second.json() == first.json()
+        
+        headers = {"Authorization": f"Bearer {token}", "X-Idempotency-Key": "stop-key"}
+        first = await ac.post(f"/device/stop/{device_id}", headers=headers)
+        second = await ac.post(f"/device/stop/{device_id}", headers=headers)
+        assert first.status_code == 200
+        assert second.status_code == 200
+        assert second.json()["refund_amount"] == first.json()["refund_amount"]
+        
+        # A key can't be reused for another kind of request
+        response = await ac.post(
+            f"/device/start/{device_id}",
+            json={"user_id": test_user.uid, "duration_minutes": 30},
+            headers=headers
+        )
+        assert response.status_code == 422
+    
+    async with test_session_factory() as session:
+        result = await session.execute(select(LedgerEntry).order_by(LedgerEntry.id))
+        assert [e.kind for e in result.scalars().all()] == [LedgerKind.DEVICE_PAYMENT, LedgerKind.DEVICE_REFUND]
+        
+        result = await session.execute(select(User).where(User.uid == test_user.uid))
+        assert float(result.scalars().first().cash) == 95.0 + first.json()["refund_amount"]
+
+
+@pytest.mark.asyncio
+async def test_start_device_concurrent_duplicates_run_once(test_app, test_user, test_session_factory):
+    device_id = 1
+    
+    async with test_session_factory() as session:
+        await session.execute(text("DELETE FROM device"))
+        session.add(Device(id=device_id, name="Test Device", type="test", hourly_cost=10.0))
+        await session.commit()
+    
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        token = login_response.json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}", "X-Idempotency-Key": "storm-key"}
+        
+        # A retry storm while the first attempt is still running
+        responses = await asyncio.gather(*(
+            ac.post(
+                f"/device/start/{device_id}",
+                json={"user_id": test_user.uid, "duration_minutes": 30},
+                headers=headers
+            )
+            for _ in range(5)
+        ))
+        assert [response.status_code for response in responses] == [200] * 5
+        assert all(response.json() == responses[0].json() for response in responses)
+    
+    async with test_session_factory() as session:
+        result = await session.execute(select(LedgerEntry))
+        assert len(result.scalars().all()) == 1
+        result = await session.execute(select(User).where(User.uid == test_user.uid))
+        assert float(result.scalars().first().cash) == 95.0
+
+@pytest.mark.asyncio
+async def test_start_device_waits_for_other_worker(test_app, test_user, test_session_factory):
+    device_id = 1
+    stored = {"id": device_id, "name": "Test Device", "type": "test", "hourly_cost": 10.0, "site": "main",
+              "user_id": test_user.uid, "end_time": None, "time_left": 30}
+    
+    async with test_session_factory() as session:
+        await session.execute(text("DELETE FROM device"))
+        session.add(Device(id=device_id, name="Test Device", type="test", hourly_cost=10.0))
+        # Another worker is running a request with this key, and one died while holding a key
+        fingerprint = request_fingerprint(
+            test_user.uid, device_id=device_id, body={"user_id": test_user.uid, "duration_minutes": 30}
+        )
+        session.add(IdempotencyKey(key="busy-key", endpoint="start_device", fingerprint=fingerprint, response="",
+                                   expires_at=datetime.utcnow() + timedelta(seconds=30)))
+        session.add(IdempotencyKey(key="stale-key", endpoint="start_device", response="",
+                                   expires_at=datetime.utcnow() - timedelta(seconds=1)))
+        await session.commit()
+    
+    async def finish_other_worker():
+        await asyncio.sleep(0.2)
+        async with test_session_factory() as session:
+            await session.execute(
+                text("UPDATE idempotency_keys SET response = :response WHERE key = 'busy-key'"),
+                {"response": json.dumps(stored)}
+            )
+            await session.commit()
+    
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        token = login_response.json()["access_token"]
+        
+        response, _ = await asyncio.gather(
+            ac.post(
+                f"/device/start/{device_id}",
+                json={"user_id": test_user.uid, "duration_minutes": 30},
+                headers={"Authorization": f"Bearer {token}", "X-Idempotency-Key": "busy-key"}
+            ),
+            finish_other_worker()
+        )
+        assert response.status_code == 200
+        assert response.json() == stored
+        
+        # The stale marker is taken over and the request runs
+        response = await ac.post(
+            f"/device/start/{device_id}",
+            json={"user_id": test_user.uid, "duration_minutes": 30},
+            headers={"Authorization": f"Bearer {token}", "X-Idempotency-Key": "stale-key"}
+        )
+        assert response.status_code == 200
+        assert response.json()["time_left"] > 0
+    
+    async with test_session_factory() as session:
+        result = await session.execute(select(LedgerEntry))
+        assert len(result.scalars().all()) == 1
+
 
 ####################GET /{device_id} ENDPOINT####################
 @pytest.mark.asyncio
@@ -0,0 +1,179 @@
+import hashlib
+import pytest
+from datetime import datetime, timedelta
+from httpx import AsyncClient
+from sqlalchemy import select, text
+
+from app.models.user import User
+from app.models.ledger import LedgerEntry, LedgerKind
+from app.core.integrity import GENESIS_HASH, get_inclusion_proof, hash_entry, root_from_path, seal_ledger
+
+
+def _naive_root(leaves):
+    # RFC 6962 Merkle tree hash, computed the slow way
+    if len(leaves) == 1:
+        return leaves[0]
+    split = 1 << ((len(leaves) - 1).bit_length() - 1)
+    left, right = _naive_root(leaves[:split]), _naive_root(leaves[split:])
+    return hashlib.sha256(b"\x01" + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+async def _add_entries(session, count, user_id=1, start=datetime(2024, 3, 1, 10, 0)):
+    for i in range(count):
+        session.add(LedgerEntry(
+            user_id=user_id, device_id=1, kind=LedgerKind.DEVICE_PAYMENT, amount=-1.5,
+            balance_after=100 - i, actor_id=user_id, timestamp=start + timedelta(minutes=i)
+        ))
+    await session.commit()
+
+async def _admin_token(ac, test_session_factory, test_user):
+    async with test_session_factory() as session:
+        result = await session.execute(select(User).where(User.uid == test_user.uid))
+        user = result.scalars().first()
+        user.is_admin = True
+        await session.commit()
+
+    login_response = await ac.post(
+        "/auth/token",
+        data={"username": "testuser", "password": "testpassword"},
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    return login_response.json()["access_token"]
+
+####################SEALING####################
+@pytest.mark.asyncio
+async def test_seal_ledger_matches_rfc6962_tree(test_session_factory):
+    async with test_session_factory() as session:
+        # Seal in uneven batches so nodes are built on top of older incomplete trees
+        for batch in [1, 2, 4, 3, 7, 1]:
+            await _add_entries(session, batch)
+            checkpoint = await seal_ledger(session)
+
+            result = await session.execute(select(LedgerEntry).order_by(LedgerEntry.seq))
+            entries = result.scalars().all()
+            assert [entry.seq for entry in entries] == list(range(len(entries)))
+            assert checkpoint.tree_size == len(entries)
+            assert checkpoint.root_hash == _naive_root([entry.entry_hash for entry in entries])
+
+        # The chain links every entry to the one before it
+        prev_hash = GENESIS_HASH
+        for entry in entries:
+            assert entry.entry_hash == hash_entry(prev_hash, entry)
+            prev_hash = entry.entry_hash
+
+        # Every entry has a short audit path to the latest root
+        for entry in entries:
+            proof = await get_inclusion_proof(session, entry, checkpoint)
+            assert proof["valid"]
+            assert len(proof["path"]) <= checkpoint.tree_size.bit_length()
+            assert root_from_path(entry.entry_hash, proof["path"]) == checkpoint.root_hash
+
+        assert await seal_ledger(session) is None
+
+####################GET /verify ENDPOINT####################
+@pytest.mark.asyncio
+async def test_verify_detects_tampering(test_app, test_user, test_session_factory):
+    async with test_session_factory() as session:
+        await _add_entries(session, 5, user_id=42)
+        await _add_entries(session, 5, user_id=7, start=datetime(2024, 3, 2, 10, 0))
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        token = await _admin_token(ac, test_session_factory, test_user)
+        headers = {"Authorization": f"Bearer {token}"}
+
+        response = await ac.post("/ledger/checkpoints", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["tree_size"] == 10
+
+        response = await ac.get("/ledger/verify", params={"user_id": 42}, headers=headers)
+        data = response.json()
+        assert data["valid"] is True
+        assert data["checked"] == 5
+
+        # A balance edited behind the ledger's back
+        async with test_session_factory() as session:
+            await session.execute(text("UPDATE ledger SET amount = 50 WHERE user_id = 42 AND seq = 2"))
+            await session.commit()
+            tampered_id = (await session.execute(select(LedgerEntry.id).where(LedgerEntry.seq == 2))).scalar()
+
+        response = await ac.get("/ledger/verify", params={"user_id": 42}, headers=headers)
+        data = response.json()
+        assert data["valid"] is False
+        assert tampered_id in [failure["entry_id"] for failure in data["failures"]]
+
+        response = await ac.get(f"/ledger/proof/{tampered_id}", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["valid"] is False
+
+        # The other user's entries are untouched
+        response = await ac.get("/ledger/verify", params={"user_id": 7}, headers=headers)
+        assert response.json()["valid"] is True
+
+        # Deleted entries show up when checking a time range
+        async with test_session_factory() as session:
+            await session.execute(text("DELETE FROM ledger WHERE seq = 7"))
+            await session.commit()
+        response = await ac.get(
+            "/ledger/verify", params={"start": "2024-03-02T00:00:00", "end": "2024-03-03T00:00:00"}, headers=headers
+        )
+        data = response.json()
+        assert data["valid"] is False
+        assert data["failures"][0]["seq"] == 7
+        assert data["failures"][0]["reason"] == "Entry missing"
+
+@pytest.mark.asyncio
+async def test_ledger_requires_admin(test_app, test_user):
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        token = login_response.json()["access_token"]
+
+        response = await ac.get("/ledger/verify", params={"user_id": 1}, headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 403
+
+####################RECONCILIATION####################
+@pytest.mark.asyncio
+async def test_reconciliation_reports_drift(test_app, test_user, test_session_factory):
+    async with test_session_factory() as session:
+        session.add_all([
+            User(uid=10, name="balanced", cash=7.5),
+            User(uid=11, name="drifted", cash=20),
+            User(uid=12, name="broken", cash=4),
+        ])
+        entries = [
+            # user, amount, balance after
+            (10, 10, 10), (10, -3, 7), (10, 0.5, 7.5),
+            (11, 10, 10), (11, -1.2, 8.8),
+            # A movement is missing between these two
+            (12, 5, 5), (12, -1, 4.5), (12, -0.5, 4),
+        ]
+        for i, (user_id, amount, balance_after) in enumerate(entries):
+            session.add(LedgerEntry(
+                user_id=user_id, kind=LedgerKind.CASH_UPDATE, amount=amount, balance_after=balance_after,
+                timestamp=datetime(2024, 3, 1, 10, 0) + timedelta(minutes=i)
+            ))
+        await session.commit()
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        token = await _admin_token(ac, test_session_factory, test_user)
+        headers = {"Authorization": f"Bearer {token}"}
+
+        response = await ac.post("/ledger/reconciliation", headers=headers)
+        assert response.status_code == 200
+        report = response.json()
+        assert report["movements"] == 8
+        assert report["users_checked"] == 4
+        assert report["users_without_movements"] == 1
+        assert report["drifted_users"] == 2
+
+        drift = {row["user_id"]: row for row in report["drift"]}
+        assert drift[11]["expected"] == 8.8
+        assert drift[11]["drift"] == pytest.approx(11.2)
+        assert drift[11]["chain_breaks"] == 0
+        assert drift[12]["chain_breaks"] == 1
+        assert 10 not in drift
+
+        response = await ac.get("/ledger/reconciliation", headers=headers)
+        assert response.json()["drift"] == report["drift"]
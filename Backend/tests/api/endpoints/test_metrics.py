@@ -0,0 +1,156 @@
+import pytest
+from datetime import datetime, timedelta
+from httpx import AsyncClient
+from sqlalchemy import select
+
+from app.models.user import User
+from app.models.device import Device
+from app.models.idempotency import IdempotencyKey
+from app.core.idempotency import sweep_expired_keys
+from app.database.instrumentation import get_query_stats, track_queries
+from app.core.logging import setup_logging, shutdown_logging, get_transaction_logger
+from app.config import settings
+
+
+async def _admin_token(ac, test_session_factory, test_user):
+    async with test_session_factory() as session:
+        result = await session.execute(select(User).where(User.uid == test_user.uid))
+        user = result.scalars().first()
+        user.is_admin = True
+        await session.commit()
+
+    login_response = await ac.post(
+        "/auth/token",
+        data={"username": "testuser", "password": "testpassword"},
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    return login_response.json()["access_token"]
+
+####################GET /logging ENDPOINT####################
+@pytest.mark.asyncio
+async def test_logging_metrics(test_app, test_user, test_session_factory, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    setup_logging()
+    try:
+        get_transaction_logger().transaction("CASH_UPDATE: test record")
+
+        async with AsyncClient(app=test_app, base_url="http://test") as ac:
+            token = await _admin_token(ac, test_session_factory, test_user)
+            response = await ac.get(
+                "/metrics/logging",
+                headers={"Authorization": f"Bearer {token}"}
+            )
+
+            assert response.status_code == 200
+            data = response.json()
+            assert data["running"] is True
+            assert data["dropped"] == 0
+            assert "backlog" in data
+    finally:
+        shutdown_logging()
+
+    # Queued records are written out on shutdown
+    lines = (tmp_path / "transactions.log").read_text().splitlines()
+    assert len(lines) == 1
+    assert lines[0].endswith("TRANSACTION - CASH_UPDATE: test record")
+
+@pytest.mark.asyncio
+async def test_logging_metrics_requires_admin(test_app, test_user):
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        token = login_response.json()["access_token"]
+
+        response = await ac.get(
+            "/metrics/logging",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == 403
+
+####################GET /idempotency ENDPOINT####################
+@pytest.mark.asyncio
+async def test_idempotency_metrics_and_sweeper(test_app, test_user, test_session_factory, monkeypatch):
+    monkeypatch.setattr(settings, "IDEMPOTENCY_SWEEP_BATCH_SIZE", 2)
+    monkeypatch.setattr(settings, "IDEMPOTENCY_SWEEP_PAUSE_MS", 0)
+    now = datetime.utcnow()
+    async with test_session_factory() as session:
+        for i in range(5):
+            session.add(IdempotencyKey(key=f"old-{i}", endpoint="start_device", response="{}",
+                                       expires_at=now - timedelta(hours=1)))
+        session.add(IdempotencyKey(key="fresh", endpoint="start_device", response="{}",
+                                   expires_at=now + timedelta(hours=1)))
+        await session.commit()
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        token = await _admin_token(ac, test_session_factory, test_user)
+        headers = {"Authorization": f"Bearer {token}"}
+
+        response = await ac.get("/metrics/idempotency", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["table"] == {"keys": 6, "expired": 5, "pending": 0}
+
+        # Five expired keys in batches of two
+        async with test_session_factory() as session:
+            assert await sweep_expired_keys(session) == 5
+
+        response = await ac.get("/metrics/idempotency", headers=headers)
+        data = response.json()
+        assert data["table"] == {"keys": 1, "expired": 0, "pending": 0}
+        assert data["sweeper"]["deleted"] >= 5
+
+####################GET /queries ENDPOINT####################
+@pytest.mark.asyncio
+async def test_query_metrics(test_app, test_user, test_session_factory, monkeypatch):
+    monkeypatch.setattr(settings, "QUERY_DEBUG_HEADERS", True)
+    async with test_session_factory() as session:
+        expired = datetime.now() - timedelta(minutes=5)
+        session.add_all([
+            Device(id=i, name=f"Device {i}", type="washer", hourly_cost=1.5,
+                   user_id=test_user.uid, end_time=expired)
+            for i in range(1, 6)
+        ])
+        await session.commit()
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        token = await _admin_token(ac, test_session_factory, test_user)
+        headers = {"Authorization": f"Bearer {token}"}
+
+        response = await ac.get("/device/all", headers=headers)
+        assert response.status_code == 200
+        # All expired devices are reset in one commit instead of one per device
+        assert response.headers["X-DB-N-Plus-One"] == "0"
+        assert int(response.headers["X-DB-Query-Count"]) < 5
+        assert float(response.headers["X-DB-Time-Ms"]) > 0
+
+        response = await ac.get("/metrics/queries", headers=headers)
+        routes = response.json()
+        assert routes["GET /device/all"]["calls"] == 1
+        assert routes["GET /device/all"]["n_plus_one_calls"] == 0
+
+        response = await ac.get("/device/1", headers=headers)
+        response = await ac.get("/device/2", headers=headers)
+        response = await ac.get("/metrics/queries", headers=headers)
+        assert response.json()["GET /device/{device_id}"]["calls"] == 2
+
+        response = await ac.delete("/metrics/queries", headers=headers)
+        assert response.status_code == 200
+        response = await ac.get("/metrics/queries", headers=headers)
+        assert "GET /device/all" not in response.json()
+
+@pytest.mark.asyncio
+async def test_track_queries_flags_n_plus_one(test_session_factory):
+    async with test_session_factory() as session:
+        with track_queries("loop") as stats:
+            for device_id in range(1, 6):
+                await session.execute(select(Device).where(Device.id == device_id))
+            await session.execute(select(User))
+
+    assert stats.count == 6
+    assert stats.total_ms > 0
+    assert list(stats.repeated().values()) == [5]
+    route = get_query_stats()["loop"]
+    assert route["n_plus_one_calls"] == 1
+    assert route["n_plus_one_statement"].startswith("SELECT device.id")
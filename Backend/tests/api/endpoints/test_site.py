@@ -0,0 +1,88 @@
+import pytest
+from datetime import datetime, timezone, timedelta
+from httpx import AsyncClient
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+
+from app.config import settings
+from app.core.sites import owns_site, site_worker
+from app.models.device import Device
+
+
+async def _add_devices(test_session_factory, end_time=None, user_id=None):
+    async with test_session_factory() as session:
+        session.add(Device(id=1, name="Washer", type="washer", hourly_cost=1.2, site="main",
+                           user_id=user_id, end_time=end_time))
+        session.add(Device(id=2, name="Dryer", type="dryer", hourly_cost=1.5, site="main"))
+        await session.commit()
+
+async def _token(ac):
+    response = await ac.post(
+        "/auth/token",
+        data={"username": "testuser", "password": "testpassword"},
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    return response.json()["access_token"]
+
+@pytest.mark.asyncio
+async def test_site_devices(test_app, test_user, test_session_factory):
+    await _add_devices(test_session_factory)
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        headers = {"Authorization": f"Bearer {await _token(ac)}"}
+
+        response = await ac.get("/site", headers=headers)
+        assert response.status_code == 200
+        assert response.json()[0]["site"] == "main"
+        assert response.json()[0]["owned"] is True
+
+        response = await ac.get("/site/main/devices", headers=headers)
+        assert response.status_code == 200
+        assert [device["id"] for device in response.json()] == [1, 2]
+        assert all(device["site"] == "main" for device in response.json())
+
+        response = await ac.get("/site/nowhere/devices", headers=headers)
+        assert response.status_code == 404
+
+@pytest.mark.asyncio
+async def test_site_websocket_pushes_expiry(test_app, test_user, test_session_factory):
+    """The hub sends a snapshot on connect and wakes up when the running device expires"""
+    end_time = datetime.now(timezone.utc) + timedelta(seconds=1)
+    await _add_devices(test_session_factory, end_time=end_time, user_id=test_user.uid)
+
+    client = TestClient(test_app)
+    with client.websocket_connect("/site/main/ws") as websocket:
+        data = websocket.receive_json()
+        assert data["site"] == "main"
+        assert data["devices"][0] == {
+            "device_id": 1, "running": True, "user_id": test_user.uid, "end_time": end_time.isoformat()
+        }
+        assert data["devices"][1]["running"] is False
+
+        data = websocket.receive_json()
+        assert data["devices"][0]["running"] is False
+        assert data["devices"][0]["user_id"] is None
+
+    # This worker owns the site, so the reset was saved
+    async with test_session_factory() as session:
+        result = await session.execute(select(Device).where(Device.id == 1))
+        device = result.scalars().first()
+        assert device.user_id is None
+        assert device.end_time is None
+
+def test_site_websocket_invalid_site(test_app):
+    client = TestClient(test_app)
+    with pytest.raises(Exception):
+        with client.websocket_connect("/site/nowhere/ws") as websocket:
+            websocket.receive_text()
+
+def test_sites_are_partitioned_across_workers(monkeypatch):
+    monkeypatch.setattr(settings, "SITE_WORKER_COUNT", 4)
+    sites = [f"site-{i}" for i in range(20)]
+    owners = {site: site_worker(site) for site in sites}
+    assert set(owners.values()) <= {0, 1, 2, 3}
+    assert len(set(owners.values())) > 1
+
+    for index in range(4):
+        monkeypatch.setattr(settings, "SITE_WORKER_INDEX", index)
+        assert {site for site in sites if owns_site(site)} == {site for site in sites if owners[site] == index}
@@ -0,0 +1,128 @@
+import pytest
+from datetime import datetime
+from httpx import AsyncClient
+from sqlalchemy import select, text
+
+from app.models.device import Device
+from app.models.user import User
+from app.models.usage_session import UsageSession
+
+
+async def _login(ac):
+    login_response = await ac.post(
+        "/auth/token",
+        data={"username": "testuser", "password": "testpassword"},
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    return {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+
+####################GET / ENDPOINT####################
+@pytest.mark.asyncio
+async def test_stats_rollups_follow_start_and_stop(test_app, test_user, test_session_factory):
+    async with test_session_factory() as session:
+        await session.execute(text("DELETE FROM device"))
+        session.add(Device(id=1, name="Washer", type="washer", hourly_cost=6.0))
+        session.add(Device(id=4, name="Dryer", type="dryer", hourly_cost=12.0))
+        result = await session.execute(select(User).where(User.uid == test_user.uid))
+        result.scalars().first().is_admin = True
+        await session.commit()
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        headers = await _login(ac)
+
+        for device_id in (1, 4):
+            response = await ac.post(
+                f"/device/start/{device_id}",
+                json={"user_id": test_user.uid, "duration_minutes": 30},
+                headers=headers
+            )
+            assert response.status_code == 200
+        response = await ac.post("/device/stop/4", headers=headers)
+        refund = response.json()["refund_amount"]
+
+        response = await ac.get("/stats", params={"scope": "device", "period": "day"}, headers=headers)
+        assert response.status_code == 200
+        rows = {row["key"]: row for row in response.json()}
+        assert rows["1"]["run_count"] == 1
+        assert rows["1"]["minutes"] == 30
+        assert rows["1"]["revenue"] == 3.0
+        assert rows["4"]["revenue"] == 6.0
+        assert rows["4"]["refunds"] == refund
+        assert rows["4"]["net_revenue"] == round(6.0 - refund, 2)
+
+        response = await ac.get(
+            "/stats", params={"scope": "device_type", "period": "month", "key": "washer"}, headers=headers
+        )
+        assert [row["run_count"] for row in response.json()] == [1]
+
+        response = await ac.get(
+            "/stats", params={"scope": "user", "period": "hour", "key": str(test_user.uid)}, headers=headers
+        )
+        assert response.json()[0]["run_count"] == 2
+        assert response.json()[0]["revenue"] == 9.0
+
+@pytest.mark.asyncio
+async def test_stats_non_admin_only_own_user(test_app, test_user):
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        headers = await _login(ac)
+
+        response = await ac.get("/stats", params={"scope": "device"}, headers=headers)
+        assert response.status_code == 403
+
+        response = await ac.get("/stats", params={"scope": "user", "key": str(test_user.uid)}, headers=headers)
+        assert response.status_code == 200
+        assert response.json() == []
+
+####################GET /occupancy ENDPOINT####################
+@pytest.mark.asyncio
+async def test_occupancy_heatmap(test_app, test_user, test_session_factory):
+    monday = datetime(2024, 3, 4)
+    async with test_session_factory() as session:
+        await session.execute(text("DELETE FROM device"))
+        session.add(Device(id=1, name="Washer", type="washer", hourly_cost=6.0))
+        session.add(Device(id=4, name="Dryer", type="dryer", hourly_cost=12.0))
+        # Washer runs 10:30-11:00, dryer 10:00-11:00 but is stopped at 10:45
+        session.add(UsageSession(
+            device_id=1, user_id=test_user.uid, cost=3,
+            start_time=monday.replace(hour=10, minute=30),
+            planned_end=monday.replace(hour=11),
+            end_time=monday.replace(hour=11)
+        ))
+        session.add(UsageSession(
+            device_id=4, user_id=test_user.uid, cost=12, refund=3,
+            start_time=monday.replace(hour=10),
+            planned_end=monday.replace(hour=11),
+            actual_end=monday.replace(hour=10, minute=45),
+            end_time=monday.replace(hour=10, minute=45)
+        ))
+        result = await session.execute(select(User).where(User.uid == test_user.uid))
+        result.scalars().first().is_admin = True
+        await session.commit()
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        headers = await _login(ac)
+
+        params = {"start": "2024-03-04T00:00:00", "end": "2024-03-11T00:00:00"}
+        response = await ac.get("/stats/occupancy", params=params, headers=headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["device_count"] == 2
+        # 75 of 120 machine minutes used on Monday 10:00-11:00
+        assert data["occupancy"][0][10] == 0.625
+        assert data["occupancy"][0][11] == 0
+        assert data["peak_concurrency"][0][10] == 2
+        assert sum(map(sum, data["peak_concurrency"])) == 2
+        assert data["device_utilization"] == {"1": round(1800 / 604800 * 100, 2), "4": round(2700 / 604800 * 100, 2)}
+
+        # Shifting to local time moves the bins
+        response = await ac.get("/stats/occupancy", params={**params, "utc_offset_hours": 2}, headers=headers)
+        assert response.json()["peak_concurrency"][0][12] == 2
+
+        response = await ac.get("/stats/occupancy", params={**params, "device_type": "washer"}, headers=headers)
+        data = response.json()
+        assert data["device_count"] == 1
+        assert data["occupancy"][0][10] == 0.5
+
+        response = await ac.get("/stats/occupancy", params={"start": params["end"], "end": params["start"]},
+                                headers=headers)
+        assert response.status_code == 400
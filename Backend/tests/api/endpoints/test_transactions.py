@@ -0,0 +1,166 @@
+import gzip
+import logging
+import pytest
+from datetime import datetime
+from httpx import AsyncClient
+from sqlalchemy import select
+
+from app.models.user import User
+from app.core import logindex
+from app.core.logindex import TransactionLogIndex
+from app.core.logging import CustomLogLevels, RotatingBatchedFileHandler, read_segment_manifest
+from app.config import settings
+
+LOG_LINES = [
+    "2024-03-01 10:00:00,000 - TRANSACTION - DEVICE_PAYMENT: User 42 (alice (2nd floor)) paid 0.6 for device 1 (Washing Machine 1) for 30 minutes. Balance changed from 10.0 to 9.4",
+    "2024-03-01 10:20:00,000 - TRANSACTION - DEVICE_REFUND: User 42 (alice (2nd floor)) refunded 0.2 from device 1 (Washing Machine 1) for 10.00 minutes. Balance changed from 9.4 to 9.6",
+    "2024-03-02 09:00:00,000 - TRANSACTION - DEVICE_PAYMENT: User 7 (bob) paid 1.5 for device 4 (Dryer 1) for 60 minutes. Balance changed from 5.0 to 3.5",
+    "2024-03-03 12:00:00,000 - TRANSACTION - CASH_UPDATE: User 42 (alice (2nd floor)) balance changed from 9.6 to 20.0 (difference: 10.4) by user 1 (admin)",
+]
+
+
+async def _admin_token(ac, test_session_factory, test_user):
+    async with test_session_factory() as session:
+        result = await session.execute(select(User).where(User.uid == test_user.uid))
+        user = result.scalars().first()
+        user.is_admin = True
+        await session.commit()
+
+    login_response = await ac.post(
+        "/auth/token",
+        data={"username": "testuser", "password": "testpassword"},
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    return login_response.json()["access_token"]
+
+####################GET /log ENDPOINT####################
+@pytest.mark.asyncio
+async def test_query_transaction_log(test_app, test_user, test_session_factory, tmp_path, monkeypatch):
+    log_path = tmp_path / "transactions.log"
+    # Older lines live in a rotated segment
+    (tmp_path / "transactions.log.1").write_text("\n".join(LOG_LINES[:2]) + "\n")
+    log_path.write_text("\n".join(LOG_LINES[2:3]) + "\n")
+    monkeypatch.setattr(logindex, "_index", TransactionLogIndex(str(log_path)))
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        token = await _admin_token(ac, test_session_factory, test_user)
+        headers = {"Authorization": f"Bearer {token}"}
+
+        response = await ac.get("/transactions/log", params={"user_id": 42}, headers=headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert [r["kind"] for r in data] == ["DEVICE_PAYMENT", "DEVICE_REFUND"]
+        assert data[0]["amount"] == -0.6
+        assert data[1]["device_id"] == 1
+
+        # Appended lines are picked up incrementally, only the live segment's index file is rewritten
+        index_files = {path.name: path.stat().st_mtime_ns for path in (tmp_path / "transactions.log.idx").iterdir()}
+        assert len(index_files) == 2
+        with open(log_path, "a") as f:
+            f.write(LOG_LINES[3] + "\n")
+        response = await ac.get("/transactions/log", params={"user_id": 42}, headers=headers)
+        data = response.json()
+        assert len(data) == 3
+        rewritten = [path.name for path in (tmp_path / "transactions.log.idx").iterdir()
+                     if path.stat().st_mtime_ns != index_files[path.name]]
+        assert len(rewritten) == 1
+        assert data[2]["actor_id"] == 1
+        assert data[2]["balance_after"] == 20.0
+
+        response = await ac.get("/transactions/log", params={"device_id": 4}, headers=headers)
+        assert [r["user_id"] for r in response.json()] == [7]
+
+        response = await ac.get(
+            "/transactions/log",
+            params={"start": "2024-03-01T10:10:00", "end": "2024-03-03T00:00:00"},
+            headers=headers
+        )
+        assert [r["kind"] for r in response.json()] == ["DEVICE_REFUND", "DEVICE_PAYMENT"]
+
+        # Times with an offset are compared in the log's local time
+        response = await ac.get(
+            "/transactions/log",
+            params={"start": datetime(2024, 3, 1, 10, 10).astimezone().isoformat()},
+            headers=headers
+        )
+        assert response.status_code == 200
+        assert [r["kind"] for r in response.json()] == ["DEVICE_REFUND", "DEVICE_PAYMENT", "CASH_UPDATE"]
+
+    # The sidecar index is reused by a new reader
+    assert (tmp_path / "transactions.log.idx").exists()
+    reloaded = TransactionLogIndex(str(log_path))
+    assert sum(segment.count for segment in reloaded.segments.values()) == 4
+    assert len(reloaded.query(user_id=42, kinds=["CASH_UPDATE"])) == 1
+
+####################GET /segments ENDPOINT####################
+@pytest.mark.asyncio
+async def test_rotated_segments(test_app, test_user, test_session_factory, tmp_path, monkeypatch):
+    log_path = tmp_path / "transactions.log"
+    handler = RotatingBatchedFileHandler(str(log_path), max_bytes=300, rotate_daily=True, compress=True)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    # Two records fit in one segment, a new day always starts a new one
+    created = [
+        datetime(2024, 3, 1, 10, 0), datetime(2024, 3, 1, 10, 20), datetime(2024, 3, 1, 11, 0),
+        datetime(2024, 3, 2, 9, 0)
+    ]
+    for i, when in enumerate(created):
+        record = logging.makeLogRecord({
+            "name": "transaction",
+            "levelno": CustomLogLevels.TRANSACTION,
+            "levelname": "TRANSACTION",
+            "msg": LOG_LINES[i].split(" - TRANSACTION - ")[1],
+            "created": when.timestamp(),
+            "msecs": 0,
+        })
+        handler.handle(record)
+    handler.close()
+
+    manifest = read_segment_manifest(str(log_path))
+    assert [(s["first"], s["last"]) for s in manifest] == [
+        ("2024-03-01T10:00:00", "2024-03-01T10:20:00"),
+        ("2024-03-01T11:00:00", "2024-03-01T11:00:00"),
+    ]
+    assert all(s["path"].endswith(".gz") and (tmp_path / s["path"]).exists() for s in manifest)
+
+    # The index reads compressed segments and only opens the ones inside the window
+    index = TransactionLogIndex(str(log_path))
+    assert len(index.query()) == 4
+    assert [r["kind"] for r in index.query(start=datetime(2024, 3, 2))] == ["CASH_UPDATE"]
+
+    # Decompressed segments are reused by later queries
+    assert len(index._decompressed) == 2
+    monkeypatch.setattr(logindex.gzip, "open", None)
+    assert len(index.query(user_id=42)) == 3
+
+    monkeypatch.setattr(settings, "TRANSACTION_LOG_PATH", str(log_path))
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        token = await _admin_token(ac, test_session_factory, test_user)
+        response = await ac.get("/transactions/segments", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        assert response.json() == manifest
+
+def test_query_finds_segment_compressed_meanwhile(tmp_path, monkeypatch):
+    log_path = tmp_path / "transactions.log"
+    segment_path = tmp_path / "transactions.log.1"
+    segment_path.write_text("\n".join(LOG_LINES[:2]) + "\n")
+    log_path.write_text(LOG_LINES[2] + "\n")
+    index = TransactionLogIndex(str(log_path))
+    index.refresh()
+
+    # The rotator compresses the segment between the query's refresh and its read
+    with open(segment_path, "rb") as src, gzip.open(str(segment_path) + ".gz", "wb") as dst:
+        dst.write(src.read())
+    segment_path.unlink()
+    refresh = index.refresh
+    calls = []
+    monkeypatch.setattr(index, "refresh", lambda: calls.append(1) if len(calls) == 0 else refresh())
+
+    assert [r["kind"] for r in index.query(user_id=42)] == ["DEVICE_PAYMENT", "DEVICE_REFUND"]
+
+def test_read_records_unterminated_last_line(tmp_path):
+    path = tmp_path / "segment.log"
+    path.write_text(LOG_LINES[0] + "\n" + LOG_LINES[1])
+    index = TransactionLogIndex(str(tmp_path / "transactions.log"))
+    records = index._read_records(str(path), [len(LOG_LINES[0]) + 1])
+    assert records[0]["balance_after"] == 9.6
@@ -1,9 +1,22 @@
+import base64
 import pytest
+import json
+from datetime import datetime, timedelta
+from typing import List
+from pydantic import TypeAdapter
 from httpx import AsyncClient
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
 from app.main import app
+from app.config import settings
+from app.database import replica
+from app.models.base import Base
+from app.models.replica import ReplicaHeartbeat
 from app.models.user import User
-from app.core.auth import get_password_hash
+from app.models.ledger import LedgerEntry, LedgerKind
+from app.core.auth import get_password_hash, verify_password
+from app.schemas.user import UserResponse
 
 ####################POST / ENDPOINT (CREATE USER)####################
 @pytest.mark.asyncio
@@ -111,6 +124,84 @@ async def test_create_user_duplicate_name(test_app, test_user):
         assert "detail" in data
         assert "Username already exists" in data["detail"]
 
+@pytest.mark.asyncio
+async def test_update_user_duplicate_name(test_app, test_user, test_session_factory):
+    """Test that renaming a user to an existing name fails"""
+    async with test_session_factory() as session:
+        session.add(User(name="takenname", cash=0, hashed_password="x", is_admin=False))
+        await session.commit()
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        token = login_response.json()["access_token"]
+
+        response = await ac.patch(
+            f"/user/{test_user.uid}",
+            json={"name": "takenname"},
+            headers={"Authorization": f"Bearer {token}"}
+        )
+
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Username already exists"
+
+@pytest.mark.asyncio
+async def test_update_user_cash_idempotent_retry(test_app, test_user, test_session_factory):
+    """Test that a retried cash update with the same idempotency key is applied once"""
+    async with test_session_factory() as session:
+        result = await session.execute(select(User).where(User.uid == test_user.uid))
+        user = result.scalars().first()
+        user.is_admin = True
+        await session.commit()
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        token = login_response.json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}", "X-Idempotency-Key": "topup-1"}
+
+        first = await ac.patch(f"/user/{test_user.uid}", json={"cash": 150}, headers=headers)
+        assert first.status_code == 200
+
+        # Balance changes in between, the retry must not set it back
+        await ac.patch(f"/user/{test_user.uid}", json={"cash": 120}, headers={"Authorization": f"Bearer {token}"})
+        second = await ac.patch(f"/user/{test_user.uid}", json={"cash": 150}, headers=headers)
+        assert second.status_code == 200
+        assert second.json()["cash"] == 150
+
+        # The key is bound to the caller and the request's arguments
+        response = await ac.patch(f"/user/{test_user.uid}", json={"cash": 160}, headers=headers)
+        assert response.status_code == 422
+
+        async with test_session_factory() as session:
+            other = User(name="otheruser", cash=5, hashed_password=get_password_hash("otherpassword"))
+            session.add(other)
+            await session.commit()
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "otheruser", "password": "otherpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        other_headers = {"Authorization": f"Bearer {login_response.json()['access_token']}",
+                         "X-Idempotency-Key": "topup-1"}
+        # Permissions are checked before the stored response could be returned
+        response = await ac.patch(f"/user/{test_user.uid}", json={"cash": 150}, headers=other_headers)
+        assert response.status_code == 403
+        response = await ac.patch(f"/user/{other.uid}", json={"cash": 150}, headers=other_headers)
+        assert response.status_code == 422
+
+    async with test_session_factory() as session:
+        result = await session.execute(select(User).where(User.uid == test_user.uid))
+        assert float(result.scalars().first().cash) == 120
+        result = await session.execute(select(LedgerEntry))
+        assert len(result.scalars().all()) == 2
+
 @pytest.mark.asyncio
 async def test_create_user_with_keycard(test_app, test_session_factory):
     """Test creating a user with key card and PIN"""
@@ -524,3 +615,323 @@ async def test_remove_nonexistent_keycard(test_app, test_user):
         data = response.json()
         assert "detail" in data
         assert "does not have key card authentication" in data["detail"]
+
+####################GET /all ENDPOINT####################
+@pytest.mark.asyncio
+async def test_get_all_users_keyset_pagination(test_app, test_session_factory):
+    """Test paging through users with limit, cursor, prefix filter and sort"""
+    async with test_session_factory() as session:
+        for name in ["alice", "bob", "anna", "albert", "carl"]:
+            session.add(User(name=name, cash=0, hashed_password="x", is_admin=False))
+        await session.commit()
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        # Without limit all users are returned
+        response = await ac.get("/user/all")
+        assert response.status_code == 200
+        assert len(response.json()) == 5
+        assert "X-Next-Cursor" not in response.headers
+
+        # Page through users starting with "a", sorted by name
+        names = []
+        cursor = None
+        while True:
+            params = {"limit": 2, "name_prefix": "a", "sort": "name", "include_total": True}
+            if cursor:
+                params["cursor"] = cursor
+            response = await ac.get("/user/all", params=params)
+            assert response.status_code == 200
+            assert response.headers["X-Total-Count"] == "3"
+            names += [u["name"] for u in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+        assert names == ["albert", "alice", "anna"]
+
+        # Descending uid order
+        response = await ac.get("/user/all", params={"limit": 2, "sort": "-uid"})
+        uids = [u["uid"] for u in response.json()]
+        assert uids == sorted(uids, reverse=True)
+        response = await ac.get("/user/all", params={
+            "limit": 10, "sort": "-uid", "cursor": response.headers["X-Next-Cursor"]
+        })
+        assert all(u["uid"] < uids[-1] for u in response.json())
+        assert len(response.json()) == 3
+
+        # Invalid cursor
+        response = await ac.get("/user/all", params={"limit": 2, "cursor": "notacursor"})
+        assert response.status_code == 400
+
+        # Crafted cursors whose sort value doesn't fit the sort column
+        for sort, sort_value in [("name", {"a": 1}), ("name", [1]), ("name", 5), ("uid", "a"), ("-uid", None)]:
+            crafted = base64.urlsafe_b64encode(json.dumps([sort_value, 5]).encode()).decode()
+            response = await ac.get("/user/all", params={"limit": 2, "sort": sort, "cursor": crafted})
+            assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_get_users_match_response_model(test_app, test_user, test_session_factory):
+    """The fast JSON path sends exactly what UserResponse would"""
+    async with test_session_factory() as session:
+        session.add(User(name="carded", cash=12.34, hashed_password="x", is_admin=True,
+                         key_card_hash="card", pin_hash="pin"))
+        await session.commit()
+
+    adapter = TypeAdapter(List[UserResponse])
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        response = await ac.get("/user/all")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/json"
+        users = response.json()
+        assert users == adapter.dump_python(adapter.validate_python(users), mode="json")
+        assert [(u["name"], u["is_admin"], u["has_keycard"], u["cash"]) for u in users] == [
+            ("testuser", False, False, 100.0), ("carded", True, True, 12.34)
+        ]
+
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        response = await ac.get(
+            f"/user/{test_user.uid}",
+            headers={"Authorization": f"Bearer {login_response.json()['access_token']}"}
+        )
+        assert response.json() == users[0]
+
+####################POST /import ENDPOINT####################
+@pytest.mark.asyncio
+async def test_import_users_csv(test_app, test_user, test_session_factory):
+    """Test bulk importing users from CSV with a per-row error report"""
+    async with test_session_factory() as session:
+        result = await session.execute(select(User).where(User.uid == test_user.uid))
+        user = result.scalars().first()
+        user.is_admin = True
+        await session.commit()
+
+    csv_data = (
+        "name,password,key_card_id,pin\n"
+        "resident1,pw1,card1,1111\n"
+        "resident2,pw2,,\n"
+        "testuser,pw3,,\n"
+        "resident1,pw4,,\n"
+        ",\n"
+        "\"resident3\",\"multi\nline pw\",,\n"
+    )
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        token = login_response.json()["access_token"]
+
+        response = await ac.post(
+            "/user/import",
+            content=csv_data,
+            headers={"Authorization": f"Bearer {token}", "Content-Type": "text/csv"}
+        )
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["created"] == 3
+        assert data["failed"] == 3
+        assert [e["row"] for e in data["errors"]] == [3, 4, 5]
+        assert data["errors"][0]["detail"] == "Username already exists"
+
+        # Imported users can log in with their password and key card
+        response = await ac.post(
+            "/auth/token/keycard",
+            json={"key_card_id": "card1", "pin": "1111"}
+        )
+        assert response.status_code == 200
+
+        async with test_session_factory() as session:
+            result = await session.execute(select(User).where(User.name == "resident2"))
+            imported = result.scalars().first()
+            assert imported.key_card_hash is None
+            assert float(imported.cash) == 0
+
+            # A quoted field spanning lines stays one row
+            result = await session.execute(select(User).where(User.name == "resident3"))
+            assert verify_password("multi\nline pw", result.scalars().first().hashed_password)
+
+@pytest.mark.asyncio
+async def test_import_users_requires_admin(test_app, test_user):
+    """Test that only admins can bulk import users"""
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        token = login_response.json()["access_token"]
+
+        response = await ac.post(
+            "/user/import",
+            json=[{"name": "sneaky", "password": "pw"}],
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == 403
+
+####################GET /export ENDPOINT####################
+@pytest.mark.asyncio
+async def test_export_users(test_app, test_user, test_session_factory):
+    """Test streaming the user export as CSV and NDJSON"""
+    async with test_session_factory() as session:
+        result = await session.execute(select(User).where(User.uid == test_user.uid))
+        user = result.scalars().first()
+        user.is_admin = True
+        session.add(User(
+            name="carduser",
+            cash=12.5,
+            hashed_password="x",
+            key_card_hash="card",
+            pin_hash="pin"
+        ))
+        await session.commit()
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        token = login_response.json()["access_token"]
+
+        response = await ac.get("/user/export", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        lines = response.text.strip().splitlines()
+        assert lines[0] == "uid,name,cash,is_admin,has_keycard,creation_time"
+        assert len(lines) == 3
+
+        response = await ac.get(
+            "/user/export",
+            params={"format": "ndjson"},
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == 200
+        rows = [json.loads(line) for line in response.text.strip().splitlines()]
+        card_row = next(r for r in rows if r["name"] == "carduser")
+        assert card_row["cash"] == 12.5
+        assert card_row["has_keycard"] is True
+        assert next(r for r in rows if r["name"] == "testuser")["has_keycard"] is False
+
+####################GET /{uid}/transactions ENDPOINT####################
+@pytest.mark.asyncio
+async def test_get_user_transactions(test_app, test_user, test_session_factory):
+    """Test paging through a user's ledger history, newest first"""
+    base_time = datetime(2024, 3, 1, 12, 0)
+    async with test_session_factory() as session:
+        for i in range(5):
+            session.add(LedgerEntry(
+                user_id=test_user.uid,
+                device_id=1,
+                kind=LedgerKind.DEVICE_PAYMENT,
+                amount=-1,
+                balance_after=100 - i - 1,
+                timestamp=base_time + timedelta(hours=i)
+            ))
+        # Another user's entry must not show up
+        session.add(LedgerEntry(
+            user_id=test_user.uid + 1, kind=LedgerKind.CASH_UPDATE, amount=5, balance_after=5, timestamp=base_time
+        ))
+        await session.commit()
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        login_response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+
+        response = await ac.get(f"/user/{test_user.uid}/transactions", params={"limit": 2}, headers=headers)
+        assert response.status_code == 200
+        assert [e["balance_after"] for e in response.json()] == [95, 96]
+
+        response = await ac.get(
+            f"/user/{test_user.uid}/transactions",
+            params={"limit": 10, "cursor": response.headers["X-Next-Cursor"]},
+            headers=headers
+        )
+        assert [e["balance_after"] for e in response.json()] == [97, 98, 99]
+        assert "X-Next-Cursor" not in response.headers
+
+        response = await ac.get(
+            f"/user/{test_user.uid}/transactions",
+            params={"start": "2024-03-01T13:00:00", "end": "2024-03-01T15:00:00"},
+            headers=headers
+        )
+        assert [e["balance_after"] for e in response.json()] == [97, 98]
+
+        # Users can't read other users' history
+        response = await ac.get(f"/user/{test_user.uid + 1}/transactions", headers=headers)
+        assert response.status_code == 403
+
+####################READ REPLICA####################
+@pytest.mark.asyncio
+async def test_reads_use_replica_until_client_writes(test_app, test_user, test_session_factory, tmp_path, monkeypatch):
+    # A second SQLite database stands in for the replica, holding an older copy of the user
+    replica_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'replica.db'}")
+    async with replica_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    replica_factory = sessionmaker(replica_engine, class_=AsyncSession, expire_on_commit=False)
+    async with replica_factory() as session:
+        session.add(User(uid=test_user.uid, name="replica copy", cash=100))
+        session.add(ReplicaHeartbeat(id=1, beat_at=datetime.utcnow()))
+        await session.commit()
+    monkeypatch.setattr(replica, "ReplicaSessionLocal", replica_factory)
+    monkeypatch.setattr(replica, "AsyncSessionLocal", test_session_factory)
+
+    try:
+        # The primary's heartbeat doesn't replicate between SQLite files, the one above is fresh though
+        assert await replica.check_replica_lag() < settings.REPLICA_MAX_LAG_SECONDS
+
+        async with AsyncClient(app=test_app, base_url="http://test") as ac:
+            login_response = await ac.post(
+                "/auth/token",
+                data={"username": "testuser", "password": "testpassword"},
+                headers={"Content-Type": "application/x-www-form-urlencoded"}
+            )
+            headers = {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+
+            response = await ac.get(f"/user/{test_user.uid}", headers=headers)
+            assert response.json()["name"] == "replica copy"
+
+            # After a write the client reads its own changes from the primary
+            response_of_write = await ac.patch(f"/user/{test_user.uid}", json={"name": "renamed"}, headers=headers)
+            assert response_of_write.status_code == 200
+            response = await ac.get(f"/user/{test_user.uid}", headers=headers)
+            assert response.json()["name"] == "renamed"
+            assert replica.get_replica_status()["routed"] == {"replica": 1, "primary": 1}
+
+            # The write time travels with the client, a worker that didn't see the write knows it too
+            replica._recent_writers.clear()
+            assert ac.cookies.get(replica.WRITE_COOKIE)
+            response = await ac.get(f"/user/{test_user.uid}", headers=headers)
+            assert response.json()["name"] == "renamed"
+            assert replica.get_replica_status()["routed"] == {"replica": 1, "primary": 2}
+
+            # Clients that don't send cookies echo the header of their write instead
+            last_write = response_of_write.headers[replica.WRITE_HEADER]
+            replica._recent_writers.clear()
+            ac.cookies.clear()
+            response = await ac.get(f"/user/{test_user.uid}", headers={**headers, replica.WRITE_HEADER: last_write})
+            assert response.json()["name"] == "renamed"
+            assert replica.get_replica_status()["routed"] == {"replica": 1, "primary": 3}
+            response = await ac.get(f"/user/{test_user.uid}", headers=headers)
+            assert response.json()["name"] == "replica copy"
+
+            # A replica lagging too far behind isn't used at all
+            replica.reset_replica_state()
+            async with replica_factory() as session:
+                heartbeat = await session.get(ReplicaHeartbeat, 1)
+                heartbeat.beat_at = datetime.utcnow() - timedelta(seconds=settings.REPLICA_MAX_LAG_SECONDS + 60)
+                await session.commit()
+            assert await replica.check_replica_lag() > settings.REPLICA_MAX_LAG_SECONDS
+            response = await ac.get(f"/user/{test_user.uid}", headers=headers)
+            assert response.json()["name"] == "renamed"
+    finally:
+        await replica_engine.dispose()
@@ -8,6 +8,11 @@ from app.models.base import Base
 from app.models.user import User
 from app.core.auth import get_password_hash
 from app.database.session import get_db
+from app.core.ratelimit import reset_throttles
+from app.core.idempotency import idempotency_cache
+from app.database.instrumentation import reset_query_stats
+from app.database.replica import reset_replica_state
+from app.core import device_table, sites
 from app.main import app
 
 # Test database URL - use in-memory SQLite for tests
@@ -22,8 +27,16 @@ async def test_app(test_session_factory):
             yield session
 
     app.dependency_overrides[get_db] = override_get_db
+    # Background work opens its sessions through module level factories instead of get_db
+    session_factory = sites.session_factory
+    sites.session_factory = device_table.session_factory = test_session_factory
+    reset_throttles()
+    idempotency_cache.clear()
+    reset_query_stats()
+    reset_replica_state()
     yield app
     app.dependency_overrides.clear()
+    sites.session_factory = device_table.session_factory = session_factory
 
 
 @pytest_asyncio.fixture(scope="session")
@@ -0,0 +1,154 @@
+import multiprocessing
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import pytest
+import pytest_asyncio
+from httpx import AsyncClient
+from sqlalchemy import delete
+
+from app.config import settings
+from app.core import device_table
+from app.core.device_table import DeviceTable, load_device_table, read_device
+from app.models.device import Device
+
+
+@pytest.fixture
+def table_name(monkeypatch):
+    name = f"waschplan-test-{uuid.uuid4().hex[:12]}"
+    monkeypatch.setattr(settings, "DEVICE_TABLE_NAME", name)
+    yield name
+    device_table.close_device_table(unlink=True)
+
+@pytest_asyncio.fixture
+async def devices(test_session_factory):
+    async with test_session_factory() as session:
+        for device_id in range(1, 6):
+            session.add(Device(id=device_id, name=f"Device {device_id}", type="washer", hourly_cost=1.2, site="main"))
+        await session.commit()
+
+def _read_in_other_process(name, capacity, queue):
+    table = DeviceTable(name, capacity)
+    queue.put((table.created, table.read(0)))
+    table.close()
+
+def test_seqlock_reads_and_ordered_writes(table_name):
+    table = DeviceTable(table_name, 2)
+    assert table.created
+    assert table.read(0) is None
+
+    assert table.write(0, 1, 7, 1000.0, stamp=2.0)
+    assert table.read(0) == (1, 7, 1000.0, 2.0)
+    # A write based on an older state arrives late and is dropped
+    assert not table.write(0, 1, 0, 0.0, stamp=1.0)
+    # An expiry only clears the run it saw
+    assert not table.write(0, 1, 0, 0.0, stamp=3.0, expect_end_time=999.0)
+    assert table.write(0, 1, 0, 0.0, stamp=3.0, expect_end_time=1000.0)
+    assert table.read(0) == (1, 0, 0.0, 3.0)
+
+    # A reader never returns a record while a write is in progress
+    table.records["seq"][1] = 1
+    assert table.read(1) is None
+    assert table.retries > 0
+
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_read_in_other_process, args=(table_name, 2, queue))
+    process.start()
+    created, record = queue.get(timeout=30)
+    process.join()
+    assert not created
+    assert record == (1, 0, 0.0, 3.0)
+    table.close(unlink=True)
+
+def test_mismatched_segment_is_recreated(table_name):
+    table = DeviceTable(table_name, 2)
+    table.write(0, 1, 7, 1000.0, stamp=1.0)
+    table.close()
+
+    table = DeviceTable(table_name, 3)
+    assert table.created
+    assert table.read(0) is None
+    table.close(unlink=True)
+
+@pytest.mark.asyncio
+async def test_load_replaces_stale_states(test_app, test_session_factory, devices, table_name):
+    # Left over from before a restart or a database restore
+    table = device_table.open_device_table()
+    table.write(0, 1, 42, 4102444800.0, stamp=device_table.table_stamp())
+
+    await load_device_table()
+    assert read_device(1) == (None, None)
+
+def test_table_disabled_without_ordered_stores(table_name, monkeypatch):
+    monkeypatch.setattr(device_table.platform, "machine", lambda: "aarch64")
+    assert device_table.open_device_table() is None
+    assert device_table.get_device_table_stats()["enabled"] is False
+
+@pytest.mark.asyncio
+async def test_device_reads_use_table(test_app, test_user, test_session_factory, devices, table_name):
+    await load_device_table()
+    assert read_device(1) == (None, None)
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        response = await ac.post("/device/start/1", json={"user_id": test_user.uid, "duration_minutes": 30},
+                                 headers=headers)
+        assert response.status_code == 200
+        user_id, end_time = read_device(1)
+        assert user_id == test_user.uid
+        expected_end = datetime.now(timezone.utc) + timedelta(minutes=30)
+        assert abs(end_time - expected_end.timestamp()) < 5
+
+        # With the rows gone, only the table can answer
+        async with test_session_factory() as session:
+            await session.execute(delete(Device))
+            await session.commit()
+
+        response = await ac.get("/device/all", headers=headers)
+        assert response.status_code == 200
+        assert [device["id"] for device in response.json()] == [1, 2, 3, 4, 5]
+        assert response.json()[0]["user_id"] == test_user.uid
+        assert response.json()[0]["time_left"] > 0
+        assert response.json()[1]["user_id"] is None
+
+        response = await ac.get("/device/2", headers=headers)
+        assert response.json()["name"] == "Device 2"
+
+@pytest.mark.asyncio
+async def test_table_and_database_send_the_same_device(test_app, test_user, test_session_factory, devices,
+                                                       table_name):
+    end_time = (datetime.now(timezone.utc) + timedelta(minutes=30)).replace(microsecond=0)
+    async with test_session_factory() as session:
+        device = await session.get(Device, 1)
+        device.user_id = test_user.uid
+        device.end_time = end_time.replace(tzinfo=None)
+        await session.commit()
+    await load_device_table()
+
+    async with AsyncClient(app=test_app, base_url="http://test") as ac:
+        response = await ac.post(
+            "/auth/token",
+            data={"username": "testuser", "password": "testpassword"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        from_table = (await ac.get("/device/1", headers=headers)).json()
+        all_from_table = (await ac.get("/device/all", headers=headers)).json()
+        # Not loaded: reads fall back to the database
+        device_table._static.clear()
+        from_database = (await ac.get("/device/1", headers=headers)).json()
+        all_from_database = (await ac.get("/device/all", headers=headers)).json()
+
+    # Both mark the end time as UTC
+    assert from_table["end_time"] == from_database["end_time"] == end_time.isoformat()
+    for table_device, database_device in [(from_table, from_database), *zip(all_from_table, all_from_database)]:
+        assert abs(table_device.pop("time_left") - database_device.pop("time_left")) < 5
+        assert table_device == database_device
@@ -0,0 +1,68 @@
+import pytest
+from sqlalchemy import false, select, update
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.config import DEVICES
+from app.core import initializer
+from app.core.initializer import ensure_schema, initialize_database
+from app.database.instrumentation import track_queries
+from app.models.device import Device
+from app.models.schema_version import SchemaVersion
+
+
+####################SCHEMA VERSION####################
+@pytest.mark.asyncio
+async def test_ensure_schema_skips_current_schema(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'schema.db'}")
+    try:
+        assert await ensure_schema(engine) is True
+        assert await ensure_schema(engine) is False
+
+        # Models changed since the tables were created
+        async with engine.begin() as conn:
+            await conn.execute(update(SchemaVersion).values(fingerprint="outdated"))
+        assert await ensure_schema(engine) is True
+        assert await ensure_schema(engine) is False
+    finally:
+        await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_ensure_schema_tolerates_concurrent_first_boot(tmp_path, monkeypatch):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'schema.db'}")
+    try:
+        assert await ensure_schema(engine) is True
+        async with engine.begin() as conn:
+            await conn.execute(update(SchemaVersion).values(fingerprint="outdated"))
+
+        # Another worker inserts the row between this worker's update and insert
+        monkeypatch.setattr(initializer, "update", lambda table: update(table).where(false()))
+        assert await ensure_schema(engine) is True
+    finally:
+        await engine.dispose()
+
+####################DEVICE RECONCILIATION####################
+@pytest.mark.asyncio
+async def test_initialize_database_reconciles_devices_in_bulk(test_user, test_session_factory, monkeypatch):
+    async def override_get_db():
+        async with test_session_factory() as session:
+            yield session
+    monkeypatch.setattr(initializer, "get_db", override_get_db)
+
+    async with test_session_factory() as session:
+        session.add_all([
+            Device(id=1, name="Old name", type="washer", hourly_cost=9.99),
+            Device(id=99, name="Removed", type="dryer", hourly_cost=1.0),
+        ])
+        await session.commit()
+
+    await initialize_database()
+
+    async with test_session_factory() as session:
+        result = await session.execute(select(Device).order_by(Device.id))
+        devices = [(d.id, d.name, d.type, d.hourly_cost) for d in result.scalars().all()]
+    assert devices == [(d["id"], d["name"], d["type"], d["hourly_cost"]) for d in DEVICES]
+
+    # Nothing to change: one read for users, one for devices, no writes
+    with track_queries("startup") as stats:
+        await initialize_database()
+    assert stats.count == 2
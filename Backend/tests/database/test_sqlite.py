@@ -0,0 +1,76 @@
+import asyncio
+import sqlite3
+import pytest
+import pytest_asyncio
+from sqlalchemy import func, select, text, update
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from app.config import settings
+from app.database.sqlite import backup_database, configure_sqlite, list_backups
+from app.models.base import Base
+from app.models.user import User
+
+
+@pytest_asyncio.fixture
+async def sqlite_engine(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'waschplan.db'}")
+    queue = configure_sqlite(engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield engine, queue
+    await engine.dispose()
+
+####################PRAGMAS####################
+@pytest.mark.asyncio
+async def test_pragmas_applied_on_connect(sqlite_engine):
+    engine, _ = sqlite_engine
+    async with engine.connect() as conn:
+        assert (await conn.execute(text("PRAGMA journal_mode"))).scalar() == "wal"
+        assert (await conn.execute(text("PRAGMA busy_timeout"))).scalar() == settings.SQLITE_BUSY_TIMEOUT_MS
+        assert (await conn.execute(text("PRAGMA cache_size"))).scalar() == -settings.SQLITE_CACHE_SIZE_KB
+        # NORMAL
+        assert (await conn.execute(text("PRAGMA synchronous"))).scalar() == 1
+
+####################WRITER QUEUE####################
+@pytest.mark.asyncio
+async def test_concurrent_writers_are_queued(sqlite_engine):
+    engine, queue = sqlite_engine
+    session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def deposit(uid):
+        async with session_factory() as session:
+            await session.get(User, uid)
+            await session.execute(update(User).where(User.uid == uid).values(cash=User.cash + 1))
+            # Hold the write transaction open, so the others have to wait for it
+            await asyncio.sleep(0.005)
+            await session.commit()
+
+    async with session_factory() as session:
+        session.add_all([User(uid=uid, name=f"user{uid}", cash=0) for uid in range(1, 5)])
+        await session.commit()
+
+    await asyncio.gather(*(deposit(uid) for _ in range(10) for uid in range(1, 5)))
+
+    async with session_factory() as session:
+        assert (await session.execute(select(func.sum(User.cash)))).scalar() == 40
+    stats = queue.stats()
+    assert stats["waited"] > 0
+    assert stats["writer_active"] is False
+
+####################BACKUP####################
+@pytest.mark.asyncio
+async def test_online_backup(sqlite_engine, tmp_path, monkeypatch):
+    engine, _ = sqlite_engine
+    monkeypatch.setattr(settings, "SQLITE_BACKUP_DIR", str(tmp_path / "backups"))
+    monkeypatch.setattr(settings, "SQLITE_BACKUP_KEEP", 2)
+    async with engine.begin() as conn:
+        await conn.execute(User.__table__.insert().values(uid=1, name="backed up", cash=5))
+
+    for _ in range(3):
+        backup = await backup_database(str(engine.url))
+
+    assert len(list_backups()) == 2
+    assert list_backups()[0]["name"] in backup["path"]
+    with sqlite3.connect(backup["path"]) as conn:
+        assert conn.execute("SELECT name FROM user").fetchall() == [("backed up",)]